@@ -0,0 +1,79 @@
+import logging
+import time
+from pathlib import Path
+from typing import override
+
+from moncic import context
+from moncic.unittest import MoncicTestCase
+from moncic.utils.btrfs import Subvolume, list_nested_subvolumes
+
+log = logging.getLogger(__name__)
+
+#: Number of create/snapshot/remove cycles timed by the benchmark
+BENCHMARK_ROUNDS = 20
+
+
+class TestSubvolume(MoncicTestCase):
+    DEFAULT_FILESYSTEM_TYPE = "btrfs"
+
+    @override
+    def setUp(self) -> None:
+        super().setUp()
+        context.privs.needs_sudo()
+        self.moncic_config = self.config()
+        assert self.moncic_config.imagedir is not None
+        self.imagedir: Path = self.moncic_config.imagedir
+
+    def subvolume(self, name: str, use_ioctl: bool = True) -> Subvolume:
+        subvolume = Subvolume(self.moncic_config, self.imagedir / name, None)
+        subvolume.use_ioctl = use_ioctl
+        return subvolume
+
+    def test_nested(self) -> None:
+        with context.privs.root():
+            base = self.subvolume("base")
+            with base.create():
+                (base.path / "dir").mkdir()
+                nested = self.subvolume("base/dir/nested")
+                with nested.create():
+                    pass
+                inner = self.subvolume("base/dir/nested/inner")
+                with inner.create():
+                    pass
+            self.assertEqual(
+                list_nested_subvolumes(base.path), [nested.path, inner.path]
+            )
+
+            snapshot = self.subvolume("snapshot")
+            snapshot.snapshot(base.path)
+            self.assertTrue((snapshot.path / "dir").is_dir())
+
+            base.remove()
+            snapshot.remove()
+            self.assertEqual(list(self.imagedir.iterdir()), [])
+
+    def time_cycles(self, use_ioctl: bool) -> float:
+        """Time create/snapshot/remove cycles, returning seconds per cycle."""
+        start = time.perf_counter()
+        for idx in range(BENCHMARK_ROUNDS):
+            base = self.subvolume(f"base{idx}", use_ioctl)
+            with base.create():
+                pass
+            snapshot = self.subvolume(f"snapshot{idx}", use_ioctl)
+            snapshot.snapshot(base.path)
+            snapshot.remove()
+            base.remove()
+        return (time.perf_counter() - start) / BENCHMARK_ROUNDS
+
+    def test_benchmark(self) -> None:
+        timings: dict[str, float] = {}
+        with context.privs.root():
+            timings["btrfs command"] = self.time_cycles(False)
+            timings["ioctl"] = self.time_cycles(True)
+        for name, elapsed in timings.items():
+            log.info(
+                "%s: %.2fms per create/snapshot/remove cycle",
+                name,
+                elapsed * 1000,
+            )
+        self.assertLess(timings["ioctl"], timings["btrfs command"])
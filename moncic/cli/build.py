@@ -175,6 +175,10 @@ class CI(SourceCommand):
                         info["config"] = dataclasses.asdict(builder.config)
                         info["source_history"] = builder.source.info_history()
                         info["result"] = dataclasses.asdict(builder.results)
+                        if builder.container_timings is not None:
+                            info["container_timings"] = dataclasses.asdict(
+                                builder.container_timings
+                            )
                         json.dump(info, sys.stdout, indent=1, cls=ResultEncoder)
                         sys.stdout.write("\n")
 
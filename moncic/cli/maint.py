@@ -1,16 +1,260 @@
 import argparse
+import asyncio
+import contextlib
 import logging
-from typing import Any, override
+import sys
+import time
+from pathlib import Path
+from typing import IO, TYPE_CHECKING, Any, NamedTuple, override
 
-from moncic.image import BootstrappableImage, RunnableImage
+from moncic import context
+from moncic.exceptions import Fail
+from moncic.image import BootstrappableImage, Image, RunnableImage
+from moncic.images import ImagesBase
+from moncic.provision.image import ConfiguredImage
+from moncic.utils.dag import DependencyGraph, TaskStatus
+from moncic.utils.run import moncic_env
 
 from .moncic import MoncicCommand, main_command
+from .query import (
+    HAVE_TEXTTABLE,
+    CSVOutput,
+    RowOutput,
+    TableOutput,
+    TextColumn,
+)
+
+if TYPE_CHECKING:
+    from moncic.nspawn.images import NspawnImages
+    from moncic.session import Session
 
 log = logging.getLogger(__name__)
 
 
+class ImageResult(NamedTuple):
+    """Outcome of working on an image in a subprocess."""
+
+    status: TaskStatus
+    #: Time spent on the image, in seconds, or None if it was skipped
+    duration: float | None
+
+
+class ParallelImagesCommand(MoncicCommand):
+    """
+    Base class for commands that can work on multiple images in parallel.
+
+    Each image is handled by running the same command on it in a subprocess,
+    and images are handled after the images they extend.
+    """
+
+    @override
+    @classmethod
+    def make_subparser(
+        cls, subparsers: "argparse._SubParsersAction[Any]"
+    ) -> argparse.ArgumentParser:
+        parser = super().make_subparser(subparsers)
+        parser.add_argument(
+            "--jobs",
+            "-j",
+            type=int,
+            metavar="N",
+            default=1,
+            help="number of images to work on in parallel. Images are"
+            " handled after the images they extend. Default: 1",
+        )
+        parser.add_argument(
+            "--logdir",
+            type=Path,
+            metavar="DIR",
+            help="with --jobs, write the output of each image to"
+            " DIR/<name>.log. Default: print the output of each image when"
+            " it is done",
+        )
+        return parser
+
+    def image_parent(self, image: Image) -> str | None:
+        """Return the name of the image that image extends, if any."""
+        match image:
+            case ConfiguredImage():
+                return image.config.bootstrap_info.extends
+            case RunnableImage(bootstrapped_from=ConfiguredImage() as source):
+                return source.config.bootstrap_info.extends
+            case _:
+                return None
+
+    def build_graph(
+        self,
+        images: ImagesBase,
+        names: list[str],
+        add_missing_parents: bool = False,
+    ) -> DependencyGraph:
+        """
+        Build the dependency graph of the named images.
+
+        :param add_missing_parents: also add to the graph parent images that
+          have not been bootstrapped yet
+        """
+        graph = DependencyGraph()
+        # Ancestors of each image, nearest first
+        ancestors: dict[str, list[str]] = {}
+        todo = list(names)
+        while todo:
+            name = todo.pop()
+            if name in ancestors:
+                continue
+            chain: list[str] = []
+            image = images.image(name)
+            while (parent_name := self.image_parent(image)) is not None:
+                if parent_name in chain or parent_name == name:
+                    raise ValueError(f"{name}: extends loop via {parent_name}")
+                chain.append(parent_name)
+                image = images.image(parent_name)
+                if (
+                    add_missing_parents
+                    and not image.bootstrapped
+                    and parent_name not in names
+                ):
+                    todo.append(parent_name)
+            ancestors[name] = chain
+        for name, chain in ancestors.items():
+            graph.add(name, (p for p in chain if p in ancestors))
+        return graph
+
+    def child_args(self) -> list[str]:
+        """Return command-specific arguments to pass to subprocesses."""
+        return []
+
+    def child_command(self, name: str) -> list[str]:
+        """Build the command line to work on one image in a subprocess."""
+        assert self.NAME is not None
+        cmd = [sys.executable, "-m", "moncic"]
+        if self.args.debug:
+            cmd.append("--debug")
+        elif self.args.verbose:
+            cmd.append("--verbose")
+        cmd += [self.NAME, "--jobs=1"]
+        if self.args.imagedir:
+            cmd.append(f"--imagedir={self.args.imagedir}")
+        if self.args.config:
+            cmd.append(f"--config={self.args.config}")
+        if self.args.extra_packages_dir:
+            cmd.append(f"--extra-packages-dir={self.args.extra_packages_dir}")
+        cmd += self.child_args()
+        cmd += ["--", name]
+        return cmd
+
+    async def run_child(self, name: str, logfile: IO[bytes] | None) -> bool:
+        """Work on one image in a subprocess."""
+        log.info("%s: starting %s", name, self.NAME)
+        proc = await asyncio.create_subprocess_exec(
+            *self.child_command(name),
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=logfile if logfile is not None else asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            env=moncic_env(),
+        )
+        output, _ = await proc.communicate()
+        if logfile is None:
+            # Print the output of each image in a single block
+            sys.stderr.buffer.write(
+                f"--- {name}: output ---\n".encode()
+                + (output or b"")
+                + f"--- {name}: end of output ---\n".encode()
+            )
+            sys.stderr.flush()
+        if proc.returncode != 0:
+            log.error("%s: failed with exit status %d", name, proc.returncode)
+            return False
+        log.info("%s: %s done", name, self.NAME)
+        return True
+
+    def run_graph(self, graph: DependencyGraph) -> dict[str, ImageResult]:
+        """Work on all the images in the graph, in parallel subprocesses."""
+        durations: dict[str, float] = {}
+        with contextlib.ExitStack() as stack:
+            # Open log files before regaining privileges, so they are owned by
+            # the user
+            logfiles: dict[str, IO[bytes] | None] = {}
+            for name in graph.deps:
+                if self.args.logdir is None:
+                    logfiles[name] = None
+                else:
+                    self.args.logdir.mkdir(parents=True, exist_ok=True)
+                    logfiles[name] = stack.enter_context(
+                        (self.args.logdir / f"{name}.log").open("wb")
+                    )
+
+            async def work(name: str) -> bool:
+                started = time.monotonic()
+                try:
+                    return await self.run_child(name, logfiles[name])
+                finally:
+                    durations[name] = time.monotonic() - started
+
+            # Child processes need to start as root, to be able to manage
+            # their privileges
+            with context.privs.root():
+                status = asyncio.run(graph.run(work, jobs=self.args.jobs))
+
+        return {
+            name: ImageResult(result, durations.get(name))
+            for name, result in status.items()
+        }
+
+    def report(self, results: dict[str, ImageResult]) -> bool:
+        """
+        Print a summary table of the results, and log failures.
+
+        :returns: True if all images succeeded
+        """
+        if HAVE_TEXTTABLE:
+            output: RowOutput = TableOutput(
+                sys.stdout,
+                TextColumn("Name"),
+                TextColumn("Result"),
+                TextColumn("Duration", align="r"),
+            )
+        else:
+            output = CSVOutput(sys.stdout)
+        count_ok = 0
+        for name, result in sorted(results.items()):
+            if result.duration is None:
+                duration = "-"
+            else:
+                duration = format_duration(result.duration)
+            output.add_row((name, result.status.value, duration))
+            match result.status:
+                case TaskStatus.OK:
+                    count_ok += 1
+                case TaskStatus.FAILED if self.args.logdir is not None:
+                    log.error(
+                        "%s: %s failed, see %s",
+                        name,
+                        self.NAME,
+                        self.args.logdir / f"{name}.log",
+                    )
+                case TaskStatus.FAILED:
+                    log.error("%s: %s failed", name, self.NAME)
+                case TaskStatus.SKIPPED:
+                    log.error("%s: skipped, a parent image failed", name)
+        output.flush()
+        log.info("%d/%d images succeeded", count_ok, len(results))
+        return count_ok == len(results)
+
+
+def format_duration(seconds: float) -> str:
+    """Format a duration in seconds for display."""
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h{minutes:02d}m{seconds:02d}s"
+    if minutes:
+        return f"{minutes}m{seconds:02d}s"
+    return f"{seconds}s"
+
+
 @main_command
-class Bootstrap(MoncicCommand):
+class Bootstrap(ParallelImagesCommand):
     """
     Create or update the whole set of OS images for the CI
     """
@@ -35,6 +279,8 @@ class Bootstrap(MoncicCommand):
         return parser
 
     def run(self) -> int | None:
+        if self.args.jobs > 1:
+            return self.run_parallel()
         with self.moncic.session() as session:
             images = session.images
             names = self.args.images
@@ -67,9 +313,31 @@ class Bootstrap(MoncicCommand):
                     return 6
         return None
 
+    @override
+    def child_args(self) -> list[str]:
+        if self.args.recreate:
+            return ["--recreate"]
+        return []
+
+    def run_parallel(self) -> int | None:
+        """Bootstrap images in parallel subprocesses."""
+        with self.moncic.session() as session:
+            try:
+                graph = self.build_graph(
+                    session.images, self.args.images, add_missing_parents=True
+                )
+                graph.check()
+            except ValueError as e:
+                log.critical("cannot bootstrap images: %s", e)
+                return 5
+
+        if not self.report(self.run_graph(graph)):
+            return 5
+        return None
+
 
 @main_command
-class Update(MoncicCommand):
+class Update(ParallelImagesCommand):
     """
     Update existing OS images
     """
@@ -89,6 +357,8 @@ class Update(MoncicCommand):
         return parser
 
     def run(self) -> int | None:
+        if self.args.jobs > 1:
+            return self.run_parallel()
         with self.moncic.session() as session:
             images = session.images
             if not self.args.systems:
@@ -119,6 +389,28 @@ class Update(MoncicCommand):
                 return 6
         return None
 
+    def run_parallel(self) -> int | None:
+        """Update images in parallel subprocesses."""
+        with self.moncic.session() as session:
+            images = session.images
+            if not self.args.systems:
+                systems = images.list_images()
+            else:
+                systems = self.args.systems
+            names = [
+                name for name in systems if images.image(name).bootstrapped
+            ]
+            try:
+                graph = self.build_graph(images, names)
+                graph.check()
+            except ValueError as e:
+                log.critical("cannot update images: %s", e)
+                return 6
+
+        if not self.report(self.run_graph(graph)):
+            return 6
+        return None
+
 
 @main_command
 class Remove(MoncicCommand):
@@ -158,12 +450,117 @@ class Remove(MoncicCommand):
                     bootstrappable_image.remove_config()
 
 
+def find_nspawn_images(session: "Session") -> "NspawnImages":
+    """Return the nspawn image directory of the session."""
+    from moncic.nspawn.images import NspawnImages
+
+    for images in session.images.images:
+        if isinstance(images, NspawnImages):
+            return images
+    raise Fail("export and import need an nspawn image directory")
+
+
+@main_command
+class Export(MoncicCommand):
+    """
+    Export an OS image to a file, to import it in another image directory
+    """
+
+    @override
+    @classmethod
+    def make_subparser(
+        cls, subparsers: "argparse._SubParsersAction[Any]"
+    ) -> argparse.ArgumentParser:
+        parser = super().make_subparser(subparsers)
+        parser.add_argument("name", help="name of the image to export")
+        parser.add_argument("file", help="file to write")
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="export the whole image, even when only the changes since"
+            " the last export could be sent",
+        )
+        return parser
+
+    def run(self) -> None:
+        with self.moncic.session() as session:
+            images = find_nspawn_images(session)
+            with open(self.args.file, "wb") as out:
+                try:
+                    fmt = images.export_image(
+                        self.args.name, out, full=self.args.full
+                    )
+                except KeyError as e:
+                    raise Fail(str(e)) from None
+            log.info("%s: exported as %s", self.args.name, fmt.value)
+
+
+@main_command
+class Import(MoncicCommand):
+    """
+    Import an OS image exported with `monci export`, replacing the image with
+    the same name if it exists
+    """
+
+    @override
+    @classmethod
+    def make_subparser(
+        cls, subparsers: "argparse._SubParsersAction[Any]"
+    ) -> argparse.ArgumentParser:
+        parser = super().make_subparser(subparsers)
+        parser.add_argument("name", help="name of the image to create")
+        parser.add_argument("file", help="file created by monci export")
+        return parser
+
+    def run(self) -> None:
+        with self.moncic.session() as session:
+            images = find_nspawn_images(session)
+            with open(self.args.file, "rb") as src:
+                fmt = images.import_image(self.args.name, src)
+            log.info("%s: imported from %s", self.args.name, fmt.value)
+
+
 @main_command
 class Dedup(MoncicCommand):
     """
     Deduplicate disk usage in image directories
     """
 
+    @override
+    @classmethod
+    def make_subparser(
+        cls, subparsers: "argparse._SubParsersAction[Any]"
+    ) -> argparse.ArgumentParser:
+        parser = super().make_subparser(subparsers)
+        parser.add_argument(
+            "--jobs",
+            "-j",
+            type=int,
+            metavar="N",
+            help="number of files to deduplicate in parallel."
+            " Default: the number of CPUs, up to 8",
+        )
+        parser.add_argument(
+            "--by-content",
+            action="store_true",
+            help="also deduplicate files with the same contents at different"
+            " paths. This needs to read and hash candidate files",
+        )
+        return parser
+
+    def run(self) -> None:
+        with self.moncic.session() as session:
+            session.images.deduplicate(
+                jobs=self.args.jobs, by_content=self.args.by_content
+            )
+
+
+@main_command
+class Gc(MoncicCommand):
+    """
+    Delete removed images and leftovers of interrupted maintenance
+    """
+
     def run(self) -> None:
         with self.moncic.session() as session:
-            session.images.deduplicate()
+            session.images.collect_garbage()
@@ -22,6 +22,7 @@ from moncic.source import Source
 from moncic.source.distro import DistroSource
 from moncic.source.local import LocalSource
 from moncic.utils.argparse import ArgumentParser as ArgumentParserWithSharedArgs
+from moncic.utils.resources import PRIORITY_CLASSES
 
 from .base import Command
 from .utils import SourceTypeAction
@@ -188,6 +189,9 @@ class MoncicCommand(Command):
 
 
 class ImageActionCommand(MoncicCommand):
+    #: Priority class of containers, if not given on the command line
+    default_priority: str | None = None
+
     @override
     @classmethod
     def make_subparser(
@@ -260,6 +264,19 @@ class ImageActionCommand(MoncicCommand):
             help="create a shell as root"
             " (useful if using workdir and still wanting a root shell)",
         )
+        parser.add_argument(
+            "--no-boot",
+            action="store_true",
+            help="run commands without booting the init system of the"
+            " container: it starts faster, but no services are running",
+        )
+        parser.add_argument(
+            "--priority",
+            choices=list(PRIORITY_CLASSES),
+            default=cls.default_priority,
+            help="priority class of the container, setting its share of CPU"
+            " and IO time when the host is busy",
+        )
 
         return parser
 
@@ -292,6 +309,9 @@ class ImageActionCommand(MoncicCommand):
                 )
             elif self.args.user:
                 config.forward_user = UserConfig.from_sudoer()
+            if self.args.no_boot:
+                config.boot = False
+            config.priority = self.args.priority
             if self.args.bind:
                 for entry in self.args.bind:
                     config.binds.append(
@@ -4,7 +4,7 @@ import logging
 import shutil
 import sys
 from collections.abc import Sequence
-from typing import Any, NamedTuple, TextIO, override
+from typing import TYPE_CHECKING, Any, NamedTuple, TextIO, override
 
 try:
     from texttable import Texttable
@@ -15,9 +15,14 @@ except ModuleNotFoundError:
 
 from moncic.distro import DistroFamily
 from moncic.image import RunnableImage
+from moncic.utils.dedup import format_size
+from moncic.utils.usage import DiskUsage
 
 from .moncic import MoncicCommand, main_command
 
+if TYPE_CHECKING:
+    from moncic.session import Session
+
 log = logging.getLogger(__name__)
 
 
@@ -79,39 +84,85 @@ class Images(MoncicCommand):
             action="store_true",
             help="machine readable output in CSV format",
         )
+        parser.add_argument(
+            "--usage",
+            action="store_true",
+            help="also show the disk space referenced by each image, and how"
+            " much of it is exclusive or shared with other images",
+        )
+        parser.add_argument(
+            "--jobs",
+            "-j",
+            type=int,
+            metavar="N",
+            help="number of images to scan in parallel with --usage."
+            " Default: the number of CPUs, up to 8",
+        )
         return parser
 
+    def get_usage(self, session: "Session") -> dict[str, DiskUsage]:
+        """Compute the disk usage of the images that support it."""
+        from moncic.nspawn.images import NspawnImages
+
+        res: dict[str, DiskUsage] = {}
+        for images in session.images.images:
+            if isinstance(images, NspawnImages):
+                for name, usage in images.disk_usage(self.args.jobs).items():
+                    res.setdefault(name, usage)
+        return res
+
     def run(self) -> None:
-        if self.args.csv or not HAVE_TEXTTABLE:
+        csv_output = self.args.csv or not HAVE_TEXTTABLE
+        output: RowOutput
+        if csv_output:
             output = CSVOutput(sys.stdout)
         else:
-            output = TableOutput(
-                sys.stdout,
+            columns = [
                 TextColumn("Name"),
                 TextColumn("Distro"),
                 TextColumn("Boostrapped"),
                 TextColumn("Backend"),
                 TextColumn("Backend ID"),
-            )
+            ]
+            if self.args.usage:
+                columns += [
+                    TextColumn("Referenced", align="r"),
+                    TextColumn("Exclusive", align="r"),
+                    TextColumn("Shared", align="r"),
+                ]
+            output = TableOutput(sys.stdout, *columns)
+
+        def format_usage(size: int) -> str | int:
+            return size if csv_output else format_size(size)
 
         # List configured images
         with self.moncic.session() as session:
             images = session.images
+            usage = self.get_usage(session) if self.args.usage else {}
             for name in images.list_images():
                 image = images.image(name)
+                row: list[Any]
                 if image.bootstrapped:
                     assert isinstance(image, RunnableImage)
-                    output.add_row(
-                        (
-                            image.name,
-                            image.distro,
-                            "yes",
-                            image.image_type,
-                            image.get_backend_id(),
-                        )
-                    )
+                    row = [
+                        image.name,
+                        image.distro,
+                        "yes",
+                        image.image_type,
+                        image.get_backend_id(),
+                    ]
                 else:
-                    output.add_row((image.name, image.distro, "no", "-", "-"))
+                    row = [image.name, image.distro, "no", "-", "-"]
+                if self.args.usage:
+                    if (image_usage := usage.get(name)) is not None:
+                        row += [
+                            format_usage(image_usage.referenced),
+                            format_usage(image_usage.exclusive),
+                            format_usage(image_usage.shared),
+                        ]
+                    else:
+                        row += ["-", "-", "-"]
+                output.add_row(row)
         output.flush()
 
 
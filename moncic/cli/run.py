@@ -16,6 +16,8 @@ class Shell(ImageActionCommand):
     Run a shell in the given container
     """
 
+    default_priority = "interactive"
+
     def run(self) -> int:
         run_config = RunConfig()
         if self.args.root:
@@ -1,3 +1,7 @@
+import unittest
+
+from moncic.cli.maint import Bootstrap, format_duration
+from moncic.cli.moncic import make_argparser
 from moncic.unittest import CLITestCase
 
 
@@ -47,3 +51,46 @@ class CliMaintTests(CLITestCase):
         with self.match_run_log(self.session.run_log) as m:
             m.assertPopFirst("test: remove")
             m.assertEmpty()
+
+    def test_build_graph(self) -> None:
+        self.session.test_write_config("base", {"distro": "rocky8"})
+        self.session.test_write_config("child", {"extends": "base"})
+        self.session.test_write_config("grandchild", {"extends": "child"})
+        self.session.test_write_config("other", {"distro": "rocky9"})
+
+        args = make_argparser().parse_args(
+            ["bootstrap", "--jobs=2", "grandchild", "other"]
+        )
+        cmd = Bootstrap(args)
+        images = self.session.images
+
+        # Missing parents are added to the graph
+        graph = cmd.build_graph(
+            images, ["grandchild", "other"], add_missing_parents=True
+        )
+        self.assertEqual(
+            graph.deps,
+            {
+                "base": set(),
+                "child": {"base"},
+                "grandchild": {"child", "base"},
+                "other": set(),
+            },
+        )
+
+        # Otherwise, only requested images are in the graph
+        graph = cmd.build_graph(images, ["grandchild", "base"])
+        self.assertEqual(graph.deps, {"base": set(), "grandchild": {"base"}})
+
+        child = cmd.child_command("base")
+        self.assertEqual(child[1:3], ["-m", "moncic"])
+        self.assertEqual(child[3:5], ["bootstrap", "--jobs=1"])
+        self.assertEqual(child[-2:], ["--", "base"])
+
+
+class TestFormatDuration(unittest.TestCase):
+    def test_format(self) -> None:
+        self.assertEqual(format_duration(0.4), "0s")
+        self.assertEqual(format_duration(59), "59s")
+        self.assertEqual(format_duration(61), "1m01s")
+        self.assertEqual(format_duration(3723), "1h02m03s")
@@ -1,6 +1,11 @@
 from .binds import BindConfig, BindType
 from .config import ContainerConfig, RunConfig
-from .container import Container, ContainerCannotStart, MaintenanceContainer
+from .container import (
+    Container,
+    ContainerCannotStart,
+    ContainerTimings,
+    MaintenanceContainer,
+)
 
 __all__ = [
     "BindConfig",
@@ -8,6 +13,7 @@ __all__ = [
     "Container",
     "ContainerCannotStart",
     "ContainerConfig",
+    "ContainerTimings",
     "MaintenanceContainer",
     "RunConfig",
 ]
@@ -166,9 +166,7 @@ class BindConfig(abc.ABC):
 
     def _run_script(self, script: Script, container: "Container") -> None:
         """Run the setup/teardown script in the container."""
-        if not script:
-            return
-        container.run_script(script)
+        container.queue_script(script)
 
 
 class BindConfigReadonly(BindConfig):
@@ -6,6 +6,7 @@ from pathlib import Path
 from typing import ContextManager, TYPE_CHECKING
 
 from moncic.runner import UserConfig
+from moncic.utils.resources import PRIORITY_CLASSES
 from moncic.utils.script import Script
 
 from .binds import BindConfig, BindType
@@ -27,6 +28,15 @@ class ContainerConfig:
         #:  Cannot be used when ephemeral is False
         self.forward_user: UserConfig | None = None
 
+        #: Set to False to run commands in the container without booting its
+        #: init system. Leave to None to use the image configuration
+        self.boot: bool | None = None
+
+        #: Priority class of the container, from
+        #: moncic.utils.resources.PRIORITY_CLASSES. Leave to None to only use
+        #: configured resource controls
+        self.priority: str | None = None
+
         #: Hooks to run before the contaner is started / after it has stopped
         self.host_setup_hooks: list[
             Callable[["Container"], ContextManager[None]]
@@ -44,17 +54,19 @@ class ContainerConfig:
         @contextlib.contextmanager
         def hook(container: "Container") -> Generator[None, None, None]:
             if setup:
-                container.run_script(setup)
+                container.queue_script(setup)
             try:
                 yield None
             finally:
                 if teardown:
-                    container.run_script(teardown)
+                    container.queue_script(teardown)
 
         self.guest_setup_hooks.append(hook)
 
     def log_debug(self, logger: logging.Logger) -> None:
         logger.debug("container:forward_user = %r", self.forward_user)
+        logger.debug("container:boot = %r", self.boot)
+        logger.debug("container:priority = %r", self.priority)
         for bind in self.binds:
             logger.debug(
                 "container:bind: type=%s host=%s guest=%s cwd=%s",
@@ -102,6 +114,11 @@ class ContainerConfig:
         """
         Raise exceptions if options are used inconsistently
         """
+        if self.priority is not None and self.priority not in PRIORITY_CLASSES:
+            raise ValueError(
+                f"unknown priority class {self.priority!r}: supported are"
+                f" {', '.join(PRIORITY_CLASSES)}"
+            )
 
     def configure_workdir(
         self,
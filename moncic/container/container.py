@@ -4,23 +4,27 @@ import os
 import shlex
 import subprocess
 import tempfile
+import time
 import types
-from collections.abc import Generator, Iterator
+from collections.abc import Generator, Iterator, Mapping, Sequence
 from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass, field
 from functools import cached_property
 from pathlib import Path
-from typing import ContextManager, Self
+from typing import ContextManager, Self, TypeVar
 
 from moncic.image import RunnableImage
-from moncic.runner import UserConfig
+from moncic.runner import Runner, UserConfig
 from moncic.utils import libbanana
-from moncic.utils.script import Script
+from moncic.utils.script import Script, ScriptBatch
 
 from .binds import BindConfig
 from .config import ContainerConfig, RunConfig
 
 log = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
 # PID-specific sequence number used for machine names
 machine_name_sequence_pid: int | None = None
 machine_name_sequence: int = 0
@@ -38,6 +42,55 @@ class ContainerCannotStart(Exception):
     """Exception raised when a container cannot be started."""
 
 
+@dataclass
+class ContainerTimings:
+    """
+    Time spent in each phase of starting and stopping a container.
+
+    Phases with a dotted name, like ``container.nspawn``, are part of the
+    phase named before the dot.
+    """
+
+    #: Seconds spent in each phase of starting the container, in order
+    start: dict[str, float] = field(default_factory=dict)
+    #: Seconds spent in each phase of stopping the container, in order
+    stop: dict[str, float] = field(default_factory=dict)
+
+    @contextmanager
+    def phase(self, name: str) -> Generator[None]:
+        """Time a phase of starting the container."""
+        started = time.monotonic()
+        try:
+            yield None
+        finally:
+            self.start[name] = time.monotonic() - started
+
+    @contextmanager
+    def track(self, name: str, cm: ContextManager[T]) -> Generator[T]:
+        """
+        Enter a context manager, timing its setup as a start phase and its
+        teardown as a stop phase.
+        """
+        started = time.monotonic()
+        stopping: float | None = None
+        try:
+            with cm as value:
+                self.start[name] = time.monotonic() - started
+                try:
+                    yield value
+                finally:
+                    stopping = time.monotonic()
+        finally:
+            if stopping is not None:
+                self.stop[name] = time.monotonic() - stopping
+
+    def format(self, phases: dict[str, float]) -> str:
+        """Format timings for logging."""
+        return ", ".join(
+            f"{name} {duration:.3f}s" for name, duration in phases.items()
+        )
+
+
 class Container(abc.ABC):
     """
     An instance of an Image in execution as a container
@@ -66,6 +119,10 @@ class Container(abc.ABC):
         #: Exchange directory for scripts
         self.scriptdir: Path
         self.guest_scriptdir = Path("/srv/moncic-ci/scripts")
+        #: Time spent starting and stopping the container
+        self.timings = ContainerTimings()
+        #: Batch collecting scripts passed to queue_script
+        self._script_batch: ScriptBatch | None = None
 
     @cached_property
     def instance_name(self) -> str:
@@ -88,8 +145,6 @@ class Container(abc.ABC):
         self, cmd: list[str], check: bool = True, cwd: Path | None = None
     ) -> subprocess.CompletedProcess[bytes]:
         """Run a command in the host system."""
-        from moncic.runner import Runner
-
         runner = Runner(self.logger, cmd, cwd=cwd, check=check)
         return runner.run()
 
@@ -112,28 +167,33 @@ class Container(abc.ABC):
         return instance_name
 
     def __enter__(self) -> Self:
+        timings = self.timings
         # If __enter__ raises an exception, __exit__ is not called.
         # Use an internal ExitStack to cleanup intermediate context managers if
         # an exception is raised
         with ExitStack() as container_stack:
             self.workdir = Path(
                 container_stack.enter_context(
-                    tempfile.TemporaryDirectory(suffix="container-workdir")
+                    timings.track(
+                        "workdir",
+                        tempfile.TemporaryDirectory(suffix="container-workdir"),
+                    )
                 )
             )
             self.scriptdir = self.workdir / "scripts"
             self.scriptdir.mkdir(parents=True, exist_ok=True)
-            container_stack.enter_context(self.config.host_setup(self))
-            container_stack.enter_context(self._container())
-
-            # Do user forwarding if requested
-            if self.config.forward_user:
-                self.forward_user(self.config.forward_user)
-            # We do not need to delete the user if it was created, because we
-            # enforce that forward_user is only used on ephemeral containers
+            container_stack.enter_context(
+                timings.track("host_setup", self.config.host_setup(self))
+            )
+            container_stack.enter_context(
+                timings.track("container", self._container())
+            )
 
-            container_stack.enter_context(self.config.guest_setup(self))
+            container_stack.enter_context(
+                timings.track("guest_setup", self._guest_setup())
+            )
             self.stack.enter_context(container_stack.pop_all())
+        self.logger.debug("started: %s", timings.format(timings.start))
         self.started = True
         return self
 
@@ -146,12 +206,93 @@ class Container(abc.ABC):
         self.started = False
         if self.linger:
             return
-        self.stack.__exit__(exc_type, exc_val, exc_tb)
+        try:
+            self.stack.__exit__(exc_type, exc_val, exc_tb)
+        finally:
+            self.logger.debug(
+                "stopped: %s", self.timings.format(self.timings.stop)
+            )
 
     @abc.abstractmethod
     def _container(self) -> ContextManager[None]:
         """Start the container for the duration of the context manager."""
 
+    @contextmanager
+    def _guest_setup(self) -> Generator[None]:
+        """
+        Perform guest setup and teardown, running each as a single batch of
+        scripts.
+        """
+        teardown = ScriptBatch("Guest teardown", keep_going=True)
+
+        def run_teardown(
+            exc_type: type[BaseException] | None,
+            exc_val: BaseException | None,
+            exc_tb: types.TracebackType | None,
+        ) -> None:
+            try:
+                self._run_batch(teardown)
+            except Exception as e:
+                if exc_val is None:
+                    raise
+                # Do not hide the error that caused the teardown
+                self.logger.error("%s failed: %s", teardown.title, e)
+
+        with ExitStack() as stack:
+            stack.push(run_teardown)
+            with self.script_batch(ScriptBatch("Guest setup")):
+                # Do user forwarding if requested
+                if self.config.forward_user:
+                    with self.timings.phase("forward_user"):
+                        self.forward_user(self.config.forward_user)
+                # We do not need to delete the user if it was created, because
+                # we enforce that forward_user is only used on ephemeral
+                # containers
+                stack.enter_context(self.config.guest_setup(self))
+                # Collect teardown scripts as the stack unwinds, including
+                # when running the setup batch fails
+                stack.callback(setattr, self, "_script_batch", teardown)
+            yield None
+
+    @contextmanager
+    def script_batch(self, batch: ScriptBatch) -> Generator[ScriptBatch]:
+        """
+        Collect scripts passed to queue_script into batch, and run them when
+        the context manager exits without errors.
+        """
+        previous = self._script_batch
+        self._script_batch = batch
+        try:
+            yield batch
+        finally:
+            self._script_batch = previous
+        self._run_batch(batch)
+
+    def _run_batch(self, batch: ScriptBatch) -> None:
+        """Run the scripts collected in a batch."""
+        if self._script_batch is batch:
+            self._script_batch = None
+        self.run_scripts(batch)
+
+    def queue_script(self, script: Script) -> None:
+        """
+        Run a script whose output is not needed.
+
+        If a batch is collecting scripts, the script is added to it, to be run
+        together with the others. Otherwise it is run immediately.
+        """
+        if not script:
+            return
+        if self._script_batch is not None:
+            self._script_batch.add(script)
+        else:
+            self.run_script(script)
+
+    def run_scripts(self, batch: ScriptBatch) -> None:
+        """Run a batch of scripts, merging them where possible."""
+        for script in batch.merged():
+            self.run_script(script)
+
     def forward_user(self, user: UserConfig, allow_maint: bool = False) -> None:
         """
         Ensure the system has a matching user and group
@@ -227,13 +368,15 @@ class Container(abc.ABC):
                     user.user_name,
                 ],
             )
-        if setup_script:
-            self.run_script(setup_script)
+        self.queue_script(setup_script)
 
-        script = Script("Validate user database", cwd=Path("/"), user=user)
-        with script.if_("[ $(id -u) -eq 0 ] && [ $(id -g) -eq 0 ]"):
-            script.run(["exit", "0"])
+        if user.user_id == 0 and user.group_id == 0:
+            return
 
+        # Run as root, so that it can be batched with the other setup scripts
+        script = Script(
+            "Validate user database", cwd=Path("/"), user=UserConfig.root()
+        )
         script.run_unquoted(f'UNAME="$(id -un {user.user_id})"')
         with script.if_(f'[ "$UNAME" != {shlex.quote(user.user_name)} ]'):
             script.fail(
@@ -248,7 +391,7 @@ class Container(abc.ABC):
                 f"group {user.group_id} in container is named $GNAME but outside it is named {user.group_name}"
             )
 
-        self.run_script(script)
+        self.queue_script(script)
 
     @abc.abstractmethod
     def get_root(self) -> Path:
@@ -281,6 +424,69 @@ class Container(abc.ABC):
         stdout and stderr are logged in real time as the process is running.
         """
 
+    @abc.abstractmethod
+    def get_run_command(
+        self, command: list[str], config: RunConfig
+    ) -> list[str]:
+        """
+        Return the command line to run in the host to run the given command
+        inside the running system.
+
+        Default working directory and user are expected to have already been
+        filled in config.
+        """
+
+    def _run_runners(
+        self, runners: Sequence[Runner]
+    ) -> list[subprocess.CompletedProcess[bytes]]:
+        """Run host commands returned by get_run_command, concurrently."""
+        return Runner.run_many(runners)
+
+    def run_many(
+        self, commands: Mapping[str, list[str]], config: RunConfig | None = None
+    ) -> dict[str, subprocess.CompletedProcess[bytes]]:
+        """
+        Run several commands inside the running system at the same time.
+
+        :param commands: commands to run, indexed by a label used to tell
+          apart their output in logs
+        :returns: the result of each command, indexed by its label
+        :raises subprocess.CalledProcessError: if config.check is set, for
+          the first command in order that failed, after all commands have
+          finished
+        """
+        if config is None:
+            config = RunConfig()
+        if config.interactive:
+            raise ValueError("interactive commands cannot be run concurrently")
+        if config.cwd is None:
+            config.cwd = self.config.get_default_cwd()
+        if config.user is None:
+            config.user = self.config.get_default_user()
+
+        runners = [
+            Runner(
+                self.logger,
+                self.get_run_command(command, config),
+                check=False,
+                label=label,
+            )
+            for label, command in commands.items()
+        ]
+        results = dict(zip(commands.keys(), self._run_runners(runners)))
+        if config.check:
+            for label, res in results.items():
+                if res.returncode != 0:
+                    self.logger.error(
+                        "%s: exited with status %d", label, res.returncode
+                    )
+                    e = subprocess.CalledProcessError(
+                        res.returncode, commands[label], res.stdout, res.stderr
+                    )
+                    e.add_note(f"Command: {label!r}")
+                    raise e
+        return results
+
     @contextmanager
     def script_in_guest(self, script: Script) -> Generator[Path, None, None]:
         """Send the script to the container, returning its guest path."""
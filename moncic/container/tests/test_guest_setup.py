@@ -0,0 +1,98 @@
+import subprocess
+from typing import override
+
+from moncic.container import ContainerConfig
+from moncic.distro import DistroFamily
+from moncic.mock.container import MockContainer
+from moncic.mock.image import MockRunnableImage
+from moncic.mock.images import MockImages
+from moncic.mock.session import MockSession
+from moncic.unittest import MockMoncicTestCase
+from moncic.utils.script import Script, ScriptBatch
+
+
+class BatchContainer(MockContainer):
+    """Container recording the batches of scripts it runs."""
+
+    def __init__(
+        self, image: MockRunnableImage, *, config: ContainerConfig
+    ) -> None:
+        super().__init__(image, config=config)
+        self.batches: list[tuple[str, list[str], bool]] = []
+
+    @override
+    def run_scripts(self, batch: ScriptBatch) -> None:
+        titles = [script.title for script in batch.scripts]
+        self.batches.append((batch.title, titles, batch.keep_going))
+        if any(title.startswith("fail") for title in titles):
+            raise subprocess.CalledProcessError(1, [batch.title])
+
+    @override
+    def run_script(
+        self, script: Script, check: bool = True
+    ) -> subprocess.CompletedProcess[bytes]:
+        self.batches.append((script.title, [], False))
+        return super().run_script(script, check)
+
+
+class TestGuestSetup(MockMoncicTestCase):
+    @override
+    def setUp(self) -> None:
+        super().setUp()
+        self.session = self.enterContext(MockSession(self.moncic))
+        self.image = MockRunnableImage(
+            images=MockImages(self.session),
+            name="test",
+            distro=DistroFamily.lookup_distro("fedora:44"),
+        )
+
+    def add_step(self, config: ContainerConfig, name: str) -> None:
+        setup = Script(f"{name} setup")
+        setup.run(["true"])
+        teardown = Script(f"{name} teardown")
+        teardown.run(["true"])
+        config.add_guest_scripts(setup=setup, teardown=teardown)
+
+    def test_batches(self) -> None:
+        config = ContainerConfig()
+        self.add_step(config, "first")
+        self.add_step(config, "second")
+        container = BatchContainer(self.image, config=config)
+        with container._guest_setup():
+            self.assertEqual(
+                container.batches,
+                [("Guest setup", ["first setup", "second setup"], False)],
+            )
+        self.assertEqual(
+            container.batches[1],
+            ("Guest teardown", ["second teardown", "first teardown"], True),
+        )
+
+    def test_failed_setup(self) -> None:
+        config = ContainerConfig()
+        self.add_step(config, "first")
+        self.add_step(config, "fail")
+        container = BatchContainer(self.image, config=config)
+        with self.assertLogs(container.logger) as logs:
+            with self.assertRaises(subprocess.CalledProcessError) as e:
+                with container._guest_setup():
+                    self.fail("guest setup did not fail")
+        # The original error is raised, not the one from teardown
+        self.assertEqual(e.exception.cmd, ["Guest setup"])
+        # Teardown scripts go through the teardown batch, which does not stop
+        # at failing steps
+        self.assertEqual(
+            container.batches,
+            [
+                ("Guest setup", ["first setup", "fail setup"], False),
+                ("Guest teardown", ["fail teardown", "first teardown"], True),
+            ],
+        )
+        self.assertEqual(
+            logs.output,
+            [
+                f"ERROR:{container.logger.name}:Guest teardown failed:"
+                " Command '['Guest teardown']' returned non-zero exit"
+                " status 1."
+            ],
+        )
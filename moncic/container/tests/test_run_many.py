@@ -0,0 +1,97 @@
+import subprocess
+import tempfile
+from pathlib import Path
+from typing import override
+
+from moncic.container import Container, ContainerConfig, RunConfig
+from moncic.distro import DistroFamily
+from moncic.mock.container import MockContainer
+from moncic.mock.image import MockRunnableImage
+from moncic.mock.images import MockImages
+from moncic.mock.session import MockSession
+from moncic.unittest import MockMoncicTestCase
+
+
+class HostContainer(MockContainer):
+    """Container running commands in the host."""
+
+    @override
+    def get_run_command(
+        self, command: list[str], config: RunConfig
+    ) -> list[str]:
+        return command
+
+    run_many = Container.run_many
+
+
+class TestRunMany(MockMoncicTestCase):
+    @override
+    def setUp(self) -> None:
+        super().setUp()
+        self.session = self.enterContext(MockSession(self.moncic))
+        image = MockRunnableImage(
+            images=MockImages(self.session),
+            name="test",
+            distro=DistroFamily.lookup_distro("fedora:44"),
+        )
+        self.container = HostContainer(image, config=ContainerConfig())
+        self.workdir = Path(self.enterContext(tempfile.TemporaryDirectory()))
+
+    def test_concurrent(self) -> None:
+        # Writing to a fifo blocks until it is opened for reading
+        fifo = self.workdir / "fifo"
+        subprocess.run(["mkfifo", fifo.as_posix()], check=True)
+        with self.assertLogs(self.container.logger) as logs:
+            results = self.container.run_many(
+                {
+                    "writer": [
+                        "timeout",
+                        "10",
+                        "sh",
+                        "-c",
+                        f"echo test > {fifo}",
+                    ],
+                    "reader": ["timeout", "10", "cat", fifo.as_posix()],
+                }
+            )
+        self.assertEqual(list(results), ["writer", "reader"])
+        self.assertEqual(results["writer"].returncode, 0)
+        self.assertEqual(results["reader"].returncode, 0)
+        self.assertEqual(results["reader"].stdout, b"test\n")
+        self.assertIn(
+            f"INFO:{self.container.logger.name}:reader: stdout: test",
+            logs.output,
+        )
+
+    def test_results(self) -> None:
+        config = RunConfig(check=False)
+        results = self.container.run_many(
+            {
+                "ok": ["true"],
+                "fail": ["sh", "-c", "echo error >&2; exit 3"],
+            },
+            config,
+        )
+        self.assertEqual(results["ok"].returncode, 0)
+        self.assertEqual(results["fail"].returncode, 3)
+        self.assertEqual(results["fail"].stderr, b"error\n")
+
+    def test_check(self) -> None:
+        done = self.workdir / "done"
+        with self.assertRaises(subprocess.CalledProcessError) as e:
+            self.container.run_many(
+                {
+                    "fail": ["false"],
+                    "slow": ["sh", "-c", f"sleep 0.1; touch {done}"],
+                }
+            )
+        self.assertEqual(e.exception.cmd, ["false"])
+        self.assertEqual(e.exception.__notes__, ["Command: 'fail'"])
+        # Other commands are run to completion
+        self.assertTrue(done.exists())
+
+    def test_interactive(self) -> None:
+        with self.assertRaises(ValueError):
+            self.container.run_many(
+                {"shell": ["sh"]}, RunConfig(interactive=True)
+            )
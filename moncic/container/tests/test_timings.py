@@ -0,0 +1,57 @@
+import contextlib
+import unittest
+from collections.abc import Generator
+
+from moncic.container import ContainerTimings
+
+
+class TestContainerTimings(unittest.TestCase):
+    def test_track(self) -> None:
+        events: list[str] = []
+
+        @contextlib.contextmanager
+        def step(name: str) -> Generator[str]:
+            events.append(f"setup {name}")
+            yield name
+            events.append(f"teardown {name}")
+
+        timings = ContainerTimings()
+        with timings.track("first", step("first")) as value:
+            self.assertEqual(value, "first")
+            with timings.track("second", step("second")):
+                with timings.phase("third"):
+                    pass
+            self.assertEqual(list(timings.stop), ["second"])
+
+        self.assertEqual(list(timings.start), ["first", "second", "third"])
+        self.assertEqual(list(timings.stop), ["second", "first"])
+        self.assertEqual(
+            events,
+            [
+                "setup first",
+                "setup second",
+                "teardown second",
+                "teardown first",
+            ],
+        )
+        for duration in (*timings.start.values(), *timings.stop.values()):
+            self.assertGreaterEqual(duration, 0)
+
+    def test_failed_setup(self) -> None:
+        @contextlib.contextmanager
+        def failing() -> Generator[None]:
+            raise RuntimeError("test")
+            yield None
+
+        timings = ContainerTimings()
+        with self.assertRaises(RuntimeError):
+            with timings.track("failing", failing()):
+                pass
+        self.assertEqual(timings.start, {})
+        self.assertEqual(timings.stop, {})
+
+    def test_format(self) -> None:
+        timings = ContainerTimings(start={"workdir": 0.0012, "container": 2.5})
+        self.assertEqual(
+            timings.format(timings.start), "workdir 0.001s, container 2.500s"
+        )
@@ -46,8 +46,23 @@ class ImagesBase(abc.ABC):
         """Return the named Image."""
 
     @abc.abstractmethod
-    def deduplicate(self) -> None:
-        """Deduplicate storage of common files (if supported)."""
+    def deduplicate(
+        self, *, jobs: int | None = None, by_content: bool = False
+    ) -> None:
+        """
+        Deduplicate storage of common files (if supported).
+
+        :param jobs: number of parallel jobs to use, or None for a default
+        :param by_content: also deduplicate files with the same contents,
+          regardless of their path
+        """
+
+    @abc.abstractmethod
+    def collect_garbage(self) -> None:
+        """
+        Delete discarded images and leftovers of interrupted maintenance (if
+        supported).
+        """
 
     def host_run(
         self, cmd: list[str], check: bool = True, cwd: Path | None = None
@@ -67,7 +82,13 @@ class Images(ImagesBase, abc.ABC):
         pass
 
     @override
-    def deduplicate(self) -> None:
+    def deduplicate(
+        self, *, jobs: int | None = None, by_content: bool = False
+    ) -> None:
+        pass  # do nothing by default
+
+    @override
+    def collect_garbage(self) -> None:
         pass  # do nothing by default
 
 
@@ -180,7 +201,18 @@ class ImageRepository(ImagesBase):
         return result
 
     @override
-    def deduplicate(self) -> None:
+    def deduplicate(
+        self, *, jobs: int | None = None, by_content: bool = False
+    ) -> None:
         """Deduplicate storage of common files (if supported)."""
         for images in self.images:
-            images.deduplicate()
+            images.deduplicate(jobs=jobs, by_content=by_content)
+
+    @override
+    def collect_garbage(self) -> None:
+        """
+        Delete discarded images and leftovers of interrupted maintenance (if
+        supported).
+        """
+        for images in self.images:
+            images.collect_garbage()
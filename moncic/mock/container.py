@@ -1,5 +1,5 @@
 import subprocess
-from collections.abc import Generator, Iterator
+from collections.abc import Generator, Iterator, Mapping
 from contextlib import contextmanager
 from pathlib import Path
 from subprocess import CompletedProcess
@@ -8,7 +8,7 @@ from typing import override
 from moncic.container import Container, MaintenanceContainer, RunConfig
 from moncic.container.binds import BindConfig
 from moncic.runner import UserConfig
-from moncic.utils.script import Script
+from moncic.utils.script import Script, ScriptBatch
 
 from .image import MockRunnableImage
 
@@ -60,6 +60,21 @@ class MockContainer(Container):
         # return self.image.images.session.get_process_result(args=command)
         return CompletedProcess(command, 0, b"", b"")
 
+    @override
+    def get_run_command(
+        self, command: list[str], config: RunConfig
+    ) -> list[str]:
+        return command
+
+    @override
+    def run_many(
+        self, commands: Mapping[str, list[str]], config: RunConfig | None = None
+    ) -> dict[str, subprocess.CompletedProcess[bytes]]:
+        return {
+            label: self.run(command, config)
+            for label, command in commands.items()
+        }
+
     @override
     def run_script(
         self, script: Script, check: bool = True
@@ -67,6 +82,12 @@ class MockContainer(Container):
         self.image.session.run_log.append_script(script)
         return CompletedProcess(["script"], 0, b"", b"")
 
+    @override
+    def run_scripts(self, batch: ScriptBatch) -> None:
+        # Log scripts one by one, to allow tests to check them individually
+        for script in batch.scripts:
+            self.run_script(script)
+
     @override
     def forward_user(self, user: UserConfig, allow_maint: bool = False) -> None:
         self.image.session.run_log.append_forward_user(user)
@@ -14,6 +14,7 @@ from moncic.provision.config import write_yaml
 from moncic.runner import UserConfig
 from moncic.session import Session
 from moncic.utils.deb import DebCache
+from moncic.utils.machined import Machined
 from moncic.utils.script import Script
 
 if TYPE_CHECKING:
@@ -173,6 +174,10 @@ class MockSession(Session):
     def _make_podman(self) -> "_podman.PodmanClient":
         raise NotImplementedError()
 
+    @override
+    def _make_machined(self) -> Machined | None:
+        return None
+
     @override
     def _make_debcache(self, path: Path) -> DebCache:
         raise NotImplementedError()
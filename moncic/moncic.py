@@ -10,6 +10,7 @@ import yaml
 from .context import privs
 from .session import RealSession, Session
 from .utils.privs import ProcessPrivs
+from .utils.resources import load_resources
 
 log = logging.getLogger(__name__)
 
@@ -51,6 +52,35 @@ class MoncicConfig:
         # Use a tmpfs overlay for ephemeral containers instead of btrfs
         # snapshots
         self.tmpfs: bool = False
+        # Number of writable snapshots of each btrfs image to keep ready for
+        # ephemeral containers
+        self.snapshot_pool: int = 0
+        # Maximum age in days of cached root filesystems of freshly
+        # bootstrapped distributions. 0 disables the cache
+        self.bootstrap_cache_max_age: int = 30
+        # Store images extending other images on non-btrfs storage as overlayfs
+        # layers on top of their parent
+        self.plain_layers: bool = False
+        # Seconds to wait for a container to shut down before killing it.
+        # 0 waits forever
+        self.shutdown_timeout: int = 120
+        # Kill ephemeral containers instead of shutting them down cleanly,
+        # once teardown scripts have run
+        self.fast_teardown: bool = False
+        # Run commands in nspawn containers through an agent started in the
+        # guest, instead of a new systemd-run unit for each
+        self.guest_agent: bool = False
+        # Number of booted ephemeral nspawn containers of each image to keep
+        # ready during a session
+        self.warm_pool: int = 0
+        # Maximum number of booted containers kept ready in a session
+        self.warm_pool_max: int = 4
+        # Do not boot containers in advance if the host has less than this
+        # amount of available memory, in MiB
+        self.warm_pool_min_memory: int = 2048
+        # Resource controls applied to nspawn containers, as a mapping of
+        # settings from moncic.utils.resources.RESOURCE_CONTROLS to values
+        self.resources: dict[str, str] = {}
         # Directory where .deb files are cached between invocations
         self.deb_cache_dir: Path | None = expand_path("~/.cache/moncic-ci/debs")
         # Directory where extra packages, if present, are added to package
@@ -66,6 +96,16 @@ class MoncicConfig:
             "compression": self.compression,
             "auto_sudo": self.auto_sudo,
             "tmpfs": self.tmpfs,
+            "snapshot_pool": self.snapshot_pool,
+            "bootstrap_cache_max_age": self.bootstrap_cache_max_age,
+            "plain_layers": self.plain_layers,
+            "shutdown_timeout": self.shutdown_timeout,
+            "fast_teardown": self.fast_teardown,
+            "guest_agent": self.guest_agent,
+            "warm_pool": self.warm_pool,
+            "warm_pool_max": self.warm_pool_max,
+            "warm_pool_min_memory": self.warm_pool_min_memory,
+            "resources": self.resources,
             "deb_cache_dir": self.deb_cache_dir,
             "extra_packages_dir": self.extra_packages_dir,
             "build_artifacts_dir": self.build_artifacts_dir,
@@ -157,6 +197,22 @@ class MoncicConfig:
             res.compression = compression
         res.auto_sudo = conf.pop("auto_sudo", res.auto_sudo)
         res.tmpfs = conf.pop("tmpfs", res.tmpfs)
+        res.snapshot_pool = conf.pop("snapshot_pool", res.snapshot_pool)
+        res.bootstrap_cache_max_age = conf.pop(
+            "bootstrap_cache_max_age", res.bootstrap_cache_max_age
+        )
+        res.plain_layers = conf.pop("plain_layers", res.plain_layers)
+        res.shutdown_timeout = conf.pop(
+            "shutdown_timeout", res.shutdown_timeout
+        )
+        res.fast_teardown = conf.pop("fast_teardown", res.fast_teardown)
+        res.guest_agent = conf.pop("guest_agent", res.guest_agent)
+        res.warm_pool = conf.pop("warm_pool", res.warm_pool)
+        res.warm_pool_max = conf.pop("warm_pool_max", res.warm_pool_max)
+        res.warm_pool_min_memory = conf.pop(
+            "warm_pool_min_memory", res.warm_pool_min_memory
+        )
+        res.resources = load_resources(conf.pop("resources", None))
         if deb_cache_dir := conf.pop("deb_cache_dir", None):
             res.deb_cache_dir = expand_path(deb_cache_dir)
         if extra_packages_dir := conf.pop("extra_packages_dir", None):
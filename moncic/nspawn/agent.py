@@ -0,0 +1,108 @@
+"""
+Client for the command agent running inside nspawn containers
+"""
+
+import json
+import logging
+import shlex
+import socket
+import subprocess
+from pathlib import Path
+
+from moncic.runner import UserConfig
+
+from . import guest_agent
+
+#: Source of the agent script, copied into containers
+AGENT_SOURCE = Path(guest_agent.__file__)
+
+
+class GuestAgent:
+    """
+    Run commands in a container through the agent listening on a unix socket.
+    """
+
+    def __init__(self, logger: logging.Logger, path: Path) -> None:
+        self.logger = logger
+        #: Host path of the agent socket
+        self.path = path
+
+    def _recv(self, sock: socket.socket, size: int) -> bytes:
+        """Receive exactly size bytes."""
+        chunks: list[bytes] = []
+        while size > 0:
+            chunk = sock.recv(size)
+            if not chunk:
+                raise ConnectionError("connection to guest agent closed")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def _log_lines(self, name: str, pending: bytes, final: bool) -> bytes:
+        """Log complete lines of output, returning the incomplete rest."""
+        lines = pending.split(b"\n")
+        rest = b"" if final else lines.pop()
+        for line in lines:
+            if line or not final:
+                self.logger.info(
+                    "%s: %s", name, line.decode(errors="replace").rstrip()
+                )
+        return rest
+
+    def run(
+        self,
+        command: list[str],
+        *,
+        cwd: Path | None = None,
+        user: UserConfig | None = None,
+        check: bool = True,
+    ) -> subprocess.CompletedProcess[bytes]:
+        """
+        Run a command in the container, logging its output as it arrives.
+
+        This needs permission to access the socket created by the agent.
+
+        :param cwd: working directory, defaulting to ``/`` as for systemd
+          services
+        :param user: user running the command, defaulting to root
+        """
+        if cwd is None:
+            cwd = Path("/")
+        if user is None:
+            user = UserConfig.root()
+        self.logger.info("Running %s", shlex.join(command))
+        request = {
+            "argv": command,
+            "cwd": cwd.as_posix(),
+            "uid": user.user_id,
+            "gid": user.group_id,
+        }
+        stdout: list[bytes] = []
+        stderr: list[bytes] = []
+        pending = {guest_agent.STDOUT: b"", guest_agent.STDERR: b""}
+        names = {guest_agent.STDOUT: "stdout", guest_agent.STDERR: "stderr"}
+        outputs = {guest_agent.STDOUT: stdout, guest_agent.STDERR: stderr}
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.path.as_posix())
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            while True:
+                kind, size = guest_agent.HEADER.unpack(
+                    self._recv(sock, guest_agent.HEADER.size)
+                )
+                data = self._recv(sock, size)
+                if kind == guest_agent.EXIT:
+                    returncode = int(data)
+                    break
+                outputs[kind].append(data)
+                pending[kind] = self._log_lines(
+                    names[kind], pending[kind] + data, final=False
+                )
+        for kind, rest in pending.items():
+            self._log_lines(names[kind], rest, final=True)
+
+        res = subprocess.CompletedProcess(
+            command, returncode, b"".join(stdout), b"".join(stderr)
+        )
+        if check:
+            res.check_returncode()
+        return res
@@ -1,13 +1,13 @@
-import errno
 import os
 import shlex
+import shutil
 import signal
 import subprocess
 import time
-from collections.abc import Generator, Iterator
+from collections.abc import Generator, Iterator, Sequence
 from contextlib import contextmanager
 from pathlib import Path
-from typing import TypeVar, override
+from typing import Self, TypeVar, override
 
 from moncic import context
 from moncic.container import (
@@ -18,14 +18,131 @@ from moncic.container import (
     MaintenanceContainer,
     RunConfig,
 )
-from moncic.runner import Runner
+from moncic.runner import Runner, UserConfig
+from moncic.utils.machined import unit_properties
 from moncic.utils.nspawn import escape_bind_ro
+from moncic.utils.process import ProcessHandle, process_cgroup
+from moncic.utils.resources import PRIORITY_CLASSES, resource_unit_config
 from moncic.utils.script import Script
 
+from .agent import AGENT_SOURCE, GuestAgent
 from .image import NspawnImage
+from .warm import WarmContainer
 
 Result = TypeVar("Result")
 
+#: Seconds to wait for the guest agent to start listening
+AGENT_START_TIMEOUT = 10
+
+#: Unit configuration for running systemd-nspawn, as in
+#: systemd-nspawn@.service
+NSPAWN_UNIT_CONFIG = [
+    "KillMode=mixed",
+    "Type=notify",
+    "RestartForceExitStatus=133",
+    "SuccessExitStatus=133",
+    "Slice=machine.slice",
+    "Delegate=yes",
+    "TasksMax=16384",
+    "WatchdogSec=3min",
+]
+
+#: Command keeping containers alive when they are not booted
+KEEPALIVE_COMMAND = ["/bin/sh", "-c", "while :; do sleep 3600; done"]
+
+#: PATH for commands run in containers that are not booted
+GUEST_PATH = "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
+
+#: Shell script setting up the user environment and working directory for
+#: commands run in containers that are not booted, given the working
+#: directory and the command as arguments
+NSENTER_WRAPPER = """
+HOME=$(getent passwd "$(id -u)" | cut -d: -f6)
+USER=$(id -un 2>/dev/null)
+LOGNAME=$USER
+export HOME="${HOME:-/}" USER LOGNAME
+cd "$1" && shift && exec "$@"
+"""
+
+#: Shell script moving itself to the cgroup whose cgroup.procs file is given
+#: as first argument, before running the rest of the command line
+CGROUP_WRAPPER = 'echo $$ > "$1" && shift && exec "$@"'
+
+#: Extra unit configuration for units started with a fixed name, which need to
+#: be garbage collected even if they fail
+DBUS_UNIT_CONFIG = [
+    "CollectMode=inactive-or-failed",
+]
+
+
+def systemd_run_nspawn_command(
+    cmd: list[str], unit_config: list[str], unit: str | None = None
+) -> list[str]:
+    """
+    Return the systemd-run command line to run systemd-nspawn in its own
+    unit, configured with the given properties.
+
+    :param unit: name of the unit, defaulting to one chosen by systemd-run
+    """
+    systemd_run_cmd = ["systemd-run"]
+    if unit is not None:
+        systemd_run_cmd.append(f"--unit={unit}")
+    for c in unit_config:
+        systemd_run_cmd.append(f"--property={c}")
+    systemd_run_cmd.extend(cmd)
+    return systemd_run_cmd
+
+
+def nsenter_command(
+    pid: int,
+    command: list[str],
+    *,
+    cwd: Path | None = None,
+    user: UserConfig | None = None,
+    cgroup: Path | None = None,
+) -> list[str]:
+    """
+    Return the nsenter command line to run a command in the namespaces and
+    root directory of the given process.
+
+    :param cwd: working directory, defaulting to ``/``
+    :param user: user running the command, defaulting to root
+    :param cgroup: cgroup directory to run the command in, so that it is
+      accounted and limited together with the container
+    """
+    cmd: list[str] = []
+    if cgroup is not None:
+        cmd += [
+            "/bin/sh",
+            "-c",
+            CGROUP_WRAPPER,
+            "moncic-ci",
+            (cgroup / "cgroup.procs").as_posix(),
+        ]
+    cmd += [
+        "nsenter",
+        f"--target={pid}",
+        "--mount",
+        "--uts",
+        "--ipc",
+        "--net",
+        "--pid",
+        "--root",
+    ]
+    if user is not None:
+        cmd += [f"--setuid={user.user_id}", f"--setgid={user.group_id}"]
+    cmd += [
+        "/usr/bin/env",
+        "-i",
+        f"PATH={GUEST_PATH}",
+        "/bin/sh",
+        "-c",
+        NSENTER_WRAPPER,
+        "moncic-ci",
+        (cwd or Path("/")).as_posix(),
+    ]
+    return cmd + command
+
 
 class NspawnContainer(Container):
     """
@@ -40,10 +157,50 @@ class NspawnContainer(Container):
         *,
         config: ContainerConfig,
         instance_name: str | None = None,
+        use_warm_pool: bool = True,
     ) -> None:
         super().__init__(image, config=config, instance_name=instance_name)
+        #: Container booted in advance, whose machine is used instead of
+        #: starting a new one
+        self.warm: WarmContainer | None = None
+        if instance_name is None and use_warm_pool:
+            # The machine name of a warm container was chosen when booting it,
+            # so it needs to be claimed before the name is used
+            self.warm = self._claim_warm()
+            if self.warm is not None:
+                self._instance_name = self.warm.name
         # machinectl properties of the running machine
         self.properties: dict[str, str] = {}
+        #: Ready snapshot of the image claimed from the snapshot pool, used
+        #: instead of an ephemeral snapshot
+        self.pool_snapshot: Path | None = None
+        #: Command agent running in the container, if started
+        self.agent: GuestAgent | None = None
+        #: Path of the agent directory in the guest
+        self.guest_agentdir = Path("/srv/moncic-ci/agent")
+
+    def _claim_warm(self) -> WarmContainer | None:
+        """Claim a booted container from the warm pool, if one can be used."""
+        if not self.ephemeral or not self._use_boot():
+            return None
+        warm_pool = self.image.images.warm_pool(self.image)
+        if warm_pool is None:
+            return None
+        with self.timings.phase("container.warm_claim"):
+            warm = warm_pool.claim()
+        # Start booting replacements while this container is in use
+        warm_pool.refill()
+        return warm
+
+    @override
+    def __enter__(self) -> Self:
+        try:
+            return super().__enter__()
+        except BaseException:
+            if self.warm is not None:
+                self.warm.discard()
+                self.warm = None
+            raise
 
     @override
     def get_root(self) -> Path:
@@ -72,28 +229,41 @@ class NspawnContainer(Container):
                     " kernel commandline"
                 )
 
+    def _priority_resources(self) -> dict[str, str]:
+        """Return the resource controls of the container priority class."""
+        if self.config.priority is None:
+            return {}
+        return PRIORITY_CLASSES[self.config.priority]
+
+    def unit_config(self) -> list[str]:
+        """
+        Return the properties of the unit running systemd-nspawn, including
+        resource controls from the global configuration, the image
+        configuration and the priority class, in increasing order of
+        precedence.
+        """
+        resources = [self.image.images.session.moncic.config.resources]
+        if image_resources := self.image.get_container_info().resources:
+            resources.append(image_resources)
+        resources.append(self._priority_resources())
+        return NSPAWN_UNIT_CONFIG + resource_unit_config(*resources)
+
     def _run_nspawn(self, cmd: list[str]) -> None:
         """
         Run the given systemd-nspawn command line, contained into its own unit
-        using systemd-run
+        started via D-Bus if possible, or using systemd-run
         """
-        unit_config = [
-            "KillMode=mixed",
-            "Type=notify",
-            "RestartForceExitStatus=133",
-            "SuccessExitStatus=133",
-            "Slice=machine.slice",
-            "Delegate=yes",
-            "TasksMax=16384",
-            "WatchdogSec=3min",
-        ]
-
-        systemd_run_cmd = ["systemd-run"]
-        for c in unit_config:
-            systemd_run_cmd.append(f"--property={c}")
-
-        systemd_run_cmd.extend(cmd)
+        if (machined := self.image.images.session.machined) is not None:
+            unit = f"moncic-ci-{self.instance_name}.service"
+            self.image.logger.info("Running %s as %s", shlex.join(cmd), unit)
+            machined.start_transient_unit(
+                unit,
+                cmd,
+                unit_properties(self.unit_config() + DBUS_UNIT_CONFIG),
+            )
+            return
 
+        systemd_run_cmd = systemd_run_nspawn_command(cmd, self.unit_config())
         self.image.logger.info("Running %s", shlex.join(systemd_run_cmd))
         with context.privs.root():
             res = subprocess.run(systemd_run_cmd, capture_output=True)
@@ -106,14 +276,64 @@ class NspawnContainer(Container):
             )
             raise RuntimeError("Failed to start container")
 
+    def _read_properties(self) -> dict[str, str]:
+        """Read the machined properties of the running machine."""
+        if (machined := self.image.images.session.machined) is not None:
+            return machined.machine_properties(self.instance_name)
+        res = subprocess.run(
+            ["machinectl", "show", self.instance_name],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        properties: dict[str, str] = {}
+        for line in res.stdout.splitlines():
+            key, value = line.split("=", 1)
+            properties[key] = value
+        return properties
+
+    def _use_tmpfs(self) -> bool:
+        """Check if ephemeral containers should use a tmpfs overlay."""
+        container_info = self.image.get_container_info()
+        if container_info.tmpfs is not None:
+            return container_info.tmpfs
+        return self.image.images.session.moncic.config.tmpfs
+
+    def _use_fast_teardown(self) -> bool:
+        """Check if the container should be killed instead of shut down."""
+        if not self.ephemeral:
+            return False
+        container_info = self.image.get_container_info()
+        if container_info.fast_teardown is not None:
+            return container_info.fast_teardown
+        return self.image.images.session.moncic.config.fast_teardown
+
+    def _use_boot(self) -> bool:
+        """Check if the container should boot its init system."""
+        if not self.ephemeral:
+            return True
+        if self.config.boot is not None:
+            return self.config.boot
+        container_info = self.image.get_container_info()
+        if container_info.boot is not None:
+            return container_info.boot
+        return True
+
     def get_start_command(self, path: Path) -> list[str]:
+        boot = self._use_boot()
         cmd = [
             "systemd-nspawn",
             "--quiet",
             f"--directory={path}",
             f"--machine={self.instance_name}",
-            "--boot",
-            "--notify-ready=yes",
+        ]
+        if boot:
+            cmd += ["--boot", "--notify-ready=yes"]
+        else:
+            # Commands are run with nsenter, next to a process that keeps the
+            # container alive
+            cmd.append("--as-pid2")
+        cmd += [
             "--resolv-conf=replace-host",
             "--timezone=copy",
         ]
@@ -121,16 +341,15 @@ class NspawnContainer(Container):
             f"--bind-ro={escape_bind_ro(self.scriptdir)}:"
             f"{escape_bind_ro(self.guest_scriptdir)}"
         )
+        if self.image.images.session.moncic.config.guest_agent:
+            cmd.append(
+                f"--bind={escape_bind_ro(self.agentdir)}:"
+                f"{escape_bind_ro(self.guest_agentdir)}"
+            )
         for bind_config in self.config.binds:
             cmd.append(bind_config.to_nspawn())
-        if self.ephemeral:
-            container_info = self.image.get_container_info()
-            if container_info.tmpfs is not None:
-                tmpfs = container_info.tmpfs
-            else:
-                tmpfs = self.image.images.session.moncic.config.tmpfs
-
-            if tmpfs:
+        if self.ephemeral and self.pool_snapshot is None:
+            if self._use_tmpfs():
                 cmd.append("--volatile=overlay")
                 # See https://github.com/Truelite/nspawn-runner/issues/10
                 # According to systemd-nspawn(1), --read-only is implied if
@@ -145,6 +364,9 @@ class NspawnContainer(Container):
             and not self.image.distro.disable_nspawn_suppress_sync
         ):
             cmd.append("--suppress-sync=yes")
+        if not boot:
+            cmd += KEEPALIVE_COMMAND
+            return cmd
         cmd.append(f"systemd.hostname={self.instance_name}")
         for name in self.image.distro.get_systemd_boot_mask_units():
             cmd.append(f"systemd.mask={name}")
@@ -154,8 +376,109 @@ class NspawnContainer(Container):
     @contextmanager
     def _container(self) -> Generator[None, None, None]:
         self._check_host_system()
-        with self._container_in_path(self.image.path):
+        if self.warm is not None:
+            warm, self.warm = self.warm, None
+            with self._warm_container(warm):
+                yield None
+            return
+
+        pool = self.image.images.snapshot_pool(self.image)
+        if (
+            not self.ephemeral
+            or pool is None
+            or pool.size <= 0
+            or self._use_tmpfs()
+        ):
+            with self._container_in_path(self.image.path):
+                yield None
+            return
+
+        with self.timings.phase("container.pool_claim"), context.privs.root():
+            self.pool_snapshot = pool.claim(self.instance_name)
+        if self.pool_snapshot is None:
+            self.image.logger.info(
+                "%s: no ready snapshot available, using an ephemeral one",
+                self.image.name,
+            )
+        try:
+            with self._container_in_path(self.pool_snapshot or self.image.path):
+                yield None
+        finally:
+            with context.privs.root():
+                if self.pool_snapshot is not None:
+                    pool.release(self.pool_snapshot)
+                    self.pool_snapshot = None
+                # Do not make the container exit wait for new snapshots
+                pool.spawn_refill()
+
+    def _bind_running(self, bind: BindConfig) -> None:
+        """Add a bind mount to the running machine."""
+        # Podman mount definitions have the source, target and access mode of
+        # the bind mount as seen by the guest
+        mount = bind.to_podman()
+        cmd = ["machinectl", "bind", "--mkdir"]
+        if mount["Readonly"] == "true":
+            cmd.append("--read-only")
+        cmd += [self.instance_name, mount["Source"], mount["Target"]]
+        with context.privs.root():
+            res = subprocess.run(cmd, capture_output=True)
+        if res.returncode != 0:
+            self.image.logger.error(
+                "Failed to run %s (exit code %d): %r",
+                shlex.join(cmd),
+                res.returncode,
+                res.stderr,
+            )
+            raise RuntimeError("Failed to set up bind mounts in container")
+
+    def _set_unit_properties(self, unit_config: list[str]) -> None:
+        """Change properties of the unit of the running machine."""
+        cmd = [
+            "systemctl",
+            "set-property",
+            "--runtime",
+            self.properties["Unit"],
+        ]
+        cmd += unit_config
+        with context.privs.root():
+            res = subprocess.run(cmd, capture_output=True)
+        if res.returncode != 0:
+            self.image.logger.warning(
+                "%s: cannot set unit properties (exit code %d): %r",
+                self.instance_name,
+                res.returncode,
+                res.stderr,
+            )
+
+    @contextmanager
+    def _warm_container(self, warm: WarmContainer) -> Generator[None]:
+        """Use a container booted in advance, instead of starting one."""
+        # The guest script directory is bind mounted from the workdir of the
+        # warm container
+        self.scriptdir = warm.container.scriptdir
+        self.properties = warm.container.properties
+        try:
+            if priority_config := resource_unit_config(
+                self._priority_resources()
+            ):
+                # Warm containers are started without a priority class
+                self._set_unit_properties(priority_config)
+            with self.timings.phase("container.binds"):
+                for bind in self.config.binds:
+                    self._bind_running(bind)
+            if self.image.images.session.moncic.config.guest_agent:
+                with self.timings.phase("container.agent"):
+                    self.agent = self._start_agent()
             yield None
+        finally:
+            stopping = time.monotonic()
+            try:
+                self._shutdown()
+            finally:
+                warm.close()
+            self.timings.stop["container.shutdown"] = (
+                time.monotonic() - stopping
+            )
 
     @contextmanager
     def _container_in_path(self, path: Path) -> Generator[None, None, None]:
@@ -166,36 +489,117 @@ class NspawnContainer(Container):
             path,
         )
 
+        started = time.monotonic()
+        if self.image.images.session.moncic.config.guest_agent:
+            # Bind mount sources need to exist when nspawn starts
+            self.agentdir.mkdir(exist_ok=True)
         cmd = self.get_start_command(path)
-        self._run_nspawn(cmd)
+        with self.timings.phase("container.nspawn"):
+            self._run_nspawn(cmd)
 
         # Read machine properties
-        res = subprocess.run(
-            ["machinectl", "show", self.instance_name],
-            capture_output=True,
-            text=True,
-            check=True,
+        with self.timings.phase("container.properties"):
+            self.properties = self._read_properties()
+        if (
+            self.image.images.session.moncic.config.guest_agent
+            and self._use_boot()
+        ):
+            with self.timings.phase("container.agent"):
+                self.agent = self._start_agent()
+        self.image.logger.info(
+            "%s: container ready in %.3fs",
+            self.instance_name,
+            time.monotonic() - started,
         )
-        self.properties = {}
-        for line in res.stdout.splitlines():
-            key, value = line.split("=", 1)
-            self.properties[key] = value
 
         try:
             yield None
         finally:
-            with context.privs.root():
-                # See https://github.com/systemd/systemd/issues/6458
-                leader_pid = self.get_pid()
-                os.kill(leader_pid, signal.SIGRTMIN + 4)
-                while True:
-                    try:
-                        os.kill(leader_pid, 0)
-                    except OSError as e:
-                        if e.errno == errno.ESRCH:
-                            break
-                        raise
-                    time.sleep(0.1)
+            stopping = time.monotonic()
+            self._shutdown()
+            self.timings.stop["container.shutdown"] = (
+                time.monotonic() - stopping
+            )
+
+    def _shutdown(self) -> None:
+        """
+        Shut down the running machine, killing it if it does not stop in
+        time.
+        """
+        timeout = self.image.images.session.moncic.config.shutdown_timeout
+        with (
+            context.privs.root(),
+            ProcessHandle(self.get_pid()) as leader,
+        ):
+            if self._use_fast_teardown() or not self._use_boot():
+                # The filesystem of the container is about to be discarded,
+                # or there is no init system to shut down, and killing the
+                # leader process takes down the whole machine
+                leader.send_signal(signal.SIGKILL)
+                leader.wait()
+                return
+            # See https://github.com/systemd/systemd/issues/6458
+            leader.send_signal(signal.SIGRTMIN + 4)
+            if leader.wait(timeout or None):
+                return
+            self.image.logger.warning(
+                "%s: container did not shut down in %ds, killing it",
+                self.instance_name,
+                timeout,
+            )
+            leader.send_signal(signal.SIGKILL)
+            leader.wait()
+
+    @property
+    def agentdir(self) -> Path:
+        """Host directory with the agent script and socket."""
+        return self.scriptdir.parent / "agent"
+
+    def _start_agent(self) -> GuestAgent | None:
+        """
+        Start the command agent in the container.
+
+        :returns: None if the agent cannot be started, for example because
+          the guest has no python3
+        """
+        with context.privs.root():
+            if not os.path.lexists(self.get_root() / "usr" / "bin" / "python3"):
+                self.image.logger.info(
+                    "%s: python3 not found, not starting the guest agent",
+                    self.instance_name,
+                )
+                return None
+        shutil.copyfile(AGENT_SOURCE, self.agentdir / "agent.py")
+        socket_path = self.agentdir / "agent.sock"
+        cmd = [
+            "systemd-run",
+            f"--machine={self.instance_name}",
+            "--quiet",
+            "--unit=moncic-ci-agent",
+            "/usr/bin/python3",
+            (self.guest_agentdir / "agent.py").as_posix(),
+            (self.guest_agentdir / "agent.sock").as_posix(),
+        ]
+        with context.privs.root():
+            res = subprocess.run(cmd, capture_output=True)
+            if res.returncode != 0:
+                self.image.logger.warning(
+                    "%s: cannot start the guest agent: %r",
+                    self.instance_name,
+                    res.stderr,
+                )
+                return None
+            deadline = time.monotonic() + AGENT_START_TIMEOUT
+            while not socket_path.exists():
+                if time.monotonic() >= deadline:
+                    self.image.logger.warning(
+                        "%s: guest agent did not start in %ds",
+                        self.instance_name,
+                        AGENT_START_TIMEOUT,
+                    )
+                    return None
+                time.sleep(0.01)
+        return GuestAgent(self.logger, socket_path)
 
     @override
     def run(
@@ -208,6 +612,41 @@ class NspawnContainer(Container):
         if config.user is None:
             config.user = self.config.get_default_user()
 
+        if self.agent is not None and not config.interactive:
+            with context.privs.root():
+                return self.agent.run(
+                    command,
+                    cwd=config.cwd,
+                    user=config.user,
+                    check=config.check,
+                )
+
+        cmd = self.get_run_command(command, config)
+        with context.privs.root():
+            if config.interactive:
+                res = subprocess.run(cmd, check=config.check)
+            else:
+                runner = Runner(self.logger, cmd, check=config.check)
+                res = runner.run()
+
+        return res
+
+    @override
+    def get_run_command(
+        self, command: list[str], config: RunConfig
+    ) -> list[str]:
+        if not self._use_boot():
+            # There is no systemd in the guest to run commands: run them in
+            # the cgroup of the container, to apply its resource controls
+            pid = self.get_pid()
+            return nsenter_command(
+                pid,
+                command,
+                cwd=config.cwd,
+                user=config.user,
+                cgroup=process_cgroup(pid),
+            )
+
         systemd_version = self.image.distro.systemd_version
 
         cmd = [
@@ -249,15 +688,16 @@ class NspawnContainer(Container):
         # else:
         #     return Path("/root")
 
-        cmd += command
-        with context.privs.root():
-            if config.interactive:
-                res = subprocess.run(cmd, check=config.check)
-            else:
-                runner = Runner(self.logger, cmd, check=config.check)
-                res = runner.run()
+        return cmd + command
 
-        return res
+    @override
+    def _run_runners(
+        self, runners: Sequence[Runner]
+    ) -> list[subprocess.CompletedProcess[bytes]]:
+        # Concurrent commands do not go through the guest agent, even if it
+        # is running
+        with context.privs.root():
+            return super()._run_runners(runners)
 
     @override
     def run_script(
@@ -0,0 +1,170 @@
+"""
+Command agent running inside nspawn containers.
+
+This file is copied into the container and run with the guest python3: it
+must only use the standard library, and work with the older versions of
+Python 3 found in supported distributions: annotations using generic types
+are quoted for this reason.
+
+The agent listens on a unix socket. Each connection carries a request, as a
+line of JSON with ``argv``, ``cwd``, ``uid`` and ``gid``, and receives the
+output and exit status of the command as frames of a one byte kind and a 4
+bytes payload length, followed by the payload.
+"""
+
+import json
+import os
+import pwd
+import socket
+import struct
+import subprocess
+import sys
+import threading
+from typing import Any
+
+#: Frame with data from the command standard output
+STDOUT = b"o"
+#: Frame with data from the command standard error
+STDERR = b"e"
+#: Frame with the exit status of the command, as a decimal string
+EXIT = b"x"
+
+HEADER = struct.Struct("!cI")
+
+#: Exit status used when the command cannot be started, as in systemd
+EXIT_EXEC = 203
+
+
+class Connection:
+    """Connection to a client, sending frames from multiple threads."""
+
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+        self.lock = threading.Lock()
+
+    def send(self, kind: bytes, data: bytes) -> None:
+        """Send a frame."""
+        with self.lock:
+            self.sock.sendall(HEADER.pack(kind, len(data)) + data)
+
+
+def command_env(uid: int) -> "dict[str, str]":
+    """Return the environment for running a command as the given user."""
+    env = dict(os.environ)
+    try:
+        pw = pwd.getpwuid(uid)
+    except KeyError:
+        return env
+    env["HOME"] = pw.pw_dir
+    env["USER"] = pw.pw_name
+    env["LOGNAME"] = pw.pw_name
+    env["SHELL"] = pw.pw_shell
+    return env
+
+
+def credentials(uid: int, gid: int) -> "dict[str, Any]":
+    """
+    Return the Popen arguments to run a command as the given user.
+
+    Supplementary groups are looked up here: NSS lookups between fork and
+    exec can deadlock in a multithreaded process.
+    """
+    try:
+        groups = os.getgrouplist(pwd.getpwuid(uid).pw_name, gid)
+    except KeyError:
+        groups = []
+    if sys.version_info >= (3, 9):
+        return {"user": uid, "group": gid, "extra_groups": groups}
+
+    def demote() -> None:
+        os.setgroups(groups)
+        os.setgid(gid)
+        os.setuid(uid)
+
+    return {"preexec_fn": demote}
+
+
+def pump(
+    conn: Connection, kind: bytes, fd: int, proc: "subprocess.Popen[bytes]"
+) -> None:
+    """Forward command output to the client."""
+    while True:
+        data = os.read(fd, 65536)
+        if not data:
+            break
+        try:
+            conn.send(kind, data)
+        except OSError:
+            # The client went away
+            proc.kill()
+            break
+
+
+def handle(sock: socket.socket) -> None:
+    """Run the command requested by a client."""
+    conn = Connection(sock)
+    with sock:
+        with sock.makefile("rb") as reader:
+            request = json.loads(reader.readline().decode())
+        argv = request["argv"]
+        uid = request["uid"]
+        gid = request["gid"]
+        try:
+            proc = subprocess.Popen(
+                argv,
+                cwd=request["cwd"],
+                env=command_env(uid),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                **credentials(uid, gid),
+            )
+        except (OSError, subprocess.SubprocessError) as e:
+            conn.send(STDERR, "{}: {}\n".format(argv[0], e).encode())
+            conn.send(EXIT, str(EXIT_EXEC).encode())
+            return
+
+        assert proc.stdout is not None
+        assert proc.stderr is not None
+        threads = [
+            threading.Thread(
+                target=pump, args=(conn, STDOUT, proc.stdout.fileno(), proc)
+            ),
+            threading.Thread(
+                target=pump, args=(conn, STDERR, proc.stderr.fileno(), proc)
+            ),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        returncode = proc.wait()
+        proc.stdout.close()
+        proc.stderr.close()
+        try:
+            conn.send(EXIT, str(returncode).encode())
+        except OSError:
+            pass
+
+
+def main() -> None:
+    path = sys.argv[1]
+    tmp_path = path + ".new"
+    if os.path.lexists(tmp_path):
+        os.unlink(tmp_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        server.bind(tmp_path)
+    finally:
+        os.umask(old_umask)
+    server.listen(16)
+    # Make the socket appear only when it accepts connections
+    os.rename(tmp_path, path)
+    while True:
+        sock, _ = server.accept()
+        threading.Thread(target=handle, args=(sock,), daemon=True).start()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,11 @@
 import abc
 import logging
-import shutil
 from pathlib import Path
 from typing import Any, Optional, TYPE_CHECKING, override
 
 from moncic import context
 from moncic.distro import Distro
 from moncic.image import BootstrappableImage, ImageType, RunnableImage
-from moncic.utils.btrfs import Subvolume
 
 if TYPE_CHECKING:
     from moncic.container import (
@@ -48,6 +46,18 @@ class NspawnImage(RunnableImage, abc.ABC):
         #: Path to the image on disk
         self.path: Path = path
 
+    @override
+    def remove(self) -> BootstrappableImage | None:
+        # Move the image to the trash, and delete it in the background
+        with context.privs.root():
+            if pool := self.images.snapshot_pool(self):
+                pool.invalidate()
+            if self.path.exists():
+                self.images.discard_image(self.name)
+            self.images.forget_image(self.name)
+            self.images.trash.spawn_collector()
+        return self.bootstrapped_from
+
     @override
     def container(
         self,
@@ -142,6 +152,11 @@ class NspawnImage(RunnableImage, abc.ABC):
             case _:
                 return
 
+        # Layered images are read-only mounts, and their data is in the layer
+        # store
+        if self.images.is_layered(self.name):
+            return
+
         with context.privs.root():
             cachedir_path = self.path / "CACHEDIR.TAG"
             if backup:
@@ -174,21 +189,6 @@ class NspawnImagePlain(NspawnImage):
             res = res._replace(tmpfs=True)
         return res
 
-    @override
-    def remove(self) -> BootstrappableImage | None:
-        with context.privs.root():
-            if self.path.exists():
-                shutil.rmtree(self.path)
-        return self.bootstrapped_from
-
 
 class NspawnImageBtrfs(NspawnImage):
-    @override
-    def remove(self) -> BootstrappableImage | None:
-        with context.privs.root():
-            if self.path.exists():
-                subvolume = Subvolume(
-                    self.session.images.session.moncic.config, self.path, None
-                )
-                subvolume.remove()
-        return self.bootstrapped_from
+    """Nspawn image stored in a btrfs subvolume."""
@@ -1,24 +1,45 @@
 import abc
 import contextlib
+import datetime
 import logging
 import os
 import re
-import shutil
-import stat
 import subprocess
-from collections import defaultdict
 from collections.abc import Generator
 from pathlib import Path
-from typing import ContextManager, TYPE_CHECKING, override
+from typing import IO, ContextManager, TYPE_CHECKING, override
 
 from moncic import context
 from moncic.distro import Distro, DistroFamily
+from moncic.exceptions import Fail
 from moncic.image import BootstrappableImage, Image, RunnableImage
 from moncic.images import BootstrappingImages
 from moncic.provision.image import ConfiguredImage
-from moncic.utils.btrfs import Subvolume, do_dedupe
+from moncic.utils.btrfs import DedupeResult, Subvolume
+from moncic.utils.dedup import (
+    ContentGroup,
+    DedupeExecutor,
+    DedupeJob,
+    DedupeProgress,
+    DedupGroup,
+    DedupIndex,
+)
+from moncic.utils.fs import exchange_paths
+from moncic.utils.usage import DiskUsage, disk_usage
 
 from .image import NspawnImage, NspawnImageBtrfs, NspawnImagePlain
+from .layers import LayerStore
+from .manifest import Manifest, ManifestEntry
+from .pool import SnapshotPool
+from .tarballs import (
+    TAR_OPTIONS,
+    TarballCache,
+    compress_command,
+    decompress_command,
+)
+from .transfer import ExportFormat, detect_format
+from .trash import Trash, flock, image_lock
+from .warm import WarmPool
 
 if TYPE_CHECKING:
     from moncic.session import Session
@@ -39,6 +60,14 @@ class NspawnImages(BootstrappingImages, abc.ABC):
         self.session = session
         self.imagedir = imagedir
         self.logger = logging.getLogger("images.nspawn")
+        #: Area where images are moved to be deleted in the background
+        self.trash = Trash(session.moncic.config, imagedir)
+        #: Cached information about the images in imagedir
+        self.manifest = Manifest(imagedir)
+        #: Cached root filesystems of freshly bootstrapped distributions
+        self.tarballs = TarballCache(session.moncic.config, imagedir)
+        #: Pools of booted containers, by image name
+        self.warm_pools: dict[str, WarmPool] = {}
 
     @classmethod
     @abc.abstractmethod
@@ -59,13 +88,14 @@ class NspawnImages(BootstrappingImages, abc.ABC):
         self, name: str, variant_of: Image | None = None
     ) -> RunnableImage:
         path = (self.imagedir / name).absolute()
-        with context.privs.root():
-            if not path.is_dir():
-                raise KeyError(f"Image {name!r} not found")
+        if (entry := self.manifest.lookup(name)) is None:
+            with context.privs.root():
+                if not path.is_dir():
+                    raise KeyError(f"Image {name!r} not found")
         bootstrapped_from: BootstrappableImage | None = None
         match variant_of:
             case None:
-                distro = self._find_distro(path)
+                distro = self._lookup_distro(name, path, entry)
             case BootstrappableImage():
                 distro = variant_of.distro
                 bootstrapped_from = variant_of
@@ -86,15 +116,208 @@ class NspawnImages(BootstrappingImages, abc.ABC):
             bootstrapped_from=bootstrapped_from,
         )
 
+    def _lookup_distro(
+        self, name: str, path: Path, entry: ManifestEntry | None
+    ) -> Distro:
+        """Find the distribution of an image, using the manifest if possible."""
+        if entry is not None:
+            try:
+                return DistroFamily.lookup_distro(entry.distro)
+            except KeyError:
+                pass
+        distro = self._find_distro(path)
+        self.manifest.record(name, distro.full_name)
+        return distro
+
+    def _record_update(self, name: str) -> None:
+        """
+        Update the manifest after an image has been created or updated.
+
+        This needs to be called with root privileges.
+        """
+        # Warm containers were booted from the previous version of the image
+        if pool := self.warm_pools.get(name):
+            pool.invalidate()
+        path = self.imagedir / name
+        if not path.is_dir():
+            self.manifest.forget(name)
+            return
+        try:
+            distro = self._find_distro(path)
+        except KeyError:
+            self.manifest.forget(name)
+            return
+        self.manifest.record_update(name, distro.full_name)
+
     @override
     def list_images(self) -> list[str]:
-        images: list[str] = []
-        for path in self.imagedir.iterdir():
-            if path.name.startswith(".") or not path.is_dir():
-                continue
-            images.append(path.name)
-        images.sort()
-        return images
+        return self.manifest.list_names()
+
+    def forget_image(self, name: str) -> None:
+        """Update cached information after an image has been removed."""
+        self.manifest.forget(name)
+
+    def discard_image(self, name: str) -> None:
+        """
+        Move an image to the trash.
+
+        This needs to be called with root privileges.
+        """
+        if pool := self.warm_pools.get(name):
+            pool.invalidate()
+        self.trash.discard(self.imagedir / name)
+
+    def _install_image(self, name: str, work_path: Path) -> None:
+        """
+        Make work_path the new version of an image.
+
+        An existing version is atomically exchanged with the new one and then
+        moved to the trash, so that an interruption never leaves the image
+        missing. This needs to be called with root privileges.
+        """
+        path = self.imagedir / name
+        if not path.exists():
+            work_path.rename(path)
+            return
+        if pool := self.warm_pools.get(name):
+            pool.invalidate()
+        exchange_paths(work_path, path)
+        # work_path now contains the old version
+        self.trash.discard(work_path)
+
+    def is_layered(self, name: str) -> bool:
+        """Check if an image is a read-only mount of overlayfs layers."""
+        return False
+
+    def disk_usage(self, jobs: int | None = None) -> dict[str, DiskUsage]:
+        """
+        Compute how much disk space each image references, and how much of it
+        is not shared with other images.
+
+        :param jobs: number of images to scan in parallel
+        """
+        paths = {name: self.imagedir / name for name in self.list_images()}
+        with context.privs.root():
+            return disk_usage(paths, jobs)
+
+    @contextlib.contextmanager
+    def _replace_image(self, name: str) -> Generator[Path]:
+        """
+        Create a new version of an image in a working directory, which
+        replaces the image if the context manager does not raise an exception.
+
+        The working directory is not created. This needs to be called with
+        root privileges.
+        """
+        work_path = self.imagedir / f"{name}.new"
+        with image_lock(self.imagedir, name):
+            if work_path.exists():
+                # Leftover of an interrupted run
+                self.trash.discard(work_path)
+            try:
+                yield work_path
+            except BaseException:
+                if work_path.exists():
+                    self.trash.discard(work_path)
+                raise
+            else:
+                self._install_image(name, work_path)
+                self._record_update(name)
+            finally:
+                self.trash.spawn_collector()
+
+    def _export_tar(self, name: str, out: IO[bytes]) -> None:
+        """
+        Export an image as a zstd compressed tarball.
+
+        This needs to be called with root privileges.
+        """
+        path = self.imagedir / name
+        cmd = ["tar", "-C", path.as_posix()] + TAR_OPTIONS
+        cmd += ["-I", compress_command(), "-cf", "-", "."]
+        log.info("%s: exporting as tar.zst", name)
+        subprocess.run(cmd, stdout=out, check=True)
+
+    def _import_tar(self, name: str, src: IO[bytes]) -> None:
+        """
+        Import an image from a zstd compressed tarball.
+
+        This needs to be called with root privileges.
+        """
+        with self._replace_image(name) as work_path:
+            work_path.mkdir(mode=0o755)
+            self._extract_tar(work_path, src)
+
+    def _extract_tar(self, path: Path, src: IO[bytes]) -> None:
+        """Extract an exported tarball into path."""
+        cmd = ["tar", "-C", path.as_posix()] + TAR_OPTIONS
+        cmd += ["-I", decompress_command(), "-xf", "-"]
+        subprocess.run(cmd, stdin=src, check=True)
+
+    def _import_btrfs(self, name: str, src: IO[bytes]) -> None:
+        """
+        Import an image from a btrfs send stream.
+
+        This needs to be called with root privileges.
+        """
+        raise Fail(
+            f"{name}: btrfs streams can only be imported in image directories"
+            " on btrfs"
+        )
+
+    @abc.abstractmethod
+    def export_image(
+        self, name: str, out: IO[bytes], full: bool = False
+    ) -> ExportFormat:
+        """
+        Export an image, to be imported in another image directory with
+        :meth:`import_image`.
+
+        :param full: export the whole image, even if an incremental export is
+          possible
+        :returns: the format used for the export
+        """
+
+    def import_image(self, name: str, src: IO[bytes]) -> ExportFormat:
+        """
+        Import an image exported with :meth:`export_image`.
+
+        If an image with the same name exists, it is replaced.
+
+        :param src: seekable file with the exported image
+        :returns: the format of the exported image
+        """
+        try:
+            fmt = detect_format(src)
+        except ValueError as e:
+            raise Fail(f"{name}: {e}") from None
+        with context.privs.root():
+            match fmt:
+                case ExportFormat.BTRFS:
+                    self._import_btrfs(name, src)
+                case ExportFormat.TAR_ZSTD:
+                    self._import_tar(name, src)
+            # Ready snapshots refer to the old version of the image
+            if pool := self.snapshot_pool(self.image(name)):
+                pool.invalidate()
+                pool.spawn_refill()
+        return fmt
+
+    @override
+    def collect_garbage(self) -> None:
+        """
+        Delete images moved to the trash, and leftovers of interrupted
+        maintenance.
+        """
+        with context.privs.root():
+            for path in self.trash.discard_leftovers():
+                log.info(
+                    "%s: removed leftover of interrupted maintenance", path
+                )
+            if count := self.trash.collect():
+                log.info(
+                    "%s: deleted %d discarded entries", self.imagedir, count
+                )
 
     def get_distro_tarball(self, distro: Distro) -> Path | None:
         """
@@ -118,6 +341,23 @@ class NspawnImages(BootstrappingImages, abc.ABC):
                     return path
         return None
 
+    def _bootstrap_rootfs(self, distro: Distro, path: Path) -> None:
+        """
+        Create a root filesystem for distro in path, reusing a cached one if
+        available.
+
+        If the cached root filesystem cannot be extracted, a new one is
+        bootstrapped. This needs to be called with root privileges.
+        """
+        if (tarball := self.tarballs.lookup(distro)) is not None:
+            try:
+                self.tarballs.extract(tarball, path)
+                return
+            except subprocess.CalledProcessError:
+                log.warning("%s: bootstrapping from scratch", distro)
+        distro.bootstrap(self, path)
+        self.tarballs.store(distro, path)
+
     def _find_distro(self, path: Path) -> Distro:
         try:
             return DistroFamily.from_path(path)
@@ -131,6 +371,44 @@ class NspawnImages(BootstrappingImages, abc.ABC):
     def transactional_workdir(self, image: Image) -> ContextManager[Path]:
         """Create a working directory for transactional image maintenance."""
 
+    def snapshot_pool(self, image: Image) -> SnapshotPool | None:
+        """
+        Return the pool of ready snapshots for the image.
+
+        :returns: None if snapshot pools are not supported
+        """
+        return None
+
+    def warm_pool(self, image: Image) -> WarmPool | None:
+        """
+        Return the pool of booted containers for the image.
+
+        :returns: None if warm pools are disabled
+        """
+        size = self.session.moncic.config.warm_pool
+        if size <= 0:
+            return None
+        if (pool := self.warm_pools.get(image.name)) is None:
+            if not self.warm_pools:
+                self.session.callback(self._close_warm_pools)
+            pool = WarmPool(self, image.name, size)
+            self.warm_pools[image.name] = pool
+        return pool
+
+    def warm_container_count(self) -> int:
+        """
+        Return the number of warm containers booted in the session, including
+        the ones that have been taken from the pools.
+        """
+        return sum(
+            len(pool.idle) + pool.claimed for pool in self.warm_pools.values()
+        )
+
+    def _close_warm_pools(self) -> None:
+        """Stop all warm containers."""
+        for pool in self.warm_pools.values():
+            pool.invalidate()
+
     def wants_compression(self, image: Image) -> str | None:
         """Check if the image should be created with compression."""
         match image:
@@ -155,6 +433,60 @@ class PlainImages(NspawnImages):
 
     image_class = NspawnImagePlain
 
+    def __init__(self, session: "Session", imagedir: Path):
+        super().__init__(session, imagedir)
+        #: Overlayfs layers of layered images
+        self.layers = LayerStore(imagedir, self.trash)
+
+    @property
+    def use_layers(self) -> bool:
+        """Check if new images extending others should be layered."""
+        return self.session.moncic.config.plain_layers
+
+    @override
+    def is_layered(self, name: str) -> bool:
+        return self.layers.is_layered(name)
+
+    @override
+    def image(
+        self, name: str, variant_of: Image | None = None
+    ) -> RunnableImage:
+        if self.layers.is_layered(name):
+            with context.privs.root():
+                self.layers.ensure_mounted(name)
+        return super().image(name, variant_of)
+
+    @override
+    def discard_image(self, name: str) -> None:
+        if self.layers.is_layered(name):
+            self.layers.remove(name)
+        super().discard_image(name)
+
+    @override
+    def _install_image(self, name: str, work_path: Path) -> None:
+        # The mount of a layered image cannot be moved
+        if self.layers.is_layered(name):
+            self.layers.remove(name)
+        super()._install_image(name, work_path)
+
+    @override
+    def collect_garbage(self) -> None:
+        with context.privs.root():
+            for layer in self.layers.prune():
+                log.info("%s: removed unused layer", layer)
+        super().collect_garbage()
+
+    @override
+    def export_image(
+        self, name: str, out: IO[bytes], full: bool = False
+    ) -> ExportFormat:
+        with context.privs.root():
+            if not (self.imagedir / name).is_dir():
+                raise KeyError(f"Image {name!r} not found")
+            self.layers.ensure_mounted(name)
+            self._export_tar(name, out)
+        return ExportFormat.TAR_ZSTD
+
     @override
     @classmethod
     def create_machinectl(cls, session: "Session") -> NspawnImages:
@@ -165,27 +497,72 @@ class PlainImages(NspawnImages):
     def transactional_workdir(self, image: Image) -> Generator[Path]:
         path = self.imagedir / image.name
 
-        if path.exists():
+        with context.privs.root():
+            layered = path.exists() and (
+                self.use_layers or self.layers.is_layered(image.name)
+            )
+        if layered:
+            with self._layered_workdir(image.name) as work_path:
+                yield work_path
+        elif path.exists():
             logging.info(
                 "%s: transactional updates on non-btrfs nspawn images"
                 " are not supported",
                 path,
             )
             yield path
+            with context.privs.root():
+                self._record_update(image.name)
         else:
             work_path = path.parent / f"{path.name}.new"
+            with context.privs.root(), image_lock(self.imagedir, image.name):
+                if work_path.exists():
+                    # Leftover of an interrupted run
+                    self.trash.discard(work_path)
+                try:
+                    with context.privs.user():
+                        yield work_path
+                except BaseException:
+                    if work_path.exists():
+                        self.trash.discard(work_path)
+                    raise
+                else:
+                    if work_path.exists():
+                        work_path.rename(path)
+                    self._record_update(image.name)
+                finally:
+                    self.trash.spawn_collector()
+
+    @contextlib.contextmanager
+    def _layered_workdir(self, name: str) -> Generator[Path]:
+        """
+        Mount a layered image read-write with a new upper layer, which is
+        added to the image if the context manager does not raise an exception.
+        """
+        work_path = self.imagedir / f"{name}.new"
+        with context.privs.root(), image_lock(self.imagedir, name):
+            self.layers.umount(work_path)
             if work_path.exists():
-                # Remove an old work path left around
-                shutil.rmtree(work_path)
+                # Leftover of an interrupted run
+                self.trash.discard(work_path)
+            self.layers.convert(name)
+            layer, work = self.layers.update(name, work_path)
             try:
-                yield work_path
+                with context.privs.user():
+                    yield work_path
             except BaseException:
-                if work_path.exists():
-                    shutil.rmtree(work_path)
+                self.layers.umount(work_path)
+                self.trash.discard(self.layers.layer_path(layer))
                 raise
             else:
+                self.layers.umount(work_path)
+                self.layers.commit(name, layer)
+                self._record_update(name)
+            finally:
                 if work_path.exists():
-                    work_path.rename(path)
+                    work_path.rmdir()
+                self.layers.discard_work(work)
+                self.trash.spawn_collector()
 
     @override
     def bootstrap_new(self, image: BootstrappableImage) -> RunnableImage:
@@ -210,7 +587,7 @@ class PlainImages(NspawnImages):
                     )
             else:
                 with context.privs.root():
-                    image.distro.bootstrap(self, work_path)
+                    self._bootstrap_rootfs(image.distro, work_path)
 
         return self.image(image.name, variant_of=image)
 
@@ -228,6 +605,14 @@ class PlainImages(NspawnImages):
             if path.exists():
                 return self.image(image.name, variant_of=image)
 
+        if self.use_layers and parent.images is self:
+            with context.privs.root():
+                with image_lock(self.imagedir, parent.name):
+                    self.layers.convert(parent.name)
+                self.layers.create(image.name, parent.name)
+                self._record_update(image.name)
+            return self.image(image.name, variant_of=image)
+
         assert isinstance(image, NspawnImage)
         with context.privs.root():
             image.host_run(
@@ -239,6 +624,7 @@ class PlainImages(NspawnImages):
                     path.as_posix(),
                 ]
             )
+            self._record_update(image.name)
         return self.image(image.name, variant_of=image)
 
 
@@ -249,59 +635,248 @@ class BtrfsImages(NspawnImages):
 
     image_class = NspawnImageBtrfs
 
+    #: Name of the directory with read-only snapshots of exported and imported
+    #: images, used as parents for incremental exports
+    EXPORTS_DIRNAME = ".exports"
+
+    def _export_snapshots(self, name: str) -> list[Path]:
+        """List the export snapshots of an image, oldest first."""
+        try:
+            return sorted(
+                (self.imagedir / self.EXPORTS_DIRNAME / name).iterdir()
+            )
+        except FileNotFoundError:
+            return []
+
+    @override
+    def export_image(
+        self, name: str, out: IO[bytes], full: bool = False
+    ) -> ExportFormat:
+        """
+        Export an image as a btrfs send stream.
+
+        A read-only snapshot of the exported image is kept, and the next export
+        only contains the changes since then. To import it, the image
+        directory on the other side needs to have imported the previous export.
+        """
+        path = self.imagedir / name
+        exports = self.imagedir / self.EXPORTS_DIRNAME / name
+        with context.privs.root():
+            if not path.is_dir():
+                raise KeyError(f"Image {name!r} not found")
+            exports.mkdir(mode=0o700, parents=True, exist_ok=True)
+            with flock(exports.parent / f".{name}.lock"):
+                previous = self._export_snapshots(name)
+                snapshot = Subvolume(
+                    self.session.moncic.config,
+                    exports
+                    / datetime.datetime.now().strftime("%Y%m%dT%H%M%S%f"),
+                    None,
+                )
+                snapshot.snapshot(path, readonly=True)
+                cmd = ["btrfs", "send", "-q"]
+                if previous and not full:
+                    log.info(
+                        "%s: exporting changes since %s",
+                        name,
+                        previous[-1].name,
+                    )
+                    cmd += ["-p", previous[-1].as_posix()]
+                else:
+                    log.info("%s: exporting the whole image", name)
+                cmd.append(snapshot.path.as_posix())
+                try:
+                    subprocess.run(cmd, stdout=out, check=True)
+                except BaseException:
+                    self.trash.discard(snapshot.path)
+                    raise
+                finally:
+                    self.trash.spawn_collector()
+                # Keep only the snapshot just exported as the next parent
+                for old in previous:
+                    self.trash.discard(old)
+        return ExportFormat.BTRFS
+
+    @override
+    def _import_btrfs(self, name: str, src: IO[bytes]) -> None:
+        exports = self.imagedir / self.EXPORTS_DIRNAME / name
+        exports.mkdir(mode=0o700, parents=True, exist_ok=True)
+        with flock(exports.parent / f".{name}.lock"):
+            before = set(self._export_snapshots(name))
+            subprocess.run(
+                ["btrfs", "receive", "-q", exports.as_posix()],
+                stdin=src,
+                check=True,
+            )
+            received = [
+                p for p in self._export_snapshots(name) if p not in before
+            ]
+            if len(received) != 1:
+                raise RuntimeError(
+                    f"{name}: btrfs receive created {len(received)} subvolumes"
+                )
+            with self._replace_image(name) as work_path:
+                Subvolume(self.session.moncic.config, work_path, None).snapshot(
+                    received[0]
+                )
+            # Keep only the snapshot just received as parent for the next
+            # incremental import
+            for old in before:
+                self.trash.discard(old)
+
+    @override
+    def _import_tar(self, name: str, src: IO[bytes]) -> None:
+        compression = self.session.moncic.config.compression
+        with self._replace_image(name) as work_path:
+            subvolume = Subvolume(
+                self.session.moncic.config, work_path, compression
+            )
+            with subvolume.create():
+                self._extract_tar(work_path, src)
+
     @override
     @classmethod
     def create_machinectl(cls, session: "Session") -> NspawnImages:
         return BtrfsMachinectlImages(session)
 
     @override
-    def deduplicate(self) -> None:
+    def snapshot_pool(self, image: Image) -> SnapshotPool | None:
+        size: int | None
+        match image:
+            case ConfiguredImage():
+                size = image.config.container_info.snapshot_pool
+            case RunnableImage():
+                size = image.get_container_info().snapshot_pool
+            case _:
+                size = None
+        if size is None:
+            size = self.session.moncic.config.snapshot_pool
+        return SnapshotPool(
+            self.session.moncic.config, self.trash, image.name, size
+        )
+
+    @override
+    def deduplicate(
+        self, *, jobs: int | None = None, by_content: bool = False
+    ) -> None:
         """
         Attempt deduplicating files that have the same name and size across OS
-        images
+        images.
+
+        A persistent index in the image directory keeps track of what has
+        already been deduplicated, so that only files changed since the last
+        run are considered.
+
+        :param jobs: number of parallel deduplication threads
+        :param by_content: also deduplicate files with the same contents,
+          regardless of their path
         """
-        super().deduplicate()
+        super().deduplicate(jobs=jobs, by_content=by_content)
         log.info("Deduplicating disk usage...")
 
         imagedir = self.imagedir
 
-        by_name_size = defaultdict(list)
-        with os.scandir(imagedir) as it:
-            for entry in it:
-                if entry.name.startswith("."):
-                    continue
-                if not entry.is_dir():
-                    continue
+        with context.privs.root(), DedupIndex(imagedir) as index:
+            names: set[str] = set()
+            with os.scandir(imagedir) as it:
+                for entry in it:
+                    if entry.name.startswith("."):
+                        continue
+                    if not entry.is_dir():
+                        continue
+                    names.add(entry.name)
+                    index.update_image(entry.name, Path(entry.path))
+            index.prune(names)
 
-                path = os.path.join(imagedir, entry.name)
-                for dirpath, dirnames, filenames, dirfd in os.fwalk(path):
-                    relpath = os.path.relpath(dirpath, path)
-                    for fn in filenames:
-                        st = os.lstat(fn, dir_fd=dirfd)
-                        if not stat.S_ISREG(st.st_mode):
-                            continue
-                        size = st.st_size
-                        by_name_size[(os.path.join(relpath, fn), size)].append(
-                            entry.name
-                        )
+            result = self._dedupe_by_path(index, jobs)
+            log.info(
+                "%d bytes newly deduplicated, %d bytes were already shared",
+                result.reclaimed,
+                result.shared,
+            )
 
-        total_saved = 0
-        for (name, size), images in by_name_size.items():
-            if len(images) < 2:
-                continue
-            saved = 0
-            for imgname in images[1:]:
-                saved += do_dedupe(
-                    os.path.join(imagedir, images[0], name),
-                    os.path.join(imagedir, imgname, name),
-                    size,
+            if by_content:
+                result, extra = self._dedupe_by_content(index, jobs)
+                log.info(
+                    "%d bytes newly deduplicated by content, %d bytes were"
+                    " already shared, about %d more than deduplicating by"
+                    " path",
+                    result.reclaimed,
+                    result.shared,
+                    extra,
                 )
-            # if saved > 0:
-            #     log.info("%s: found in %s, recovered %db", name, ",
-            #     ".join(images), saved)
-            total_saved += saved
 
-        log.info("%d total bytes are currently deduplicated", total_saved)
+            for name in names:
+                index.update_generation(name, imagedir / name)
+
+    def _dedupe_by_path(
+        self, index: DedupIndex, jobs: int | None
+    ) -> DedupeResult:
+        """
+        Deduplicate files with the same path and size across images.
+        """
+        work: list[tuple[DedupGroup, DedupeJob]] = []
+        for group in index.pending_groups():
+            reference, *others = group.images
+            if reference not in group.changed:
+                # Only files changed since the last run need work
+                others = [name for name in others if name in group.changed]
+            job = DedupeJob(
+                os.path.join(self.imagedir, reference, group.relpath),
+                [
+                    os.path.join(self.imagedir, imgname, group.relpath)
+                    for imgname in others
+                ],
+                group.size,
+            )
+            work.append((group, job))
+
+        progress = DedupeProgress(
+            sum(job.size * len(job.dsts) for group, job in work)
+        )
+        executor = DedupeExecutor[DedupGroup](jobs)
+        for group, result in executor.run(work, progress):
+            # Leave failed groups in the index, to retry them next time
+            if not result.failed:
+                index.mark_deduped(group)
+        return DedupeResult(progress.reclaimed, progress.shared)
+
+    def _dedupe_by_content(
+        self, index: DedupIndex, jobs: int | None
+    ) -> tuple[DedupeResult, int]:
+        """
+        Deduplicate files with the same contents, regardless of their path.
+
+        :returns: the deduplication result, and an estimate of how many of the
+          newly deduplicated bytes could not have been deduplicated by path
+        """
+        log.info("Looking for files with the same contents...")
+        work: list[tuple[ContentGroup, DedupeJob]] = []
+        for group in index.content_groups(jobs):
+            reference, *others = group.files
+            if reference not in group.changed:
+                others = [file for file in others if file in group.changed]
+            job = DedupeJob(
+                os.path.join(self.imagedir, *reference),
+                [os.path.join(self.imagedir, *file) for file in others],
+                group.size,
+            )
+            work.append((group, job))
+
+        progress = DedupeProgress(
+            sum(job.size * len(job.dsts) for group, job in work)
+        )
+        total_extra = 0
+        executor = DedupeExecutor[ContentGroup](jobs)
+        for group, result in executor.run(work, progress):
+            # Leave failed groups in the index, to retry them next time
+            if not result.failed:
+                index.mark_content_deduped(group)
+            # Deduplicating by path would leave one copy for each distinct
+            # path: count the rest as extra savings
+            paths = {relpath for image, relpath in group.files}
+            total_extra += min(result.reclaimed, group.size * (len(paths) - 1))
+        return DedupeResult(progress.reclaimed, progress.shared), total_extra
 
     @override
     @contextlib.contextmanager
@@ -310,34 +885,37 @@ class BtrfsImages(NspawnImages):
         compression = self.wants_compression(image)
 
         work_path = path.parent / f"{path.name}.new"
-        with context.privs.root():
+        with context.privs.root(), image_lock(self.imagedir, image.name):
             subvolume = Subvolume(
                 self.session.moncic.config, work_path, compression
             )
             if work_path.exists():
-                subvolume.remove()
-                shutil.rmtree(work_path)
-            if not path.exists():
-                with subvolume.create():
-                    try:
+                # Leftover of an interrupted run
+                self.trash.discard(work_path)
+            try:
+                if not path.exists():
+                    with subvolume.create():
                         with context.privs.user():
                             yield work_path
-                    except BaseException:
-                        subvolume.remove()
-                        raise
-                    else:
-                        work_path.rename(path)
-            else:
-                # Create work_path as a snapshot of path
-                subvolume.snapshot(path)
-                try:
+                    work_path.rename(path)
+                else:
+                    # Create work_path as a snapshot of path
+                    subvolume.snapshot(path)
                     with context.privs.user():
                         yield work_path
-                except BaseException:
-                    subvolume.remove()
-                    raise
-                else:
-                    subvolume.replace_subvolume(path)
+                    self._install_image(image.name, work_path)
+            except BaseException:
+                if work_path.exists():
+                    self.trash.discard(work_path)
+                raise
+            else:
+                self._record_update(image.name)
+                # Ready snapshots now refer to the old version of the image
+                if pool := self.snapshot_pool(image):
+                    pool.invalidate()
+                    pool.spawn_refill()
+            finally:
+                self.trash.spawn_collector()
 
     @override
     def bootstrap_new(self, image: BootstrappableImage) -> RunnableImage:
@@ -362,7 +940,7 @@ class BtrfsImages(NspawnImages):
                     )
             else:
                 with context.privs.root():
-                    image.distro.bootstrap(self, work_path)
+                    self._bootstrap_rootfs(image.distro, work_path)
 
         return self.image(image.name, variant_of=image)
 
@@ -385,24 +963,51 @@ class BtrfsImages(NspawnImages):
         with context.privs.root():
             subvolume = Subvolume(self.session.moncic.config, path, compression)
             subvolume.snapshot(parent.path)
+            self._record_update(image.name)
         return self.image(image.name, variant_of=image)
 
 
 class MachinectlImages(NspawnImages):
+    """
+    Images stored in /var/lib/machines, compatibly with machinectl
+    """
+
     def __init__(self, session: "Session") -> None:
         super().__init__(session, MACHINECTL_PATH)
+        #: Names of the images, cached for the duration of the session
+        self._machines: set[str] | None = None
 
     def _list_machines(self) -> set[str]:
-        res = subprocess.run(
-            ["machinectl", "list-images", "--no-pager", "--no-legend"],
-            check=True,
-            stdout=subprocess.PIPE,
-            text=True,
-        )
-        names: set[str] = set()
-        for line in res.stdout.splitlines():
-            names.add(line.split()[0])
-        return names
+        """
+        List the images in /var/lib/machines.
+
+        The directory is scanned directly instead of running ``machinectl
+        list-images``, and the result is cached until images are created or
+        removed.
+        """
+        if self._machines is None:
+            try:
+                names = self.manifest.list_names()
+            except PermissionError:
+                with context.privs.root():
+                    names = self.manifest.list_names()
+            self._machines = set(names)
+        return self._machines
+
+    @override
+    def reload(self) -> None:
+        super().reload()
+        self._machines = None
+
+    @override
+    def _record_update(self, name: str) -> None:
+        super()._record_update(name)
+        self._machines = None
+
+    @override
+    def forget_image(self, name: str) -> None:
+        super().forget_image(name)
+        self._machines = None
 
     @override
     def has_image(self, name: str) -> bool:
@@ -0,0 +1,419 @@
+"""
+Images on non-btrfs storage made of stacked overlayfs layers
+"""
+
+import json
+import logging
+import os
+import re
+import shutil
+import stat
+import subprocess
+import uuid
+from pathlib import Path
+from typing import TYPE_CHECKING, NamedTuple
+
+if TYPE_CHECKING:
+    from .trash import Trash
+
+log = logging.getLogger("images.layers")
+
+#: Extended attribute marking an overlayfs directory as opaque
+OPAQUE_XATTR = "trusted.overlay.opaque"
+
+
+def is_opaque(path: Path) -> bool:
+    """Check if a directory is marked as opaque by overlayfs."""
+    try:
+        return os.getxattr(path, OPAQUE_XATTR, follow_symlinks=False) == b"y"
+    except OSError:
+        return False
+
+
+def _remove(path: Path) -> None:
+    """Remove a path of any type, if it exists."""
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path)
+    else:
+        path.unlink(missing_ok=True)
+
+
+def _copy(src: Path, dst: Path) -> None:
+    """Copy a file or directory tree preserving all metadata."""
+    subprocess.run(
+        [
+            "cp",
+            "-a",
+            "--reflink=auto",
+            "--no-target-directory",
+            src.as_posix(),
+            dst.as_posix(),
+        ],
+        check=True,
+    )
+
+
+def merge_layer(src: Path, dst: Path) -> None:
+    """
+    Apply the overlayfs layer src on top of the layer dst, as if src had been
+    the upper directory of an overlay mount using dst as its top lower
+    directory.
+
+    Whiteouts and opaque directories are kept, since they may still need to
+    hide files in the layers below dst.
+    """
+    with os.scandir(src) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    for entry in entries:
+        src_path = Path(entry.path)
+        dst_path = dst / entry.name
+        st = entry.stat(follow_symlinks=False)
+        if (
+            stat.S_ISDIR(st.st_mode)
+            and not is_opaque(src_path)
+            and dst_path.is_dir()
+            and not dst_path.is_symlink()
+        ):
+            merge_layer(src_path, dst_path)
+            shutil.copystat(src_path, dst_path, follow_symlinks=False)
+            os.chown(dst_path, st.st_uid, st.st_gid, follow_symlinks=False)
+        else:
+            _remove(dst_path)
+            _copy(src_path, dst_path)
+
+
+def is_mounted(path: Path) -> bool:
+    """
+    Check if path is a mount point.
+
+    Unlike :func:`os.path.ismount`, this also detects bind mounts within the
+    same file system.
+    """
+    target = os.path.abspath(path)
+    with open("/proc/self/mountinfo", "rb") as fd:
+        for line in fd:
+            mountpoint = line.split(b" ", 5)[4]
+            # Spaces and other special characters are escaped as octal
+            decoded = re.sub(
+                rb"\\([0-7]{3})",
+                lambda mo: bytes([int(mo.group(1), 8)]),
+                mountpoint,
+            )
+            if os.fsdecode(decoded) == target:
+                return True
+    return False
+
+
+def _escape(path: Path) -> str:
+    """Escape a path for use in overlayfs mount options."""
+    res = path.as_posix()
+    for c in "\\:,":
+        res = res.replace(c, "\\" + c)
+    return res
+
+
+class LayerStack(NamedTuple):
+    """Layers making up an image."""
+
+    #: IDs of the layers, from the bottom to the top
+    layers: list[str]
+    #: Number of bottom layers shared with the image this one extends
+    inherited: int
+
+    @property
+    def own(self) -> list[str]:
+        """Layers created for this image."""
+        return self.layers[self.inherited :]
+
+
+class LayerStore:
+    """
+    Immutable overlayfs layers of images in a non-btrfs image directory.
+
+    Layers are stored in ``.layers/data/<id>/``, and the list of layers of each
+    layered image in ``.layers/stacks/<name>.json``. The image directory is
+    the read-only overlay mount of the layers of the image.
+
+    An image extending another starts with the layers of its parent, plus an
+    empty layer. Updates write into a new layer, added to the stack only if
+    the update succeeded. When an image has more than :attr:`MAX_OWN_LAYERS`
+    of its own layers, all the layers added by updates are merged into one.
+
+    Layers are shared among images and are never modified: layers that no
+    image uses any more are only removed by :meth:`prune`.
+    """
+
+    #: Name of the layer store directory inside the image directory
+    DIRNAME = ".layers"
+
+    #: Number of layers of an image after which updates are merged
+    MAX_OWN_LAYERS = 4
+
+    def __init__(self, imagedir: Path, trash: "Trash") -> None:
+        self.imagedir = imagedir
+        self.trash = trash
+        self.path = imagedir / self.DIRNAME
+        #: Directory with the contents of the layers
+        self.data_path = self.path / "data"
+        #: Directory with the list of layers of each image
+        self.stacks_path = self.path / "stacks"
+        #: Directory with overlayfs work directories
+        self.work_path = self.path / "work"
+
+    def layer_path(self, layer: str) -> Path:
+        """Return the path of a layer."""
+        return self.data_path / layer
+
+    def stack_path(self, name: str) -> Path:
+        """Return the path of the layer list of an image."""
+        return self.stacks_path / f"{name}.json"
+
+    def is_layered(self, name: str) -> bool:
+        """Check if an image is made of layers."""
+        return self.stack_path(name).exists()
+
+    def read_stack(self, name: str) -> LayerStack | None:
+        """
+        Read the layer list of an image.
+
+        :returns: None if the image is not layered
+        """
+        try:
+            with self.stack_path(name).open() as fd:
+                data = json.load(fd)
+        except FileNotFoundError:
+            return None
+        return LayerStack(layers=data["layers"], inherited=data["inherited"])
+
+    def write_stack(self, name: str, stack: LayerStack) -> None:
+        """Atomically replace the layer list of an image."""
+        # Layer lists are readable, to look up layered images without root
+        # privileges
+        self.stacks_path.mkdir(mode=0o755, parents=True, exist_ok=True)
+        path = self.stack_path(name)
+        tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+        with tmp_path.open("w") as fd:
+            json.dump(stack._asdict(), fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+        tmp_path.rename(path)
+
+    def new_layer(self) -> str:
+        """Create a new empty layer, returning its ID."""
+        self.data_path.mkdir(mode=0o700, parents=True, exist_ok=True)
+        layer = uuid.uuid4().hex
+        self.layer_path(layer).mkdir(mode=0o755)
+        return layer
+
+    def convert(self, name: str) -> LayerStack:
+        """
+        Turn a plain image into a layered image with a single layer.
+
+        This needs to be called with root privileges, holding the image lock.
+        """
+        if (stack := self.read_stack(name)) is not None:
+            return stack
+        path = self.imagedir / name
+        self.data_path.mkdir(mode=0o700, parents=True, exist_ok=True)
+        layer = uuid.uuid4().hex
+        log.info("%s: converting to a layered image", name)
+        path.rename(self.layer_path(layer))
+        path.mkdir(mode=0o755)
+        stack = LayerStack(layers=[layer], inherited=0)
+        self.write_stack(name, stack)
+        self.mount(name)
+        return stack
+
+    def create(self, name: str, parent: str) -> None:
+        """
+        Create a layered image extending a parent image.
+
+        This needs to be called with root privileges.
+        """
+        parent_stack = self.read_stack(parent)
+        assert parent_stack is not None
+        stack = LayerStack(
+            layers=parent_stack.layers + [self.new_layer()],
+            inherited=len(parent_stack.layers),
+        )
+        (self.imagedir / name).mkdir(mode=0o755)
+        self.write_stack(name, stack)
+        self.mount(name)
+
+    def _mount(
+        self, layers: list[str], target: Path, upper: str | None = None
+    ) -> Path | None:
+        """
+        Mount layers on target, read-only unless upper is given.
+
+        :returns: the overlayfs work directory to remove after unmounting, if
+          any
+        """
+        lower = [self.layer_path(layer) for layer in reversed(layers)]
+        if upper is None and len(lower) == 1:
+            cmd = ["mount", "--bind", "-o", "ro", lower[0].as_posix()]
+            subprocess.run(cmd + [target.as_posix()], check=True)
+            return None
+        options = ["lowerdir=" + ":".join(_escape(p) for p in lower)]
+        work: Path | None = None
+        if upper is None:
+            options.insert(0, "ro")
+        else:
+            self.work_path.mkdir(mode=0o700, parents=True, exist_ok=True)
+            work = self.work_path / uuid.uuid4().hex
+            work.mkdir(mode=0o700)
+            options += [
+                f"upperdir={_escape(self.layer_path(upper))}",
+                f"workdir={_escape(work)}",
+                # Keep upper directories self-contained, so that they can be
+                # merged
+                "redirect_dir=off",
+                "metacopy=off",
+            ]
+        subprocess.run(
+            [
+                "mount",
+                "-t",
+                "overlay",
+                "overlay",
+                "-o",
+                ",".join(options),
+                target.as_posix(),
+            ],
+            check=True,
+        )
+        return work
+
+    def umount(self, target: Path) -> None:
+        """
+        Unmount target, if mounted.
+
+        Containers already running on the mount keep using it.
+        """
+        if is_mounted(target):
+            subprocess.run(["umount", "--lazy", target.as_posix()], check=True)
+
+    def mount(self, name: str) -> None:
+        """
+        Mount the current layers of an image on the image directory, replacing
+        any previous mount.
+
+        This needs to be called with root privileges.
+        """
+        stack = self.read_stack(name)
+        assert stack is not None
+        path = self.imagedir / name
+        self.umount(path)
+        self._mount(stack.layers, path)
+
+    def ensure_mounted(self, name: str) -> None:
+        """
+        Mount a layered image if it is not mounted, for example after a
+        reboot.
+
+        This needs to be called with root privileges.
+        """
+        if not self.is_layered(name):
+            return
+        if not is_mounted(self.imagedir / name):
+            self.mount(name)
+
+    def update(self, name: str, work_path: Path) -> tuple[str, Path | None]:
+        """
+        Mount the layers of an image read-write on work_path, with a new empty
+        upper layer.
+
+        This needs to be called with root privileges, holding the image lock.
+
+        :returns: the ID of the new layer, and the overlayfs work directory to
+          remove after unmounting
+        """
+        stack = self.read_stack(name)
+        assert stack is not None
+        layer = self.new_layer()
+        work_path.mkdir(mode=0o755)
+        try:
+            work = self._mount(stack.layers, work_path, upper=layer)
+        except BaseException:
+            work_path.rmdir()
+            self.trash.discard(self.layer_path(layer))
+            raise
+        return layer, work
+
+    def commit(self, name: str, layer: str) -> None:
+        """
+        Add a layer to an image, after a successful update.
+
+        This needs to be called with root privileges, holding the image lock.
+        """
+        stack = self.read_stack(name)
+        assert stack is not None
+        stack = stack._replace(layers=stack.layers + [layer])
+        if len(stack.own) > self.MAX_OWN_LAYERS:
+            stack = self.squash(name, stack)
+        self.write_stack(name, stack)
+        self.mount(name)
+
+    def squash(self, name: str, stack: LayerStack) -> LayerStack:
+        """
+        Merge all the layers of an image added by updates into a new layer.
+
+        The first layer of the image is kept, since it is usually the largest.
+        """
+        first, *updates = stack.own
+        log.info("%s: merging %d update layers", name, len(updates))
+        layer = uuid.uuid4().hex
+        _copy(self.layer_path(updates[0]), self.layer_path(layer))
+        for update in updates[1:]:
+            merge_layer(self.layer_path(update), self.layer_path(layer))
+        return stack._replace(
+            layers=stack.layers[: stack.inherited] + [first, layer]
+        )
+
+    def remove(self, name: str) -> None:
+        """
+        Remove a layered image, leaving its layers to :meth:`prune`.
+
+        This needs to be called with root privileges.
+        """
+        self.umount(self.imagedir / name)
+        self.stack_path(name).unlink(missing_ok=True)
+
+    def discard_work(self, work: Path | None) -> None:
+        """Remove an overlayfs work directory."""
+        if work is not None and work.exists():
+            self.trash.discard(work)
+
+    def prune(self) -> list[str]:
+        """
+        Move the layers that are not used by any image to the trash.
+
+        Layers used by mounts in the host are kept, but containers still
+        running on a previous version of an image are not detected.
+        This needs to be called with root privileges.
+
+        :returns: the IDs of the removed layers
+        """
+        used: set[str] = set()
+        try:
+            stacks = list(self.stacks_path.glob("*.json"))
+        except FileNotFoundError:
+            stacks = []
+        for path in stacks:
+            if (stack := self.read_stack(path.name[:-5])) is not None:
+                used.update(stack.layers)
+        # Layer IDs are unique, so they can be looked up in the mount table
+        # to find layers used by mounts, like updates in progress
+        mountinfo = Path("/proc/self/mountinfo").read_text()
+        res: list[str] = []
+        try:
+            layers = sorted(p.name for p in self.data_path.iterdir())
+        except FileNotFoundError:
+            return res
+        for layer in layers:
+            if layer in used or layer in mountinfo:
+                continue
+            log.info("%s: removing unused layer", layer)
+            self.trash.discard(self.layer_path(layer))
+            res.append(layer)
+        return res
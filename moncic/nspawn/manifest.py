@@ -0,0 +1,264 @@
+"""
+Cached information about the images in an image directory
+"""
+
+import contextlib
+import json
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, NamedTuple
+
+from moncic import context
+from moncic.utils.btrfs import get_subvolume_info
+
+log = logging.getLogger("images.manifest")
+
+
+class ManifestEntry(NamedTuple):
+    """Cached information about an image."""
+
+    #: Image name
+    name: str
+    #: Full name of the image distribution
+    distro: str
+    #: Backend ID of the image
+    backend_id: str
+    #: Time of the last update of the image
+    updated: float
+    #: State of the image directory when the entry was recorded
+    fingerprint: tuple[int, ...]
+
+
+class Manifest:
+    """
+    Index of the images in an image directory.
+
+    Looking up an image normally needs reading its ``/etc/os-release`` with
+    root privileges: the manifest caches the results, and checks their
+    validity with a quick ``stat()`` of the image directory, and the btrfs
+    subvolume generation when available.
+
+    The manifest is stored in ``.manifest/images.json`` in the image directory.
+    It is only a cache: it is ignored if it cannot be read or written, and it
+    can be safely deleted.
+    """
+
+    #: Name of the manifest directory inside the image directory
+    DIRNAME = ".manifest"
+
+    #: Name of the manifest file inside :attr:`DIRNAME`
+    FILENAME = "images.json"
+
+    #: Version of the manifest format. Manifests with a different version are
+    #: ignored
+    VERSION = 1
+
+    def __init__(self, imagedir: Path) -> None:
+        self.imagedir = imagedir
+        #: Directory containing the manifest file. It is a subdirectory so that
+        #: writing the manifest does not change the modification time of the
+        #: image directory
+        self.dir = imagedir / self.DIRNAME
+        self.path = self.dir / self.FILENAME
+        self.loaded = False
+        self.entries: dict[str, ManifestEntry] = {}
+        #: Cached list of image names
+        self.names: list[str] | None = None
+        #: Modification time of the image directory when names was computed
+        self.names_mtime: int | None = None
+
+    def _privileged(self) -> contextlib.AbstractContextManager[None]:
+        """
+        Use root privileges to write the manifest, if they can be regained
+        without running sudo.
+        """
+        if context.privs.have_sudo:
+            return context.privs.root()
+        return contextlib.nullcontext()
+
+    def fingerprint(self, path: Path) -> tuple[int, ...]:
+        """
+        Compute a fingerprint of the state of an image directory.
+
+        The fingerprint changes when the image is replaced or modified at the
+        top level and, on btrfs, when anything is modified in its subvolume.
+        """
+        st = path.stat()
+        if (info := get_subvolume_info(path)) is not None:
+            generation = info.generation
+        else:
+            generation = 0
+        return (st.st_dev, st.st_ino, st.st_mtime_ns, generation)
+
+    def load(self) -> None:
+        """Load the manifest from disk, if not already loaded."""
+        if self.loaded:
+            return
+        self.loaded = True
+        try:
+            with self.path.open() as fd:
+                data = json.load(fd)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log.debug("%s: cannot read manifest: %s", self.path, e)
+            return
+        if not isinstance(data, dict) or data.get("version") != self.VERSION:
+            log.debug("%s: ignoring manifest with wrong version", self.path)
+            return
+        try:
+            for name, info in data["images"].items():
+                self.entries[name] = ManifestEntry(
+                    name=name,
+                    distro=info["distro"],
+                    backend_id=info["backend_id"],
+                    updated=info["updated"],
+                    fingerprint=tuple(info["fingerprint"]),
+                )
+            if (names := data.get("names")) is not None:
+                self.names = list(names)
+                self.names_mtime = data["names_mtime"]
+        except (KeyError, TypeError, AttributeError) as e:
+            log.debug("%s: ignoring invalid manifest: %s", self.path, e)
+            self.entries = {}
+            self.names = None
+            self.names_mtime = None
+
+    def save(self) -> None:
+        """Atomically write the manifest to disk, if possible."""
+        data: dict[str, Any] = {
+            "version": self.VERSION,
+            "images": {
+                name: {
+                    "distro": entry.distro,
+                    "backend_id": entry.backend_id,
+                    "updated": entry.updated,
+                    "fingerprint": list(entry.fingerprint),
+                }
+                for name, entry in self.entries.items()
+            },
+        }
+        if self.names is not None:
+            data["names"] = self.names
+            data["names_mtime"] = self.names_mtime
+        try:
+            with self._privileged():
+                self._write(data)
+        except OSError as e:
+            log.debug("%s: cannot write manifest: %s", self.path, e)
+
+    def _write(self, data: dict[str, Any]) -> None:
+        """Atomically write the manifest data."""
+        self.dir.mkdir(exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "wt", dir=self.dir, prefix=".images.", delete=False
+        ) as fd:
+            try:
+                json.dump(data, fd)
+                fd.flush()
+                os.chmod(fd.name, 0o644)
+                os.rename(fd.name, self.path)
+            except BaseException:
+                os.unlink(fd.name)
+                raise
+
+    def list_names(self) -> list[str]:
+        """
+        List the names of the images in the image directory.
+
+        The directory is only scanned if its modification time changed since
+        the last time.
+        """
+        self.load()
+        # Make sure that creating the manifest directory later does not
+        # change the modification time of the image directory
+        if not self.dir.exists():
+            try:
+                with self._privileged():
+                    self.dir.mkdir(exist_ok=True)
+            except OSError:
+                pass
+        mtime = self.imagedir.stat().st_mtime_ns
+        if self.names is not None and self.names_mtime == mtime:
+            return list(self.names)
+        names: list[str] = []
+        for path in self.imagedir.iterdir():
+            if path.name.startswith(".") or not path.is_dir():
+                continue
+            names.append(path.name)
+        names.sort()
+        self.names = names
+        self.names_mtime = mtime
+        self.save()
+        return list(names)
+
+    def lookup(self, name: str) -> ManifestEntry | None:
+        """
+        Return the cached information about an image.
+
+        :returns: None if the image is not in the manifest, or if the cached
+          information is out of date
+        """
+        self.load()
+        if (entry := self.entries.get(name)) is None:
+            return None
+        try:
+            fingerprint = self.fingerprint(self.imagedir / name)
+        except OSError:
+            return None
+        if fingerprint != entry.fingerprint:
+            return None
+        return entry
+
+    def record(
+        self,
+        name: str,
+        distro: str,
+        *,
+        updated: float | None = None,
+    ) -> ManifestEntry | None:
+        """
+        Store information about an image.
+
+        :param updated: time of the last update of the image. Default: the
+          modification time of the image directory
+        :returns: the new entry, or None if the image cannot be accessed
+        """
+        self.load()
+        path = self.imagedir / name
+        try:
+            fingerprint = self.fingerprint(path)
+            if updated is None:
+                updated = path.stat().st_mtime
+        except OSError as e:
+            log.debug("%s: cannot record in manifest: %s", path, e)
+            return None
+        entry = ManifestEntry(
+            name=name,
+            distro=distro,
+            backend_id=path.absolute().as_posix(),
+            updated=updated,
+            fingerprint=fingerprint,
+        )
+        self.entries[name] = entry
+        self.save()
+        return entry
+
+    def record_update(self, name: str, distro: str) -> ManifestEntry | None:
+        """
+        Store information about an image that has just been created or
+        updated.
+
+        Disk usage is not stored: it is computed when requested, taking
+        extents shared between images into account.
+        """
+        return self.record(name, distro, updated=time.time())
+
+    def forget(self, name: str) -> None:
+        """Remove an image from the manifest."""
+        self.load()
+        if self.entries.pop(name, None) is not None:
+            self.save()
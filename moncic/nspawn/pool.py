@@ -0,0 +1,220 @@
+"""
+Pool of pre-created snapshots of btrfs images, used to quickly start
+ephemeral containers
+"""
+
+import argparse
+import errno
+import logging
+import subprocess
+import sys
+import uuid
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from moncic.utils.btrfs import Subvolume, get_subvolume_info
+from moncic.utils.run import spawn_detached
+
+from .trash import Trash, flock
+
+if TYPE_CHECKING:
+    from moncic.moncic import MoncicConfig
+
+log = logging.getLogger("images.pool")
+
+
+class SnapshotPool:
+    """
+    Writable snapshots of an image, created in advance.
+
+    Snapshots are stored in ``.pool/<image name>/`` inside the image directory.
+    A container claims a snapshot by atomically renaming it out of the pool,
+    and the snapshot is discarded when the container stops.
+
+    A snapshot is only used if it was taken from the current version of the
+    image: stale snapshots are discarded.
+    """
+
+    #: Name of the directory with snapshot pools inside the image directory
+    DIRNAME = ".pool"
+
+    #: Name of the directory with claimed snapshots inside :attr:`DIRNAME`
+    CLAIMED_DIRNAME = ".claimed"
+
+    #: Name of the file with the output of background refills, in the image
+    #: directory
+    LOGNAME = ".pool.log"
+
+    def __init__(
+        self, mconfig: "MoncicConfig", trash: Trash, name: str, size: int
+    ) -> None:
+        self.mconfig = mconfig
+        #: Trash of the image directory
+        self.trash = trash
+        #: Image directory
+        self.imagedir = trash.imagedir
+        #: Name of the image
+        self.name = name
+        #: Number of snapshots to keep ready
+        self.size = size
+        #: Path of the image
+        self.image_path = self.imagedir / name
+        #: Directory with the snapshots
+        self.path = self.imagedir / self.DIRNAME / name
+        #: Directory where claimed snapshots are moved
+        self.claimed_path = self.imagedir / self.DIRNAME / self.CLAIMED_DIRNAME
+
+    def _is_current(self, path: Path, image_uuid: bytes) -> bool:
+        """Check if the snapshot has been taken from the current image."""
+        info = get_subvolume_info(path)
+        if info is None:
+            return False
+        return info.parent_uuid == image_uuid
+
+    def claim(self, instance_name: str) -> Path | None:
+        """
+        Take a snapshot out of the pool.
+
+        This needs to be called with root privileges.
+
+        :returns: the path to the snapshot, or None if no valid snapshot is
+          available
+        """
+        image_info = get_subvolume_info(self.image_path)
+        if image_info is None:
+            return None
+        try:
+            candidates = sorted(self.path.iterdir())
+        except FileNotFoundError:
+            return None
+        self.claimed_path.mkdir(mode=0o700, exist_ok=True)
+        for candidate in candidates:
+            if not self._is_current(candidate, image_info.uuid):
+                log.debug("%s: discarding stale snapshot", candidate)
+                try:
+                    self.trash.discard(candidate)
+                except FileNotFoundError:
+                    # Claimed by someone else in the meantime
+                    pass
+                continue
+            dest = self.claimed_path / f"{instance_name}.{candidate.name}"
+            try:
+                candidate.rename(dest)
+            except FileNotFoundError:
+                # Claimed by someone else in the meantime
+                continue
+            log.debug("%s: claimed snapshot %s", self.name, dest)
+            return dest
+        return None
+
+    def release(self, path: Path) -> None:
+        """
+        Discard a claimed snapshot.
+
+        This needs to be called with root privileges.
+        """
+        self.trash.discard(path)
+        self.trash.spawn_collector()
+
+    def refill(self) -> None:
+        """
+        Create snapshots until the pool is full.
+
+        This needs to be called with root privileges.
+        """
+        if self.size <= 0 or not self.image_path.exists():
+            return
+        try:
+            self._refill()
+        except (OSError, subprocess.CalledProcessError) as e:
+            log.warning("%s: cannot refill snapshot pool: %s", self.name, e)
+
+    def spawn_refill(self) -> None:
+        """
+        Start a background process to refill the pool.
+
+        The process is detached, and keeps running after Moncic-CI exits. This
+        needs to be called with root privileges.
+        """
+        if self.size <= 0:
+            return
+        try:
+            spawn_detached(
+                [
+                    sys.executable,
+                    "-m",
+                    "moncic.nspawn.pool",
+                    self.imagedir.as_posix(),
+                    self.name,
+                    str(self.size),
+                ],
+                self.imagedir / self.LOGNAME,
+            )
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.EACCES):
+                raise
+            log.warning(
+                "%s: cannot start background snapshot pool refill: %s",
+                self.name,
+                e,
+            )
+
+    def _refill(self) -> None:
+        """Create snapshots until the pool is full."""
+        self.path.mkdir(mode=0o700, parents=True, exist_ok=True)
+        lock_path = self.path.parent / f".{self.name}.lock"
+        with flock(lock_path, blocking=False) as ok:
+            if not ok:
+                # Someone else is refilling the pool
+                return
+            image_info = get_subvolume_info(self.image_path)
+            if image_info is None:
+                return
+            count = 0
+            for path in self.path.iterdir():
+                if self._is_current(path, image_info.uuid):
+                    count += 1
+                else:
+                    self.trash.discard(path)
+            for _ in range(count, self.size):
+                subvolume = Subvolume(
+                    self.mconfig,
+                    self.path / uuid.uuid4().hex,
+                    None,
+                )
+                subvolume.snapshot(self.image_path)
+                log.debug("%s: created snapshot %s", self.name, subvolume.path)
+
+    def invalidate(self) -> None:
+        """
+        Discard all snapshots in the pool.
+
+        This needs to be called with root privileges.
+        """
+        if self.path.exists():
+            self.trash.discard(self.path)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Create ready snapshots of an OS image"
+    )
+    parser.add_argument("imagedir", help="image directory")
+    parser.add_argument("name", help="image name")
+    parser.add_argument("size", type=int, help="number of snapshots")
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.WARNING,
+        format="%(asctime)s %(process)d %(levelname)s %(message)s",
+    )
+    from moncic.moncic import MoncicConfig
+
+    mconfig = MoncicConfig()
+    trash = Trash(mconfig, Path(args.imagedir))
+    SnapshotPool(mconfig, trash, args.name, args.size).refill()
+    # Stale snapshots may have been moved to the trash
+    trash.collect()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+Cache of compressed root filesystems of freshly bootstrapped distributions
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import time
+import uuid
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, NamedTuple
+
+from moncic.distro import Distro
+
+if TYPE_CHECKING:
+    from moncic.moncic import MoncicConfig
+
+log = logging.getLogger("images.tarballs")
+
+#: tar options to preserve all file metadata of a root filesystem
+TAR_OPTIONS = [
+    "--numeric-owner",
+    "--xattrs",
+    "--xattrs-include=*",
+    "--acls",
+]
+
+
+def compress_command() -> str:
+    """Return the zstd compression command to use with ``tar -I``."""
+    # pzstd writes independent frames, that it can later decompress in
+    # parallel
+    if shutil.which("pzstd"):
+        return "pzstd -q -3"
+    return "zstd -q -3 -T0"
+
+
+def decompress_command() -> str:
+    """Return the zstd decompression command to use with ``tar -I``."""
+    if shutil.which("pzstd"):
+        return "pzstd -q"
+    return "zstd -q -T0"
+
+
+def package_set_hash(distro: Distro) -> str:
+    """
+    Compute a hash of what determines the contents of a freshly bootstrapped
+    distribution.
+    """
+    data = {
+        "distro": distro.full_name,
+        "packages": sorted(distro.get_base_packages()),
+        "mirror": getattr(distro, "mirror", None),
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+class TarballInfo(NamedTuple):
+    """Metadata of a cached tarball."""
+
+    #: Full name of the distribution
+    distro: str
+    #: Time when the tarball was created
+    created: float
+    #: Hash of the package set, see :func:`package_set_hash`
+    packages_hash: str
+
+
+class TarballCache:
+    """
+    Compressed root filesystems of distributions, created after bootstrapping
+    a distribution from scratch, and used to quickly bootstrap it again.
+
+    Tarballs are compressed with zstd, and stored in ``.tarballs/`` in the
+    image directory, each with a JSON file of metadata. A tarball is used only
+    if the package set to bootstrap has not changed since it was created, and
+    if it is not older than the configured maximum age.
+    """
+
+    #: Name of the tarball cache directory inside the image directory
+    DIRNAME = ".tarballs"
+
+    def __init__(self, mconfig: "MoncicConfig", imagedir: Path) -> None:
+        self.mconfig = mconfig
+        self.path = imagedir / self.DIRNAME
+
+    @property
+    def enabled(self) -> bool:
+        """Check if the cache is enabled in the configuration."""
+        return self.mconfig.bootstrap_cache_max_age > 0
+
+    def tarball_path(self, distro: Distro) -> Path:
+        """Return the path of the cached tarball for a distribution."""
+        return self.path / f"{distro.full_name.replace(':', '_')}.tar.zst"
+
+    def info_path(self, distro: Distro) -> Path:
+        """Return the path of the metadata for a distribution tarball."""
+        return self.tarball_path(distro).with_suffix(".json")
+
+    def read_info(self, distro: Distro) -> TarballInfo | None:
+        """Read the metadata of a cached tarball."""
+        try:
+            with self.info_path(distro).open() as fd:
+                data = json.load(fd)
+            return TarballInfo(
+                distro=data["distro"],
+                created=data["created"],
+                packages_hash=data["packages_hash"],
+            )
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.warning("%s: cannot read tarball metadata: %s", distro, e)
+            return None
+
+    def lookup(self, distro: Distro) -> Path | None:
+        """
+        Return the path of a valid cached tarball for the distribution.
+
+        :returns: None if there is no valid tarball
+        """
+        if not self.enabled:
+            return None
+        path = self.tarball_path(distro)
+        if not path.exists():
+            return None
+        if (info := self.read_info(distro)) is None:
+            return None
+        if info.packages_hash != package_set_hash(distro):
+            log.info("%s: package set changed, not using %s", distro, path)
+            return None
+        age = time.time() - info.created
+        max_age = self.mconfig.bootstrap_cache_max_age * 86400
+        if age > max_age:
+            log.info(
+                "%s: %s is %.1f days old, refreshing it",
+                distro,
+                path,
+                age / 86400,
+            )
+            return None
+        return path
+
+    def extract(self, path: Path, dest: Path) -> None:
+        """
+        Extract a cached tarball into a directory.
+
+        If extraction fails, the tarball is removed from the cache and dest is
+        emptied, ready for bootstrapping from scratch. This needs to be called
+        with root privileges.
+        """
+        cmd = ["tar", "-C", dest.as_posix()] + TAR_OPTIONS
+        cmd += ["-I", decompress_command(), "-xf", path.as_posix()]
+        log.info("%s: extracting cached root filesystem", path)
+        try:
+            subprocess.run(cmd, check=True)
+        except subprocess.CalledProcessError:
+            # Do not try to use a broken tarball again
+            log.warning("%s: extraction failed, removing from cache", path)
+            path.with_suffix(".json").unlink(missing_ok=True)
+            path.unlink(missing_ok=True)
+            for entry in dest.iterdir():
+                if entry.is_dir() and not entry.is_symlink():
+                    shutil.rmtree(entry)
+                else:
+                    entry.unlink()
+            raise
+
+    def store(self, distro: Distro, root: Path) -> None:
+        """
+        Store a tarball of a freshly bootstrapped root filesystem.
+
+        Failures are logged and otherwise ignored. This needs to be called with
+        root privileges.
+        """
+        if not self.enabled:
+            return
+        if not shutil.which("zstd") and not shutil.which("pzstd"):
+            log.info("%s: zstd not found, not caching root filesystem", distro)
+            return
+        path = self.tarball_path(distro)
+        tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+        info = TarballInfo(
+            distro=distro.full_name,
+            created=time.time(),
+            packages_hash=package_set_hash(distro),
+        )
+        try:
+            self.path.mkdir(mode=0o700, exist_ok=True)
+            cmd = ["tar", "-C", root.as_posix()] + TAR_OPTIONS
+            cmd += ["-I", compress_command(), "-cf", tmp_path.as_posix()]
+            cmd.append(".")
+            log.info("%s: caching root filesystem in %s", distro, path)
+            subprocess.run(cmd, check=True)
+            # Remove stale metadata first, so that the old metadata is never
+            # paired with the new tarball
+            self.info_path(distro).unlink(missing_ok=True)
+            tmp_path.rename(path)
+            self._write_info(distro, info)
+        except (OSError, subprocess.CalledProcessError) as e:
+            log.warning("%s: cannot cache root filesystem: %s", distro, e)
+            tmp_path.unlink(missing_ok=True)
+
+    def _write_info(self, distro: Distro, info: TarballInfo) -> None:
+        """Atomically write the metadata of a cached tarball."""
+        path = self.info_path(distro)
+        tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+        data: dict[str, Any] = info._asdict()
+        with tmp_path.open("w") as fd:
+            json.dump(data, fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+        tmp_path.rename(path)
@@ -0,0 +1,76 @@
+import logging
+import os
+import pwd
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from typing import override
+
+from moncic.nspawn.agent import AGENT_SOURCE, GuestAgent
+from moncic.nspawn.guest_agent import credentials
+from moncic.runner import UserConfig
+
+
+class TestGuestAgent(unittest.TestCase):
+    @override
+    def setUp(self) -> None:
+        super().setUp()
+        self.workdir = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        socket_path = self.workdir / "agent.sock"
+        proc = subprocess.Popen(
+            [sys.executable, AGENT_SOURCE.as_posix(), socket_path.as_posix()]
+        )
+        self.addCleanup(proc.wait)
+        self.addCleanup(proc.kill)
+        deadline = time.monotonic() + 10
+        while not socket_path.exists():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        self.agent = GuestAgent(logging.getLogger("test"), socket_path)
+        self.user = UserConfig("test", os.getuid(), "test", os.getgid())
+
+    def test_run(self) -> None:
+        with self.assertLogs("test") as logs:
+            res = self.agent.run(
+                ["sh", "-c", "pwd; echo err >&2; printf partial"],
+                cwd=self.workdir,
+                user=self.user,
+            )
+        self.assertEqual(res.returncode, 0)
+        self.assertEqual(res.stdout, f"{self.workdir}\npartial".encode())
+        self.assertEqual(res.stderr, b"err\n")
+        self.assertIn(f"INFO:test:stdout: {self.workdir}", logs.output)
+        self.assertIn("INFO:test:stdout: partial", logs.output)
+        self.assertIn("INFO:test:stderr: err", logs.output)
+
+    def test_exit_status(self) -> None:
+        res = self.agent.run(
+            ["sh", "-c", "exit 3"], user=self.user, check=False
+        )
+        self.assertEqual(res.returncode, 3)
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.agent.run(["false"], user=self.user)
+
+    def test_not_found(self) -> None:
+        res = self.agent.run(["/does-not-exist"], user=self.user, check=False)
+        self.assertEqual(res.returncode, 203)
+        self.assertIn(b"/does-not-exist", res.stderr)
+
+    def test_groups(self) -> None:
+        name = pwd.getpwuid(os.getuid()).pw_name
+        groups = os.getgrouplist(name, os.getgid())
+        res = self.agent.run(["id", "-G"], user=self.user)
+        self.assertEqual(
+            sorted(int(g) for g in res.stdout.split()), sorted(set(groups))
+        )
+
+    def test_credentials(self) -> None:
+        # Credentials are computed before forking, and dropped without
+        # running python code in the child
+        kwargs = credentials(os.getuid(), os.getgid())
+        self.assertNotIn("preexec_fn", kwargs)
+        self.assertEqual(kwargs["user"], os.getuid())
+        self.assertEqual(kwargs["group"], os.getgid())
@@ -0,0 +1,134 @@
+import os
+import stat
+import tempfile
+import unittest
+from pathlib import Path
+from typing import override
+
+from moncic.moncic import MoncicConfig
+from moncic.nspawn.layers import (
+    LayerStack,
+    LayerStore,
+    is_mounted,
+    merge_layer,
+)
+from moncic.nspawn.trash import Trash
+
+
+def make_whiteout(path: Path) -> None:
+    try:
+        os.mknod(path, stat.S_IFCHR | 0o000, os.makedev(0, 0))
+    except PermissionError:
+        raise unittest.SkipTest("creating whiteouts needs CAP_MKNOD")
+
+
+class TestMergeLayer(unittest.TestCase):
+    @override
+    def setUp(self) -> None:
+        super().setUp()
+        self.workdir = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        self.lower = self.workdir / "lower"
+        self.upper = self.workdir / "upper"
+        self.lower.mkdir()
+        self.upper.mkdir()
+
+    def test_files(self) -> None:
+        (self.lower / "etc").mkdir()
+        (self.lower / "etc" / "kept").write_text("lower")
+        (self.lower / "etc" / "changed").write_text("lower")
+        (self.upper / "etc").mkdir(mode=0o750)
+        (self.upper / "etc" / "changed").write_text("upper")
+        (self.upper / "etc" / "added").write_text("upper")
+        (self.upper / "usr").mkdir()
+        (self.upper / "usr" / "file").write_text("upper")
+        os.symlink("etc", self.upper / "link")
+
+        merge_layer(self.upper, self.lower)
+
+        self.assertEqual((self.lower / "etc" / "kept").read_text(), "lower")
+        self.assertEqual((self.lower / "etc" / "changed").read_text(), "upper")
+        self.assertEqual((self.lower / "etc" / "added").read_text(), "upper")
+        self.assertEqual((self.lower / "usr" / "file").read_text(), "upper")
+        self.assertEqual(os.readlink(self.lower / "link"), "etc")
+        self.assertEqual(
+            stat.S_IMODE((self.lower / "etc").stat().st_mode), 0o750
+        )
+
+    def test_type_change(self) -> None:
+        (self.lower / "dir").mkdir()
+        (self.lower / "dir" / "file").write_text("lower")
+        (self.lower / "file").write_text("lower")
+        (self.upper / "dir").write_text("upper")
+        (self.upper / "file").mkdir()
+
+        merge_layer(self.upper, self.lower)
+
+        self.assertEqual((self.lower / "dir").read_text(), "upper")
+        self.assertTrue((self.lower / "file").is_dir())
+
+    def test_whiteout(self) -> None:
+        (self.lower / "dir").mkdir()
+        (self.lower / "dir" / "file").write_text("lower")
+        make_whiteout(self.upper / "dir")
+
+        merge_layer(self.upper, self.lower)
+
+        # The whiteout is kept, to hide the file in lower layers
+        st = (self.lower / "dir").lstat()
+        self.assertTrue(stat.S_ISCHR(st.st_mode))
+        self.assertEqual(st.st_rdev, 0)
+
+
+class TestIsMounted(unittest.TestCase):
+    def test_is_mounted(self) -> None:
+        self.assertTrue(is_mounted(Path("/")))
+        self.assertTrue(is_mounted(Path("/proc")))
+        with tempfile.TemporaryDirectory() as workdir:
+            self.assertFalse(is_mounted(Path(workdir)))
+
+
+class TestLayerStore(unittest.TestCase):
+    @override
+    def setUp(self) -> None:
+        super().setUp()
+        self.imagedir = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        self.trash = Trash(MoncicConfig(), self.imagedir)
+        self.store = LayerStore(self.imagedir, self.trash)
+
+    def test_stack(self) -> None:
+        self.assertFalse(self.store.is_layered("test"))
+        self.assertIsNone(self.store.read_stack("test"))
+
+        stack = LayerStack(layers=["a", "b", "c"], inherited=2)
+        self.assertEqual(stack.own, ["c"])
+        self.store.write_stack("test", stack)
+        self.assertTrue(self.store.is_layered("test"))
+        self.assertEqual(self.store.read_stack("test"), stack)
+
+    def test_squash(self) -> None:
+        layers = [self.store.new_layer() for _ in range(4)]
+        base, first, *updates = layers
+        (self.store.layer_path(updates[0]) / "file").write_text("1")
+        (self.store.layer_path(updates[0]) / "old").write_text("1")
+        (self.store.layer_path(updates[1]) / "file").write_text("2")
+
+        stack = self.store.squash("test", LayerStack(layers, inherited=1))
+
+        self.assertEqual(len(stack.layers), 3)
+        self.assertEqual(stack.layers[:2], [base, first])
+        merged = self.store.layer_path(stack.layers[2])
+        self.assertEqual((merged / "file").read_text(), "2")
+        self.assertEqual((merged / "old").read_text(), "1")
+        # Squashed layers are not modified
+        self.assertEqual(
+            (self.store.layer_path(updates[0]) / "file").read_text(), "1"
+        )
+
+    def test_prune(self) -> None:
+        used = self.store.new_layer()
+        unused = self.store.new_layer()
+        self.store.write_stack("test", LayerStack([used], inherited=0))
+
+        self.assertEqual(self.store.prune(), [unused])
+        self.assertTrue(self.store.layer_path(used).exists())
+        self.assertFalse(self.store.layer_path(unused).exists())
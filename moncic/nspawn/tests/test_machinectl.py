@@ -0,0 +1,47 @@
+from pathlib import Path
+from typing import override
+
+from moncic.nspawn.images import MACHINECTL_PATH, PlainMachinectlImages
+from moncic.nspawn.manifest import Manifest
+from moncic.unittest import MoncicTestCase
+
+
+class TestMachinectlImages(MoncicTestCase):
+    @override
+    def setUp(self) -> None:
+        super().setUp()
+        self.imagedir = self.workdir()
+        self.session = self.enterContext(
+            self.mock_session(self.moncic(self.config()))
+        )
+        self.images = PlainMachinectlImages(self.session)
+        self.assertEqual(self.images.imagedir, MACHINECTL_PATH)
+        # Point the images to a test directory
+        self.images.imagedir = self.imagedir
+        self.images.manifest = Manifest(self.imagedir)
+
+    def make_image(self, name: str) -> Path:
+        path = self.imagedir / name
+        (path / "etc").mkdir(parents=True)
+        return path
+
+    def test_list(self) -> None:
+        self.make_image("test")
+        (self.imagedir / "test.raw").write_bytes(b"")
+        self.assertEqual(self.images.list_images(), ["test"])
+        self.assertTrue(self.images.has_image("test"))
+        self.assertFalse(self.images.has_image("test.raw"))
+
+        # The list is cached
+        self.make_image("new")
+        self.assertFalse(self.images.has_image("new"))
+
+        # Removing an image invalidates the list
+        self.images.forget_image("test")
+        self.assertEqual(self.images.list_images(), ["new", "test"])
+
+        # So does reloading
+        self.make_image("other")
+        self.assertFalse(self.images.has_image("other"))
+        self.images.reload()
+        self.assertTrue(self.images.has_image("other"))
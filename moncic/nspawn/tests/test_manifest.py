@@ -0,0 +1,95 @@
+import os
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from typing import override
+
+from moncic.nspawn.manifest import Manifest
+
+
+class TestManifest(unittest.TestCase):
+    @override
+    def setUp(self) -> None:
+        super().setUp()
+        self.imagedir = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        self.manifest = Manifest(self.imagedir)
+
+    def make_image(self, name: str) -> Path:
+        path = self.imagedir / name
+        (path / "etc").mkdir(parents=True)
+        (path / "etc" / "os-release").write_text("ID=fedora\nVERSION_ID=34\n")
+        return path
+
+    def test_record_lookup(self) -> None:
+        path = self.make_image("test")
+        self.assertIsNone(self.manifest.lookup("test"))
+        entry = self.manifest.record("test", "fedora:34")
+        assert entry is not None
+        self.assertEqual(entry.backend_id, path.as_posix())
+        self.assertEqual(self.manifest.lookup("test"), entry)
+
+        # The manifest is persisted
+        manifest = Manifest(self.imagedir)
+        self.assertEqual(manifest.lookup("test"), entry)
+
+        # Changes to the image invalidate the entry
+        st = path.stat()
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+        self.assertIsNone(self.manifest.lookup("test"))
+
+        # So does replacing it
+        self.manifest.record("test", "fedora:34")
+        path.rename(self.imagedir / "old")
+        self.make_image("test")
+        self.assertIsNone(self.manifest.lookup("test"))
+
+    def test_record_update(self) -> None:
+        path = self.make_image("test")
+        # Make the modification time of the image differ from the update time
+        os.utime(path, (0, 0))
+        before = time.time()
+        entry = self.manifest.record_update("test", "fedora:34")
+        assert entry is not None
+        self.assertGreaterEqual(entry.updated, before)
+        self.assertEqual(self.manifest.lookup("test"), entry)
+
+    def test_forget(self) -> None:
+        self.make_image("test")
+        self.manifest.record("test", "fedora:34")
+        self.manifest.forget("test")
+        self.assertIsNone(self.manifest.lookup("test"))
+        self.assertIsNone(Manifest(self.imagedir).lookup("test"))
+
+    def test_list_names(self) -> None:
+        self.make_image("b")
+        self.make_image("a")
+        (self.imagedir / "file").write_text("")
+        (self.imagedir / ".hidden").mkdir()
+        self.assertEqual(self.manifest.list_names(), ["a", "b"])
+        self.assertEqual(Manifest(self.imagedir).list_names(), ["a", "b"])
+
+        # The cached list is used if the directory did not change
+        manifest = Manifest(self.imagedir)
+        manifest.load()
+        manifest.names = ["cached"]
+        self.assertEqual(manifest.list_names(), ["cached"])
+
+        # New images invalidate the list
+        self.make_image("c")
+        st = self.imagedir.stat()
+        os.utime(
+            self.imagedir, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000)
+        )
+        self.assertEqual(manifest.list_names(), ["a", "b", "c"])
+
+    def test_invalid(self) -> None:
+        self.make_image("test")
+        self.manifest.dir.mkdir()
+        self.manifest.path.write_text("{invalid")
+        self.assertIsNone(self.manifest.lookup("test"))
+        self.assertIsNotNone(self.manifest.record("test", "fedora:34"))
+        self.assertIsNotNone(Manifest(self.imagedir).lookup("test"))
+
+        self.manifest.path.write_text('{"version": 0, "images": {}}')
+        self.assertIsNone(Manifest(self.imagedir).lookup("test"))
@@ -0,0 +1,125 @@
+import os
+import shutil
+import subprocess
+from pathlib import Path
+from typing import override
+from unittest import mock, skipIf
+
+from moncic.container import ContainerConfig, RunConfig
+from moncic.nspawn.container import (
+    KEEPALIVE_COMMAND,
+    NspawnContainer,
+    nsenter_command,
+)
+from moncic.nspawn.image import NspawnImage
+from moncic.nspawn.images import PlainImages
+from moncic.provision.config import ContainerInfo
+from moncic.runner import UserConfig
+from moncic.unittest import MoncicTestCase
+from moncic.utils.process import process_cgroup
+
+
+class TestNoBoot(MoncicTestCase):
+    @override
+    def setUp(self) -> None:
+        super().setUp()
+        mconfig = self.config()
+        assert mconfig.imagedir is not None
+        self.imagedir: Path = mconfig.imagedir
+        self.session = self.enterContext(
+            self.mock_session(self.moncic(mconfig))
+        )
+        self.images = PlainImages(self.session, self.imagedir)
+        os_release = self.imagedir / "test" / "etc" / "os-release"
+        os_release.parent.mkdir(parents=True)
+        os_release.write_text("ID=rocky\nVERSION_ID=9\n")
+
+    def container(self, config: ContainerConfig) -> NspawnContainer:
+        image = self.images.image("test")
+        assert isinstance(image, NspawnImage)
+        container = NspawnContainer(image, config=config)
+        container.scriptdir = self.workdir()
+        return container
+
+    def test_use_boot(self) -> None:
+        config = ContainerConfig()
+        container = self.container(config)
+        self.assertTrue(container._use_boot())
+
+        # Image configuration
+        with mock.patch.object(
+            container.image,
+            "get_container_info",
+            return_value=ContainerInfo(boot=False),
+        ):
+            self.assertFalse(container._use_boot())
+
+            # Per invocation configuration wins over the image
+            config.boot = True
+            self.assertTrue(container._use_boot())
+
+        config.boot = False
+        self.assertFalse(container._use_boot())
+
+        # Maintenance containers always boot
+        container.ephemeral = False
+        self.assertTrue(container._use_boot())
+
+    def test_start_command(self) -> None:
+        config = ContainerConfig()
+        cmd = self.container(config).get_start_command(Path("/image"))
+        self.assertIn("--boot", cmd)
+        self.assertNotIn("--as-pid2", cmd)
+
+        config.boot = False
+        cmd = self.container(config).get_start_command(Path("/image"))
+        self.assertNotIn("--boot", cmd)
+        self.assertIn("--as-pid2", cmd)
+        self.assertEqual(cmd[-len(KEEPALIVE_COMMAND) :], KEEPALIVE_COMMAND)
+        self.assertFalse(any(a.startswith("systemd.") for a in cmd))
+
+    @skipIf(
+        os.geteuid() != 0 or shutil.which("nsenter") is None,
+        "needs root and nsenter",
+    )
+    def test_nsenter(self) -> None:
+        workdir = self.workdir()
+        cmd = nsenter_command(
+            os.getpid(),
+            ["sh", "-c", 'echo "$PWD $HOME $USER $1"', "sh", "a b"],
+            cwd=workdir,
+            user=UserConfig.root(),
+        )
+        res = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        self.assertEqual(res.stdout, f"{workdir} /root root a b\n")
+
+        # The working directory defaults to /
+        cmd = nsenter_command(os.getpid(), ["pwd"])
+        res = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        self.assertEqual(res.stdout, "/\n")
+
+    def test_nsenter_cgroup(self) -> None:
+        cgroup = self.workdir()
+        (cgroup / "cgroup.procs").touch()
+        cmd = nsenter_command(1, ["true"], cgroup=cgroup)
+        # Run what precedes nsenter, which moves the command to the cgroup
+        wrapper = cmd[: cmd.index("nsenter")]
+        res = subprocess.run(
+            wrapper + ["sh", "-c", "echo $$"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        self.assertEqual((cgroup / "cgroup.procs").read_text(), res.stdout)
+
+    def test_run_command_cgroup(self) -> None:
+        config = ContainerConfig()
+        config.boot = False
+        container = self.container(config)
+        container.properties = {"Leader": str(os.getpid())}
+        cmd = container.get_run_command(["true"], RunConfig())
+        if (cgroup := process_cgroup(os.getpid())) is None:
+            self.assertEqual(cmd[0], "nsenter")
+        else:
+            self.assertEqual(cmd[4], (cgroup / "cgroup.procs").as_posix())
+            self.assertIn(f"--target={os.getpid()}", cmd)
@@ -0,0 +1,83 @@
+import sys
+from pathlib import Path
+from typing import override
+from unittest import mock
+
+from moncic.nspawn.images import BtrfsImages, PlainImages
+from moncic.nspawn.pool import SnapshotPool
+from moncic.unittest import MoncicTestCase
+
+
+class TestSnapshotPool(MoncicTestCase):
+    @override
+    def setUp(self) -> None:
+        super().setUp()
+        self.mconfig = self.config()
+        self.mconfig.snapshot_pool = 2
+        assert self.mconfig.imagedir is not None
+        self.imagedir: Path = self.mconfig.imagedir
+        self.session = self.enterContext(
+            self.mock_session(self.moncic(self.mconfig))
+        )
+        self.images = BtrfsImages(self.session, self.imagedir)
+        self.pool = SnapshotPool(
+            self.session.moncic.config, self.images.trash, "test", 2
+        )
+        os_release = self.imagedir / "test" / "etc" / "os-release"
+        os_release.parent.mkdir(parents=True)
+        os_release.write_text("ID=fedora\nVERSION_ID=34\n")
+
+    def test_paths(self) -> None:
+        self.assertEqual(self.pool.path, self.imagedir / ".pool" / "test")
+        self.assertEqual(
+            self.pool.claimed_path, self.imagedir / ".pool" / ".claimed"
+        )
+
+    def test_not_btrfs(self) -> None:
+        # Without btrfs there are no snapshots to claim or create
+        self.pool.refill()
+        self.assertIsNone(self.pool.claim("test-1"))
+        self.assertFalse(
+            self.pool.path.exists() and any(self.pool.path.iterdir())
+        )
+
+    def test_spawn_refill(self) -> None:
+        with mock.patch("moncic.nspawn.pool.spawn_detached") as spawn:
+            self.pool.spawn_refill()
+        spawn.assert_called_once_with(
+            [
+                sys.executable,
+                "-m",
+                "moncic.nspawn.pool",
+                self.imagedir.as_posix(),
+                "test",
+                "2",
+            ],
+            self.imagedir / SnapshotPool.LOGNAME,
+        )
+
+        # Nothing is started for disabled pools
+        self.pool.size = 0
+        with mock.patch("moncic.nspawn.pool.spawn_detached") as spawn:
+            self.pool.spawn_refill()
+        spawn.assert_not_called()
+
+    def test_invalidate(self) -> None:
+        (self.pool.path / "stale").mkdir(parents=True)
+        self.pool.invalidate()
+        self.assertFalse(self.pool.path.exists())
+        self.assertFalse(self.images.trash.is_empty())
+        self.assertEqual(self.images.trash.collect(), 1)
+
+        # Invalidating an empty pool does nothing
+        self.pool.invalidate()
+        self.assertTrue(self.images.trash.is_empty())
+
+    def test_size(self) -> None:
+        pool = self.images.snapshot_pool(self.images.image("test"))
+        assert pool is not None
+        self.assertEqual(pool.size, 2)
+
+    def test_plain_images(self) -> None:
+        images = PlainImages(self.session, self.imagedir)
+        self.assertIsNone(images.snapshot_pool(images.image("test")))
@@ -0,0 +1,128 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from typing import override
+
+from moncic.distro import DistroFamily
+from moncic.moncic import MoncicConfig
+from moncic.nspawn.tarballs import TarballCache, package_set_hash
+
+
+class TestTarballCache(unittest.TestCase):
+    @override
+    def setUp(self) -> None:
+        super().setUp()
+        self.imagedir = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        self.mconfig = MoncicConfig()
+        self.cache = TarballCache(self.mconfig, self.imagedir)
+        self.distro = DistroFamily.lookup_distro("rocky9")
+
+    def make_root(self) -> Path:
+        root = self.imagedir / "root"
+        (root / "etc").mkdir(parents=True)
+        (root / "etc" / "os-release").write_text("ID=rocky\nVERSION_ID=9\n")
+        os.symlink("os-release", root / "etc" / "link")
+        return root
+
+    def write_info(self, **kwargs: str | float) -> None:
+        info = {
+            "distro": self.distro.full_name,
+            "created": time.time(),
+            "packages_hash": package_set_hash(self.distro),
+        }
+        info.update(kwargs)
+        self.cache.path.mkdir(exist_ok=True)
+        self.cache.tarball_path(self.distro).write_bytes(b"")
+        self.cache.info_path(self.distro).write_text(json.dumps(info))
+
+    def test_paths(self) -> None:
+        self.assertEqual(
+            self.cache.tarball_path(self.distro),
+            self.imagedir / ".tarballs" / "rocky_9.tar.zst",
+        )
+        self.assertEqual(
+            self.cache.info_path(self.distro),
+            self.imagedir / ".tarballs" / "rocky_9.tar.json",
+        )
+
+    def test_lookup(self) -> None:
+        self.assertIsNone(self.cache.lookup(self.distro))
+
+        self.write_info()
+        self.assertEqual(
+            self.cache.lookup(self.distro), self.cache.tarball_path(self.distro)
+        )
+
+        # Changed package set
+        self.write_info(packages_hash="changed")
+        self.assertIsNone(self.cache.lookup(self.distro))
+
+        # Too old
+        self.write_info(created=time.time() - 31 * 86400)
+        self.assertIsNone(self.cache.lookup(self.distro))
+        self.mconfig.bootstrap_cache_max_age = 60
+        self.assertIsNotNone(self.cache.lookup(self.distro))
+
+        # Disabled
+        self.mconfig.bootstrap_cache_max_age = 0
+        self.assertIsNone(self.cache.lookup(self.distro))
+
+        # Invalid metadata
+        self.mconfig.bootstrap_cache_max_age = 30
+        self.cache.info_path(self.distro).write_text("{")
+        with self.assertLogs("images.tarballs", "WARNING"):
+            self.assertIsNone(self.cache.lookup(self.distro))
+
+    @unittest.skipIf(
+        not shutil.which("zstd") and not shutil.which("pzstd"),
+        "zstd not available",
+    )
+    def test_store_extract(self) -> None:
+        root = self.make_root()
+        self.cache.store(self.distro, root)
+        tarball = self.cache.lookup(self.distro)
+        assert tarball is not None
+        # No temporary files are left around
+        self.assertEqual(
+            sorted(p.name for p in self.cache.path.iterdir()),
+            ["rocky_9.tar.json", "rocky_9.tar.zst"],
+        )
+
+        dest = self.imagedir / "dest"
+        dest.mkdir()
+        self.cache.extract(tarball, dest)
+        self.assertEqual(
+            (dest / "etc" / "os-release").read_text(),
+            "ID=rocky\nVERSION_ID=9\n",
+        )
+        self.assertEqual(os.readlink(dest / "etc" / "link"), "os-release")
+
+    @unittest.skipIf(
+        not shutil.which("zstd") and not shutil.which("pzstd"),
+        "zstd not available",
+    )
+    def test_extract_failed(self) -> None:
+        self.write_info()
+        tarball = self.cache.tarball_path(self.distro)
+        tarball.write_bytes(b"not a tarball")
+        dest = self.imagedir / "dest"
+        dest.mkdir()
+        (dest / "partial").mkdir()
+        (dest / "partial" / "file").touch()
+        with self.assertLogs("images.tarballs", level="WARNING"):
+            with self.assertRaises(subprocess.CalledProcessError):
+                self.cache.extract(tarball, dest)
+        # The broken tarball is removed, and dest is left empty
+        self.assertIsNone(self.cache.lookup(self.distro))
+        self.assertFalse(tarball.exists())
+        self.assertEqual(list(dest.iterdir()), [])
+
+    def test_store_disabled(self) -> None:
+        self.mconfig.bootstrap_cache_max_age = 0
+        self.cache.store(self.distro, self.make_root())
+        self.assertFalse(self.cache.path.exists())
@@ -0,0 +1,47 @@
+import io
+import shutil
+import subprocess
+import tempfile
+import unittest
+from pathlib import Path
+
+from moncic.nspawn.tarballs import TAR_OPTIONS, compress_command
+from moncic.nspawn.transfer import ExportFormat, detect_format
+
+
+class TestDetectFormat(unittest.TestCase):
+    def test_btrfs(self) -> None:
+        src = io.BytesIO(b"btrfs-stream\0\x01\x00\x00\x00")
+        self.assertEqual(detect_format(src), ExportFormat.BTRFS)
+        self.assertEqual(src.tell(), 0)
+
+    def test_zstd(self) -> None:
+        src = io.BytesIO(b"\x28\xb5\x2f\xfd\x00\x00")
+        self.assertEqual(detect_format(src), ExportFormat.TAR_ZSTD)
+        self.assertEqual(src.tell(), 0)
+
+        # pzstd starts with a skippable frame
+        src = io.BytesIO(b"\x50\x2a\x4d\x18\x04\x00\x00\x00")
+        self.assertEqual(detect_format(src), ExportFormat.TAR_ZSTD)
+
+    def test_unknown(self) -> None:
+        for data in (b"", b"\x1f\x8b\x08\x00", b"btrfs"):
+            with self.subTest(data=data):
+                with self.assertRaises(ValueError):
+                    detect_format(io.BytesIO(data))
+
+    @unittest.skipIf(
+        not shutil.which("zstd") and not shutil.which("pzstd"),
+        "zstd not installed",
+    )
+    def test_tar_zstd(self) -> None:
+        with tempfile.TemporaryDirectory() as workdir:
+            root = Path(workdir) / "root"
+            (root / "etc").mkdir(parents=True)
+            (root / "etc" / "os-release").write_text("ID=test\n")
+            with tempfile.TemporaryFile() as out:
+                cmd = ["tar", "-C", root.as_posix()] + TAR_OPTIONS
+                cmd += ["-I", compress_command(), "-cf", "-", "."]
+                subprocess.run(cmd, stdout=out, check=True)
+                out.seek(0)
+                self.assertEqual(detect_format(out), ExportFormat.TAR_ZSTD)
@@ -0,0 +1,79 @@
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from typing import override
+
+from moncic.moncic import MoncicConfig
+from moncic.nspawn.trash import Trash, image_lock
+
+
+class TestTrash(unittest.TestCase):
+    @override
+    def setUp(self) -> None:
+        super().setUp()
+        self.imagedir = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        self.trash = Trash(MoncicConfig(), self.imagedir)
+
+    def make_image(self, name: str) -> Path:
+        path = self.imagedir / name
+        (path / "etc").mkdir(parents=True)
+        (path / "etc" / "os-release").write_text("ID=test\n")
+        return path
+
+    def test_discard(self) -> None:
+        path = self.make_image("test")
+        self.assertTrue(self.trash.is_empty())
+        discarded = self.trash.discard(path)
+        self.assertFalse(path.exists())
+        self.assertEqual(discarded.parent, self.trash.path)
+        self.assertTrue(discarded.name.startswith("test."))
+        self.assertFalse(self.trash.is_empty())
+
+        # Discarding again the same name does not conflict
+        self.make_image("test")
+        self.trash.discard(path)
+        self.assertEqual(len(list(self.trash.path.iterdir())), 2)
+
+        self.assertEqual(self.trash.collect(), 2)
+        self.assertTrue(self.trash.is_empty())
+        self.assertEqual(self.trash.collect(), 0)
+
+    def test_collect_locked(self) -> None:
+        self.trash.discard(self.make_image("test"))
+        with self.trash.lock_collection():
+            # Another collector is running
+            self.assertEqual(self.trash.collect(), 0)
+        self.assertEqual(self.trash.collect(), 1)
+
+    def test_spawn_collector(self) -> None:
+        self.trash.discard(self.make_image("test"))
+        self.trash.spawn_collector()
+        deadline = time.monotonic() + 10
+        while not self.trash.is_empty():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        # Wait for the collector to release its lock before the image
+        # directory is removed
+        with self.trash.lock_collection():
+            pass
+        # Output of the collector is kept
+        self.assertTrue((self.imagedir / Trash.LOGNAME).exists())
+
+    def test_leftovers(self) -> None:
+        self.make_image("test")
+        self.make_image("test.new")
+        self.make_image("test.tmp")
+        self.make_image("busy.new")
+        (self.imagedir / "file.new").write_text("")
+
+        with image_lock(self.imagedir, "busy"):
+            discarded = self.trash.discard_leftovers()
+
+        self.assertEqual(
+            discarded, [self.imagedir / "test.new", self.imagedir / "test.tmp"]
+        )
+        self.assertTrue((self.imagedir / "test").exists())
+        self.assertTrue((self.imagedir / "busy.new").exists())
+        self.assertTrue((self.imagedir / "file.new").exists())
+        self.assertEqual(self.trash.collect(), 2)
@@ -0,0 +1,174 @@
+import subprocess
+import time
+from pathlib import Path
+from typing import override
+from unittest import mock
+
+from moncic.container import ContainerConfig
+from moncic.nspawn.container import NspawnContainer
+from moncic.nspawn.image import NspawnImage
+from moncic.nspawn.images import PlainImages
+from moncic.nspawn.warm import WarmContainer, available_memory
+from moncic.unittest import MoncicTestCase
+
+
+class TestWarmPool(MoncicTestCase):
+    @override
+    def setUp(self) -> None:
+        super().setUp()
+        mconfig = self.config()
+        mconfig.warm_pool = 2
+        assert mconfig.imagedir is not None
+        self.imagedir: Path = mconfig.imagedir
+        self.session = self.enterContext(
+            self.mock_session(self.moncic(mconfig))
+        )
+        self.mconfig = self.session.moncic.config
+        self.images = PlainImages(self.session, self.imagedir)
+        os_release = self.imagedir / "test" / "etc" / "os-release"
+        os_release.parent.mkdir(parents=True)
+        os_release.write_text("ID=rocky\nVERSION_ID=9\n")
+
+    def image(self) -> NspawnImage:
+        image = self.images.image("test")
+        assert isinstance(image, NspawnImage)
+        return image
+
+    def test_available_memory(self) -> None:
+        available = available_memory()
+        assert available is not None
+        self.assertGreater(available, 0)
+
+    def test_disabled(self) -> None:
+        self.mconfig.warm_pool = 0
+        self.assertIsNone(self.images.warm_pool(self.image()))
+
+    def test_pool(self) -> None:
+        pool = self.images.warm_pool(self.image())
+        assert pool is not None
+        self.assertEqual(pool.size, 2)
+        self.assertIs(self.images.warm_pool(self.image()), pool)
+        self.assertIsNone(pool.claim())
+
+    def test_limits(self) -> None:
+        pool = self.images.warm_pool(self.image())
+        assert pool is not None
+
+        # Nothing is booted when over the limits
+        self.assertIsNone(pool.claim())
+        self.mconfig.warm_pool_max = 0
+        pool.refill()
+        self.assertEqual(pool.idle, [])
+
+        self.mconfig.warm_pool_max = 4
+        self.mconfig.warm_pool_min_memory = 2**40
+        pool.refill()
+        self.assertEqual(pool.idle, [])
+
+    def test_refill(self) -> None:
+        pool = self.images.warm_pool(self.image())
+        assert pool is not None
+        self.mconfig.warm_pool_max = 3
+        self.mconfig.warm_pool_min_memory = 0
+        self.addCleanup(pool.invalidate)
+        with mock.patch("moncic.nspawn.warm.WarmContainer.start"):
+            # Nothing is booted before the image is used
+            pool.refill()
+            self.assertEqual(pool.idle, [])
+
+            # A miss boots only one replacement
+            self.assertIsNone(pool.claim())
+            pool.refill()
+            self.assertEqual(len(pool.idle), 1)
+            pool.refill()
+            self.assertEqual(len(pool.idle), 1)
+
+            # Each container used boots one replacement
+            pool.idle[0].ready = True
+            warm = pool.claim()
+            assert warm is not None
+            self.addCleanup(warm.close)
+            pool.refill()
+            self.assertEqual(len(pool.idle), 1)
+
+            # Claimed containers count towards warm_pool_max
+            self.assertEqual(self.images.warm_container_count(), 2)
+            pool.idle[0].ready = True
+            warm = pool.claim()
+            assert warm is not None
+            self.addCleanup(warm.close)
+            pool.refill()
+            self.assertEqual(len(pool.idle), 1)
+            self.assertEqual(self.images.warm_container_count(), 3)
+            pool.idle[0].ready = True
+            warm = pool.claim()
+            assert warm is not None
+            self.addCleanup(warm.close)
+            pool.refill()
+            self.assertEqual(pool.idle, [])
+            self.assertEqual(self.images.warm_container_count(), 3)
+
+    def test_invalidate(self) -> None:
+        pool = self.images.warm_pool(self.image())
+        assert pool is not None
+        warm = WarmContainer(self.image())
+        workdir = warm.container.workdir
+        self.assertTrue(warm.container.scriptdir.is_dir())
+        pool.idle.append(warm)
+        self.assertEqual(self.images.warm_container_count(), 1)
+
+        # Updating the image discards warm containers
+        self.images._record_update("test")
+        self.assertEqual(pool.idle, [])
+        self.assertFalse(workdir.exists())
+
+    def test_discard_booting(self) -> None:
+        warm = WarmContainer(self.image())
+        workdir = warm.container.workdir
+        # Still booting
+        warm.process = subprocess.Popen(["sleep", "60"])
+        process = warm.process
+        self.addCleanup(process.wait)
+        commands: list[list[str]] = []
+
+        def run(cmd: list[str], **kwargs: object) -> None:
+            commands.append(cmd)
+            # Stopping the unit makes systemd-run exit
+            if cmd[0] == "systemctl":
+                process.kill()
+
+        started = time.monotonic()
+        with mock.patch("moncic.nspawn.warm.subprocess.run", side_effect=run):
+            warm.discard()
+        self.assertLess(time.monotonic() - started, 5)
+
+        # The container is killed without waiting for it to boot
+        self.assertEqual(commands[0][:2], ["machinectl", "kill"])
+        self.assertEqual(commands[0][-1], warm.name)
+        self.assertEqual(commands[1], ["systemctl", "stop", warm.unit])
+        self.assertIsNotNone(process.returncode)
+        self.assertFalse(workdir.exists())
+
+    def test_claim_before_start(self) -> None:
+        pool = self.images.warm_pool(self.image())
+        assert pool is not None
+        warm = WarmContainer(self.image())
+        warm.ready = True
+        pool.idle.append(warm)
+
+        # The warm container is claimed when creating the container, which
+        # gets its machine name from the start
+        with mock.patch.object(pool, "refill"):
+            container = NspawnContainer(self.image(), config=ContainerConfig())
+        self.assertIs(container.warm, warm)
+        self.assertEqual(container.instance_name, warm.name)
+        self.assertEqual(pool.idle, [])
+        warm.close()
+
+        # Containers with a given name do not use the warm pool
+        pool.idle.append(warm)
+        container = NspawnContainer(
+            self.image(), config=ContainerConfig(), instance_name="test"
+        )
+        self.assertIsNone(container.warm)
+        self.assertEqual(pool.idle, [warm])
@@ -0,0 +1,48 @@
+"""
+Formats used to export and import images
+"""
+
+import enum
+from typing import IO
+
+#: Magic number at the start of btrfs send streams
+BTRFS_STREAM_MAGIC = b"btrfs-stream\0"
+
+#: Magic number at the start of zstd frames
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+#: Last 3 bytes of the magic number of zstd skippable frames, which pzstd
+#: writes before each frame
+ZSTD_SKIPPABLE_MAGIC = b"\x2a\x4d\x18"
+
+
+class ExportFormat(enum.Enum):
+    """Format of an exported image."""
+
+    #: Stream created by ``btrfs send``, possibly incremental
+    BTRFS = "btrfs"
+    #: Tarball of the image root filesystem, compressed with zstd
+    TAR_ZSTD = "tar.zst"
+
+
+def detect_format(src: IO[bytes]) -> ExportFormat:
+    """
+    Detect the format of an exported image.
+
+    src needs to be seekable, and is rewound to the beginning.
+
+    :raises ValueError: if the format is not recognized
+    """
+    head = src.read(len(BTRFS_STREAM_MAGIC))
+    src.seek(0)
+    if head.startswith(BTRFS_STREAM_MAGIC):
+        return ExportFormat.BTRFS
+    if head.startswith(ZSTD_MAGIC):
+        return ExportFormat.TAR_ZSTD
+    if (
+        head[0:1]
+        and head[0] & 0xF0 == 0x50
+        and head[1:4] == ZSTD_SKIPPABLE_MAGIC
+    ):
+        return ExportFormat.TAR_ZSTD
+    raise ValueError("unrecognized exported image format")
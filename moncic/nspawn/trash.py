@@ -0,0 +1,236 @@
+"""
+Deferred removal of OS images and leftovers of interrupted maintenance
+"""
+
+import argparse
+import contextlib
+import errno
+import fcntl
+import logging
+import os
+import re
+import shutil
+import subprocess
+import sys
+import uuid
+from collections.abc import Generator
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from moncic.utils.btrfs import Subvolume, is_btrfs
+from moncic.utils.run import spawn_detached
+
+if TYPE_CHECKING:
+    from moncic.moncic import MoncicConfig
+
+log = logging.getLogger("images.trash")
+
+#: Inode number of the root directory of a btrfs subvolume
+BTRFS_FIRST_FREE_OBJECTID = 256
+
+
+@contextlib.contextmanager
+def flock(path: Path, blocking: bool = True) -> Generator[bool]:
+    """
+    Hold an exclusive lock on a lock file.
+
+    :param blocking: if False, do not wait for the lock to be available
+    :returns: True if the lock was acquired, False if blocking is False and
+      the lock is held by someone else
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+        else:
+            yield True
+    finally:
+        os.close(fd)
+
+
+def image_lock(
+    imagedir: Path, name: str, blocking: bool = True
+) -> contextlib.AbstractContextManager[bool]:
+    """Hold a lock on transactional maintenance of the named image."""
+    return flock(imagedir / f".{name}.lock", blocking=blocking)
+
+
+def is_subvolume(path: Path) -> bool:
+    """Check if path is the root of a btrfs subvolume."""
+    return path.stat().st_ino == BTRFS_FIRST_FREE_OBJECTID and is_btrfs(path)
+
+
+class Trash:
+    """
+    Area in an image directory where things to be deleted are moved.
+
+    Moving a subvolume or directory to the trash is a quick rename, and the
+    actual deletion can happen later, in a background process.
+    """
+
+    #: Name of the trash directory inside the image directory
+    DIRNAME = ".trash"
+
+    #: Name of the lock file held while collecting garbage
+    LOCKNAME = ".trash.lock"
+
+    #: Name of the file with the output of background garbage collection
+    LOGNAME = ".trash.log"
+
+    #: Match names of working directories of transactional maintenance
+    re_leftover = re.compile(r"^(.+)\.(?:new|tmp)$")
+
+    def __init__(self, mconfig: "MoncicConfig", imagedir: Path) -> None:
+        self.mconfig = mconfig
+        self.imagedir = imagedir
+        self.path = imagedir / self.DIRNAME
+
+    def discard(self, path: Path) -> Path:
+        """
+        Move path to the trash.
+
+        path needs to be in the image directory.
+
+        :returns: the new path in the trash
+        """
+        self.path.mkdir(mode=0o700, exist_ok=True)
+        dest = self.path / f"{path.name}.{uuid.uuid4().hex}"
+        path.rename(dest)
+        log.debug("%s: moved to %s", path, dest)
+        return dest
+
+    def is_empty(self) -> bool:
+        """Check if there is nothing in the trash."""
+        try:
+            with os.scandir(self.path) as it:
+                return next(it, None) is None
+        except FileNotFoundError:
+            return True
+
+    def discard_leftovers(self) -> list[Path]:
+        """
+        Move working directories left behind by interrupted transactional
+        maintenance to the trash.
+
+        Working directories of maintenance still in progress are skipped.
+
+        :returns: the paths that have been discarded
+        """
+        res: list[Path] = []
+        for path in sorted(self.imagedir.iterdir()):
+            if not (mo := self.re_leftover.match(path.name)):
+                continue
+            if not path.is_dir():
+                continue
+            with image_lock(self.imagedir, mo.group(1), blocking=False) as ok:
+                if not ok:
+                    log.debug("%s: maintenance in progress", path)
+                    continue
+                log.info(
+                    "%s: discarding leftover of interrupted maintenance", path
+                )
+                self.discard(path)
+                res.append(path)
+        return res
+
+    def lock_collection(
+        self, blocking: bool = True
+    ) -> contextlib.AbstractContextManager[bool]:
+        """Hold the garbage collection lock."""
+        return flock(self.imagedir / self.LOCKNAME, blocking=blocking)
+
+    def _delete(self, path: Path) -> None:
+        """Delete a path from the trash."""
+        if path.is_symlink() or not path.is_dir():
+            path.unlink()
+        elif is_subvolume(path):
+            Subvolume(self.mconfig, path, None).remove()
+        else:
+            # Directories can contain subvolumes, like snapshot pools
+            for entry in path.iterdir():
+                if entry.is_dir() and not entry.is_symlink():
+                    if is_subvolume(entry):
+                        Subvolume(self.mconfig, entry, None).remove()
+            shutil.rmtree(path)
+
+    def collect(self) -> int:
+        """
+        Delete everything in the trash.
+
+        If another process is already collecting garbage, return immediately.
+
+        :returns: the number of entries deleted
+        """
+        if self.is_empty():
+            return 0
+        count = 0
+        failed: set[Path] = set()
+        with self.lock_collection(blocking=False) as ok:
+            if not ok:
+                log.debug("%s: garbage collection already running", self.path)
+                return 0
+            # Loop until the trash is empty, to also collect what is added
+            # while we work
+            while True:
+                try:
+                    entries = sorted(set(self.path.iterdir()) - failed)
+                except FileNotFoundError:
+                    break
+                if not entries:
+                    break
+                for path in entries:
+                    log.info("%s: deleting", path)
+                    try:
+                        self._delete(path)
+                    except (OSError, subprocess.CalledProcessError) as e:
+                        log.warning("%s: cannot delete: %s", path, e)
+                        failed.add(path)
+                    else:
+                        count += 1
+        return count
+
+    def spawn_collector(self) -> None:
+        """
+        Start a background process to empty the trash.
+
+        The process is detached, and keeps running after Moncic-CI exits. This
+        needs to be called with root privileges.
+        """
+        if self.is_empty():
+            return
+        try:
+            # Keep a record of failures, since nobody sees the output
+            spawn_detached(
+                [
+                    sys.executable,
+                    "-m",
+                    "moncic.nspawn.trash",
+                    self.imagedir.as_posix(),
+                ],
+                self.imagedir / self.LOGNAME,
+            )
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.EACCES):
+                raise
+            log.warning("cannot start background garbage collector: %s", e)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Delete OS images moved to the trash"
+    )
+    parser.add_argument("imagedir", help="image directory")
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.WARNING,
+        format="%(asctime)s %(process)d %(levelname)s %(message)s",
+    )
+    from moncic.moncic import MoncicConfig
+
+    Trash(MoncicConfig(), Path(args.imagedir)).collect()
+
+
+if __name__ == "__main__":
+    main()
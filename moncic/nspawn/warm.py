@@ -0,0 +1,243 @@
+"""
+Pools of ephemeral containers booted in advance
+"""
+
+import logging
+import subprocess
+import tempfile
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from moncic import context
+from moncic.container import ContainerConfig
+
+from .image import NspawnImage
+
+if TYPE_CHECKING:
+    from .images import NspawnImages
+
+log = logging.getLogger("images.warm")
+
+#: Seconds to wait for a warm container to finish booting
+BOOT_TIMEOUT = 300
+
+
+def available_memory() -> int | None:
+    """
+    Return the memory available for new processes in the host, in bytes.
+
+    :returns: None if the information is not available
+    """
+    try:
+        with open("/proc/meminfo") as fd:
+            for line in fd:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class WarmContainer:
+    """
+    Ephemeral container booting in the background, which can be adopted by
+    a container about to start.
+    """
+
+    def __init__(self, image: NspawnImage) -> None:
+        from .container import NspawnContainer
+
+        self.image = image
+        self.tempdir = tempfile.TemporaryDirectory(suffix="container-workdir")
+        #: Container owning the running machine
+        self.container = NspawnContainer(
+            image, config=ContainerConfig(), use_warm_pool=False
+        )
+        self.container.workdir = Path(self.tempdir.name)
+        self.container.scriptdir = self.container.workdir / "scripts"
+        self.container.scriptdir.mkdir()
+        if image.images.session.moncic.config.guest_agent:
+            self.container.agentdir.mkdir()
+        self.process: subprocess.Popen[bytes] | None = None
+        #: Set when the container has finished booting
+        self.ready = False
+
+    @property
+    def name(self) -> str:
+        """Machine name of the container."""
+        return self.container.instance_name
+
+    @property
+    def unit(self) -> str:
+        """Name of the systemd unit running systemd-nspawn."""
+        return f"moncic-ci-{self.name}.service"
+
+    def start(self) -> None:
+        """Start booting the container, without waiting for it."""
+        from .container import DBUS_UNIT_CONFIG, systemd_run_nspawn_command
+
+        cmd = systemd_run_nspawn_command(
+            self.container.get_start_command(self.image.path),
+            self.container.unit_config() + DBUS_UNIT_CONFIG,
+            unit=self.unit,
+        )
+        log.info("%s: booting %s in the background", self.image.name, self.name)
+        with context.privs.root():
+            self.process = subprocess.Popen(
+                cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+
+    def wait_ready(self) -> bool:
+        """
+        Wait for the container to finish booting.
+
+        :returns: False if the container failed to start
+        """
+        if self.ready:
+            return True
+        assert self.process is not None
+        try:
+            _, stderr = self.process.communicate(timeout=BOOT_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+            log.warning(
+                "%s: %s did not boot in time", self.image.name, self.name
+            )
+            return False
+        if self.process.returncode != 0:
+            log.warning(
+                "%s: %s failed to start: %r", self.image.name, self.name, stderr
+            )
+            return False
+        with context.privs.root():
+            self.container.properties = self.container._read_properties()
+        self.ready = True
+        return True
+
+    def discard(self) -> None:
+        """
+        Kill the container, whether it has finished booting or not, and remove
+        its workdir.
+        """
+        if self.process is not None:
+            with context.privs.root():
+                # The filesystem of the container is ephemeral: there is no
+                # need to wait for it to boot, nor to shut it down cleanly.
+                # Killing the leader makes systemd-nspawn exit
+                subprocess.run(
+                    [
+                        "machinectl",
+                        "kill",
+                        "--kill-whom=leader",
+                        "--signal=SIGKILL",
+                        self.name,
+                    ],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+                # Wait for the unit to stop, also stopping it in case the
+                # machine was not registered yet
+                subprocess.run(
+                    ["systemctl", "stop", self.unit],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+            if self.process.returncode is None:
+                self.process.communicate()
+        self.close()
+
+    def close(self) -> None:
+        """Remove the workdir."""
+        self.tempdir.cleanup()
+
+
+class WarmPool:
+    """
+    Booted ephemeral containers of an image, ready to be used.
+
+    Containers are booted in the background, and each is used only once.
+    Containers are booted only as replacements for the ones used, so that
+    images used once in a session do not get containers booted for nothing.
+    """
+
+    def __init__(self, images: "NspawnImages", name: str, size: int) -> None:
+        self.images = images
+        #: Name of the image
+        self.name = name
+        #: Number of containers to keep ready
+        self.size = size
+        #: Containers booted or booting, in order of start
+        self.idle: list[WarmContainer] = []
+        #: Number of containers of the image requested so far
+        self.used = 0
+        #: Number of containers booted so far
+        self.started = 0
+        #: Number of booted containers taken from the pool
+        self.claimed = 0
+
+    def claim(self) -> WarmContainer | None:
+        """
+        Take a booted container from the pool.
+
+        The caller becomes responsible for shutting down the container and
+        closing it.
+
+        :returns: None if no container is available
+        """
+        self.used += 1
+        while self.idle:
+            warm = self.idle.pop(0)
+            if warm.wait_ready():
+                log.info("%s: using warm container %s", self.name, warm.name)
+                self.claimed += 1
+                return warm
+            warm.discard()
+        return None
+
+    def _can_start(self) -> bool:
+        """Check if the configured limits allow booting one more container."""
+        config = self.images.session.moncic.config
+        if self.images.warm_container_count() >= config.warm_pool_max:
+            return False
+        available = available_memory()
+        if (
+            available is not None
+            and available < config.warm_pool_min_memory * 1024 * 1024
+        ):
+            log.info(
+                "%s: not enough available memory to boot warm containers",
+                self.name,
+            )
+            return False
+        return True
+
+    def refill(self) -> None:
+        """
+        Start booting containers until the pool is full, booting at most one
+        replacement for each container requested so far.
+        """
+        image = self.images.image(self.name)
+        assert isinstance(image, NspawnImage)
+        while (
+            len(self.idle) < self.size
+            and self.started < self.used
+            and self._can_start()
+        ):
+            warm = WarmContainer(image)
+            try:
+                warm.start()
+            except BaseException:
+                warm.close()
+                raise
+            self.started += 1
+            self.idle.append(warm)
+
+    def invalidate(self) -> None:
+        """Discard all containers, for example because the image changed."""
+        idle, self.idle = self.idle, []
+        for warm in idle:
+            warm.discard()
@@ -6,7 +6,7 @@ from collections.abc import Callable, Generator
 from pathlib import Path
 from typing import ContextManager, IO, TYPE_CHECKING
 
-from moncic.container import BindType, ContainerConfig
+from moncic.container import BindType, ContainerConfig, ContainerTimings
 from moncic.runner import UserConfig
 from moncic.source.distro import DistroSource
 from moncic.utils.script import Script
@@ -70,6 +70,8 @@ class ContainerSourceOperation[SourceType: DistroSource](
         self.guest_source_path = (
             self.guest_root / "source" / self.source.path.name
         )
+        #: Time spent starting and stopping the last container used
+        self.container_timings: ContainerTimings | None = None
         #: Modular units of functionality activated on this operation
         self.plugins: list[
             Callable[[ContainerConfig], ContextManager[None]]
@@ -167,6 +169,8 @@ class ContainerSourceOperation[SourceType: DistroSource](
     def container_config(self) -> Generator[ContainerConfig]:
         """Build the container configuration for this operation."""
         config = ContainerConfig()
+        # Yield to interactive containers when sharing the host
+        config.priority = "batch"
         with contextlib.ExitStack() as stack:
             for plugin in self.plugins:
                 log.info(
@@ -216,6 +220,7 @@ class ContainerSourceOperation[SourceType: DistroSource](
             config = stack.enter_context(self.container_config())
             self.log_execution_info(config)
             with self.image.container(config=config) as container:
+                self.container_timings = container.timings
                 try:
                     yield container
                 finally:
@@ -160,6 +160,19 @@ class PodmanContainer(Container):
         if config.user is None:
             config.user = self.config.get_default_user()
 
+        podman_command = self.get_run_command(command, config)
+        if config.interactive:
+            res = subprocess.run(podman_command, check=config.check)
+        else:
+            res = self.host_run(podman_command, check=config.check)
+        return res
+
+    @override
+    def get_run_command(
+        self, command: list[str], config: RunConfig
+    ) -> list[str]:
+        assert self.container is not None
+
         podman_command = ["podman", "exec"]
         if config.interactive:
             podman_command += ["--interactive", "--tty"]
@@ -178,12 +191,7 @@ class PodmanContainer(Container):
         #     return Path("/root")
 
         podman_command.append(self.container.id)
-        podman_command += command
-        if config.interactive:
-            res = subprocess.run(podman_command, check=config.check)
-        else:
-            res = self.host_run(podman_command, check=config.check)
-        return res
+        return podman_command + command
 
     @override
     def run_script(
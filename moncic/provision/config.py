@@ -5,6 +5,7 @@ from typing import Any, IO, NamedTuple, Self, TYPE_CHECKING
 import yaml
 
 from moncic.distro import Distro
+from moncic.utils.resources import load_resources
 
 if TYPE_CHECKING:
     from moncic.image import BootstrappableImage
@@ -96,6 +97,30 @@ class ContainerInfo(NamedTuple):
     # Leave to None to use system or container defaults.
     tmpfs: bool | None = None
 
+    # Number of writable snapshots of the image to keep ready for ephemeral
+    # containers
+    #
+    # Leave to None to use system defaults.
+    snapshot_pool: int | None = None
+
+    # Kill ephemeral containers instead of shutting them down cleanly, once
+    # teardown scripts have run
+    #
+    # Leave to None to use system defaults.
+    fast_teardown: bool | None = None
+
+    # Boot the init system in ephemeral containers. If False, commands are
+    # run in a container without services
+    #
+    # Leave to None to use the default of booting containers.
+    boot: bool | None = None
+
+    # Resource controls for containers, overriding system defaults setting by
+    # setting
+    #
+    # Leave to None to use system defaults.
+    resources: dict[str, str] | None = None
+
     @classmethod
     def load(cls, conf: dict[str, Any]) -> Self:
         """
@@ -105,6 +130,10 @@ class ContainerInfo(NamedTuple):
         """
         return cls(
             tmpfs=conf.pop("tmpfs", None),
+            snapshot_pool=conf.pop("snapshot_pool", None),
+            fast_teardown=conf.pop("fast_teardown", None),
+            boot=conf.pop("boot", None),
+            resources=load_resources(conf.pop("resources", None)) or None,
         )
 
 
@@ -11,6 +11,7 @@ import pwd
 import shlex
 import shutil
 import subprocess
+from collections.abc import Sequence
 from functools import cached_property
 from pathlib import Path
 from typing import Any, NamedTuple, Self, TypeVar
@@ -134,12 +135,16 @@ class Runner:
         cmd: list[str],
         cwd: Path | None = None,
         check: bool = True,
+        label: str | None = None,
     ):
         super().__init__()
         self.logger = logger
         self.cmd = cmd
         self.cwd = cwd
         self.check = check
+        #: Prefix for log messages, to tell apart the output of commands
+        #: running at the same time
+        self.label = label
         self.stdout: list[bytes] = []
         self.stderr: list[bytes] = []
         self.result: Any = None
@@ -153,15 +158,43 @@ class Runner:
         """Run the command and return its result."""
         return asyncio.run(self._run())
 
+    @classmethod
+    def run_many(
+        cls, runners: Sequence["Runner"]
+    ) -> list[subprocess.CompletedProcess[bytes]]:
+        """
+        Run the commands of several runners at the same time, and return
+        their results in the same order.
+
+        All commands are run to completion: if any of them raised an
+        exception, the first one is raised afterwards.
+        """
+
+        async def run_all() -> list[Any]:
+            return await asyncio.gather(
+                *(runner._run() for runner in runners), return_exceptions=True
+            )
+
+        results = asyncio.run(run_all())
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    def _log(self, msg: str, *args: Any) -> None:
+        """Log a message, prefixed with the label if set."""
+        if self.label is not None:
+            self.logger.info("%s: " + msg, self.label, *args)
+        else:
+            self.logger.info(msg, *args)
+
     async def read_stdout(self, reader: asyncio.StreamReader) -> None:
         while True:
             line = await reader.readline()
             if not line:
                 break
             self.stdout.append(line)
-            self.logger.info(
-                "stdout: %s", line.decode(errors="replace").rstrip()
-            )
+            self._log("stdout: %s", line.decode(errors="replace").rstrip())
 
     async def read_stderr(self, reader: asyncio.StreamReader) -> None:
         while True:
@@ -169,12 +202,10 @@ class Runner:
             if not line:
                 break
             self.stderr.append(line)
-            self.logger.info(
-                "stderr: %s", line.decode(errors="replace").rstrip()
-            )
+            self._log("stderr: %s", line.decode(errors="replace").rstrip())
 
     async def start_process(self) -> asyncio.subprocess.Process:
-        self.logger.info("Running %s", self.name)
+        self._log("Running %s", self.name)
 
         kwargs: dict[str, Any] = {}
         if self.cwd is not None:
@@ -13,6 +13,7 @@ from .context import privs
 from .exceptions import Fail
 from .utils.deb import DebCache
 from .utils.fs import extra_packages_dir
+from .utils.machined import Machined
 
 if TYPE_CHECKING:
     import podman as _podman
@@ -72,6 +73,18 @@ class Session(contextlib.ExitStack, abc.ABC):
     def podman(self) -> "_podman.PodmanClient":
         return self._make_podman()
 
+    @abc.abstractmethod
+    def _make_machined(self) -> Machined | None:
+        """Create a new Machined client, if possible."""
+
+    @cached_property
+    def machined(self) -> Machined | None:
+        """
+        Return the D-Bus client for systemd and systemd-machined, or None if
+        it is not available
+        """
+        return self._make_machined()
+
     @abc.abstractmethod
     def _make_debcache(self, path: Path) -> DebCache:
         """Create a new DebCache."""
@@ -166,6 +179,16 @@ class RealSession(Session):
         uri = f"unix:///run/user/{os.getuid()}/podman/podman.sock"
         return self.enter_context(podman.PodmanClient(base_url=uri))
 
+    @override
+    def _make_machined(self) -> Machined | None:
+        if not privs.can_regain():
+            return None
+        with privs.root():
+            machined = Machined.connect()
+        if machined is not None:
+            self.callback(machined.close)
+        return machined
+
     @override
     def _make_debcache(self, path: Path) -> DebCache:
         return self.enter_context(DebCache(path))
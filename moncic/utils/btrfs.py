@@ -1,4 +1,5 @@
 import contextlib
+import errno
 import fcntl
 import logging
 import os
@@ -6,9 +7,9 @@ import re
 import struct
 import subprocess
 import tempfile
-from collections.abc import Generator
+from collections.abc import Callable, Generator
 from pathlib import Path
-from typing import TYPE_CHECKING
+from typing import NamedTuple, TYPE_CHECKING
 
 if TYPE_CHECKING:
     from ..moncic import MoncicConfig
@@ -16,11 +17,317 @@ if TYPE_CHECKING:
 log = logging.getLogger(__name__)
 
 
+def _IOC(direction: int, ioctl_type: int, nr: int, size: int) -> int:
+    """Compute an ioctl request number, like the _IOC kernel macro."""
+    return (direction << 30) | (size << 16) | (ioctl_type << 8) | nr
+
+
+def _IOR(ioctl_type: int, nr: int, size: int) -> int:
+    return _IOC(2, ioctl_type, nr, size)
+
+
+def _IOW(ioctl_type: int, nr: int, size: int) -> int:
+    return _IOC(1, ioctl_type, nr, size)
+
+
+def _IOWR(ioctl_type: int, nr: int, size: int) -> int:
+    return _IOC(3, ioctl_type, nr, size)
+
+
+BTRFS_IOCTL_MAGIC = 0x94
+
+# struct btrfs_ioctl_get_subvol_info_args
+_SUBVOL_INFO = struct.Struct("=Q256sQQQQ16s16s16sQQQQ" + "QI4x" * 4 + "8Q")
+BTRFS_IOC_GET_SUBVOL_INFO = _IOR(BTRFS_IOCTL_MAGIC, 60, _SUBVOL_INFO.size)
+
+
+class SubvolumeInfo(NamedTuple):
+    """Information about a btrfs subvolume."""
+
+    #: Subvolume ID
+    subvolid: int
+    #: Generation of the last transaction that modified the subvolume
+    generation: int
+    #: UUID of the subvolume
+    uuid: bytes
+    #: UUID of the subvolume this one is a snapshot of
+    parent_uuid: bytes
+
+
+def get_subvolume_info(path: Path) -> SubvolumeInfo | None:
+    """
+    Return information about the subvolume containing ``path``.
+
+    Return None if the information is not available, for example because the
+    path is not on btrfs.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+        return None
+    try:
+        buf = fcntl.ioctl(
+            fd, BTRFS_IOC_GET_SUBVOL_INFO, bytes(_SUBVOL_INFO.size)
+        )
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+    fields = _SUBVOL_INFO.unpack(buf)
+    return SubvolumeInfo(
+        subvolid=fields[0],
+        generation=fields[4],
+        uuid=fields[6],
+        parent_uuid=fields[7],
+    )
+
+
+# struct btrfs_ioctl_vol_args
+_VOL_ARGS = struct.Struct("=q4088s")
+# struct btrfs_ioctl_vol_args_v2
+_VOL_ARGS_V2 = struct.Struct("=qQQ32x4040s")
+# struct btrfs_ioctl_search_key
+_SEARCH_KEY = struct.Struct("=QQQQQQQIIII32x")
+# struct btrfs_ioctl_search_header
+_SEARCH_HEADER = struct.Struct("=QQQII")
+# struct btrfs_root_ref
+_ROOT_REF = struct.Struct("=QQH")
+# struct btrfs_ioctl_ino_lookup_args
+_INO_LOOKUP = struct.Struct("=QQ4080s")
+# struct btrfs_qgroup_info_item
+_QGROUP_INFO = struct.Struct("=QQQQQ")
+
+BTRFS_IOC_SUBVOL_CREATE = _IOW(BTRFS_IOCTL_MAGIC, 14, _VOL_ARGS.size)
+BTRFS_IOC_TREE_SEARCH = _IOWR(BTRFS_IOCTL_MAGIC, 17, 4096)
+BTRFS_IOC_INO_LOOKUP = _IOWR(BTRFS_IOCTL_MAGIC, 18, _INO_LOOKUP.size)
+BTRFS_IOC_SNAP_CREATE_V2 = _IOW(BTRFS_IOCTL_MAGIC, 23, _VOL_ARGS_V2.size)
+BTRFS_IOC_SNAP_DESTROY_V2 = _IOW(BTRFS_IOCTL_MAGIC, 63, _VOL_ARGS_V2.size)
+
+#: Flag for BTRFS_IOC_SNAP_CREATE_V2 to create a read-only snapshot
+BTRFS_SUBVOL_RDONLY = 1 << 1
+
+BTRFS_ROOT_TREE_OBJECTID = 1
+BTRFS_QUOTA_TREE_OBJECTID = 8
+BTRFS_ROOT_REF_KEY = 156
+BTRFS_QGROUP_INFO_KEY = 242
+
+U64_MAX = 2**64 - 1
+
+
+def _open_dir(path: Path) -> int:
+    """Open a directory for use with ioctls."""
+    return os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+
+
+def ioctl_subvol_create(path: Path) -> None:
+    """Create a subvolume using BTRFS_IOC_SUBVOL_CREATE."""
+    fd = _open_dir(path.parent)
+    try:
+        # ioctl needs a mutable buffer for arguments bigger than 1024 bytes
+        args = bytearray(_VOL_ARGS.pack(0, os.fsencode(path.name)))
+        fcntl.ioctl(fd, BTRFS_IOC_SUBVOL_CREATE, args, True)
+    finally:
+        os.close(fd)
+
+
+def ioctl_snap_create(
+    source_path: Path, path: Path, readonly: bool = False
+) -> None:
+    """Snapshot a subvolume using BTRFS_IOC_SNAP_CREATE_V2."""
+    flags = BTRFS_SUBVOL_RDONLY if readonly else 0
+    source_fd = _open_dir(source_path)
+    try:
+        fd = _open_dir(path.parent)
+        try:
+            args = bytearray(
+                _VOL_ARGS_V2.pack(source_fd, 0, flags, os.fsencode(path.name))
+            )
+            fcntl.ioctl(fd, BTRFS_IOC_SNAP_CREATE_V2, args, True)
+        finally:
+            os.close(fd)
+    finally:
+        os.close(source_fd)
+
+
+def ioctl_snap_destroy(path: Path) -> None:
+    """Delete a subvolume using BTRFS_IOC_SNAP_DESTROY_V2."""
+    fd = _open_dir(path.parent)
+    try:
+        args = bytearray(_VOL_ARGS_V2.pack(0, 0, 0, os.fsencode(path.name)))
+        fcntl.ioctl(fd, BTRFS_IOC_SNAP_DESTROY_V2, args, True)
+    finally:
+        os.close(fd)
+
+
+class RootRef(NamedTuple):
+    """Reference to a subvolume from the subvolume containing it."""
+
+    #: ID of the subvolume
+    subvolid: int
+    #: Inode number of the directory containing the subvolume
+    dirid: int
+    #: Name of the subvolume in its directory
+    name: str
+
+
+def ioctl_root_refs(fd: int, subvolid: int) -> list[RootRef]:
+    """
+    List subvolumes directly contained in the given subvolume, using
+    BTRFS_IOC_TREE_SEARCH.
+
+    :param fd: any file descriptor open in the same file system
+    """
+    res: list[RootRef] = []
+    min_offset = 0
+    buf = bytearray(4096)
+    while True:
+        _SEARCH_KEY.pack_into(
+            buf,
+            0,
+            BTRFS_ROOT_TREE_OBJECTID,
+            subvolid,
+            subvolid,
+            min_offset,
+            U64_MAX,
+            0,
+            U64_MAX,
+            BTRFS_ROOT_REF_KEY,
+            BTRFS_ROOT_REF_KEY,
+            4096,
+            0,
+        )
+        fcntl.ioctl(fd, BTRFS_IOC_TREE_SEARCH, buf, True)
+        nr_items = _SEARCH_KEY.unpack_from(buf)[9]
+        if not nr_items:
+            break
+        pos = _SEARCH_KEY.size
+        for _ in range(nr_items):
+            _, _, offset, item_type, length = _SEARCH_HEADER.unpack_from(
+                buf, pos
+            )
+            pos += _SEARCH_HEADER.size
+            if item_type == BTRFS_ROOT_REF_KEY:
+                dirid, _, name_len = _ROOT_REF.unpack_from(buf, pos)
+                name_start = pos + _ROOT_REF.size
+                name = os.fsdecode(
+                    bytes(buf[name_start : name_start + name_len])
+                )
+                res.append(RootRef(offset, dirid, name))
+            pos += length
+        if offset == U64_MAX:
+            break
+        min_offset = offset + 1
+    return res
+
+
+class QgroupInfo(NamedTuple):
+    """Disk usage accounted by a btrfs quota group."""
+
+    #: Bytes referenced by the subvolume
+    referenced: int
+    #: Bytes referenced only by the subvolume
+    exclusive: int
+
+
+def ioctl_qgroup_info(fd: int) -> dict[int, QgroupInfo]:
+    """
+    Return the disk usage of all subvolumes in the file system, indexed by
+    subvolume ID, using BTRFS_IOC_TREE_SEARCH on the quota tree.
+
+    This needs root privileges.
+
+    :param fd: any file descriptor open in the same file system
+    :raises OSError: with ENOENT if quotas are not enabled
+    """
+    res: dict[int, QgroupInfo] = {}
+    min_offset = 0
+    buf = bytearray(4096)
+    while True:
+        _SEARCH_KEY.pack_into(
+            buf,
+            0,
+            BTRFS_QUOTA_TREE_OBJECTID,
+            0,
+            0,
+            min_offset,
+            U64_MAX,
+            0,
+            U64_MAX,
+            BTRFS_QGROUP_INFO_KEY,
+            BTRFS_QGROUP_INFO_KEY,
+            4096,
+            0,
+        )
+        fcntl.ioctl(fd, BTRFS_IOC_TREE_SEARCH, buf, True)
+        nr_items = _SEARCH_KEY.unpack_from(buf)[9]
+        if not nr_items:
+            break
+        pos = _SEARCH_KEY.size
+        for _ in range(nr_items):
+            _, _, offset, item_type, length = _SEARCH_HEADER.unpack_from(
+                buf, pos
+            )
+            pos += _SEARCH_HEADER.size
+            # Level 0 quota groups have the ID of their subvolume
+            if item_type == BTRFS_QGROUP_INFO_KEY and offset >> 48 == 0:
+                _, rfer, _, excl, _ = _QGROUP_INFO.unpack_from(buf, pos)
+                res[offset] = QgroupInfo(rfer, excl)
+            pos += length
+        if offset == U64_MAX:
+            break
+        min_offset = offset + 1
+    return res
+
+
+def ioctl_ino_lookup(fd: int, treeid: int, objectid: int) -> str:
+    """
+    Return the path of a directory relative to the root of its subvolume,
+    using BTRFS_IOC_INO_LOOKUP.
+
+    :param fd: any file descriptor open in the same file system
+    """
+    buf = bytearray(_INO_LOOKUP.pack(treeid, objectid, b""))
+    fcntl.ioctl(fd, BTRFS_IOC_INO_LOOKUP, buf, True)
+    name = bytes(buf[16:]).split(b"\0", 1)[0]
+    return os.fsdecode(name)
+
+
+def list_nested_subvolumes(path: Path) -> list[Path]:
+    """
+    List the subvolumes nested inside the subvolume at path, recursively.
+
+    Subvolumes are listed before the subvolumes they contain.
+    """
+    info = get_subvolume_info(path)
+    if info is None:
+        raise OSError(errno.ENOTTY, "cannot read subvolume information", path)
+
+    res: list[Path] = []
+    fd = _open_dir(path)
+    try:
+
+        def scan(subvol_path: Path, subvolid: int) -> None:
+            for ref in ioctl_root_refs(fd, subvolid):
+                dirpath = ioctl_ino_lookup(fd, subvolid, ref.dirid)
+                nested = subvol_path / dirpath / ref.name
+                res.append(nested)
+                scan(nested, ref.subvolid)
+
+        scan(path, info.subvolid)
+    finally:
+        os.close(fd)
+    return res
+
+
 class Subvolume:
     """
     Low-level functions to access and maintain a btrfs subvolume
     """
 
+    #: Use btrfs ioctls directly, falling back to the btrfs command line tool
+    #: if they fail. If False, always use the command line tool
+    use_ioctl: bool = True
+
     def __init__(
         self, mconfig: "MoncicConfig", path: Path, compression: str | None
     ):
@@ -32,25 +339,52 @@ class Subvolume:
         else:
             self.compression = compression
 
-    def replace_subvolume(self, path: Path) -> None:
-        """
-        Replace the given subvolume with this one.
-
-        This and the destination subvolumes need to be on the same filesystem.
-        """
-        # We can do this because we stay on the same directory, which should
-        # only be writable by root
-        stash_path = path.parent / f"{path.name}.tmp"
-        path.rename(stash_path)
-        self.path.rename(path)
-        self.path = path
-        old = Subvolume(self.mconfig, stash_path, self.compression)
-        old.remove()
-
     def local_run(self, cmd: list[str]) -> None:
         """Run a command on the host system."""
         subprocess.run(cmd)
 
+    def _try_ioctl(self, description: str, func: Callable[[], None]) -> bool:
+        """
+        Run an ioctl-based implementation of an operation.
+
+        :returns: True if it succeeded, False if the caller should fall back to
+          the btrfs command line tool
+        """
+        if not self.use_ioctl:
+            return False
+        try:
+            func()
+        except OSError as e:
+            log.debug(
+                "%s: cannot %s with ioctl, using btrfs command: %s",
+                self.path,
+                description,
+                e,
+            )
+            return False
+        return True
+
+    def _set_compression(self, compression: str) -> None:
+        """Set the compression property of the subvolume."""
+        if self._try_ioctl(
+            "set compression",
+            lambda: os.setxattr(
+                self.path, "btrfs.compression", compression.encode()
+            ),
+        ):
+            return
+        self.local_run(
+            [
+                "btrfs",
+                "-q",
+                "property",
+                "set",
+                self.path.as_posix(),
+                "compression",
+                compression,
+            ]
+        )
+
     @contextlib.contextmanager
     def create(self) -> Generator[None, None, None]:
         """
@@ -60,23 +394,17 @@ class Subvolume:
         if os.path.exists(self.path):
             raise RuntimeError(f"{self.path!r} already exists")
 
-        # See if there is a compression level configured that we should apply
-        self.local_run(
-            ["btrfs", "-q", "subvolume", "create", self.path.as_posix()]
-        )
+        if not self._try_ioctl(
+            "create subvolume", lambda: ioctl_subvol_create(self.path)
+        ):
+            self.local_run(
+                ["btrfs", "-q", "subvolume", "create", self.path.as_posix()]
+            )
         try:
+            # See if there is a compression level configured that we should
+            # apply
             if self.compression is not None:
-                self.local_run(
-                    [
-                        "btrfs",
-                        "-q",
-                        "property",
-                        "set",
-                        self.path.as_posix(),
-                        "compression",
-                        self.compression,
-                    ]
-                )
+                self._set_compression(self.compression)
             yield
         except BaseException:
             # Catch BaseException instead of Exception to also cleanup in case
@@ -84,31 +412,44 @@ class Subvolume:
             self.remove()
             raise
 
-    def snapshot(self, source_path: Path) -> None:
+    def snapshot(self, source_path: Path, readonly: bool = False) -> None:
         """
-        Create a btrfs subvolume, and leave it on exit only if the context
-        manager did not raise an exception
+        Create this subvolume as a snapshot of source_path.
+
+        :param readonly: create a read-only snapshot
         """
         if not os.path.exists(source_path):
             raise RuntimeError(f"{source_path!r} does not exist")
         if os.path.exists(self.path):
             raise RuntimeError(f"{self.path!r} already exists")
 
-        self.local_run(
-            [
-                "btrfs",
-                "-q",
-                "subvolume",
-                "snapshot",
-                source_path.as_posix(),
-                self.path.as_posix(),
-            ]
-        )
+        if self._try_ioctl(
+            "create snapshot",
+            lambda: ioctl_snap_create(source_path, self.path, readonly),
+        ):
+            return
+
+        cmd = ["btrfs", "-q", "subvolume", "snapshot"]
+        if readonly:
+            cmd.append("-r")
+        cmd += [source_path.as_posix(), self.path.as_posix()]
+        self.local_run(cmd)
+
+    def _remove_ioctl(self) -> None:
+        """Remove this subvolume and all nested subvolumes using ioctls."""
+        # Delete nested subvolumes before the subvolumes containing them
+        for nested in reversed(list_nested_subvolumes(self.path)):
+            log.info("removing btrfs subvolume %r", nested.as_posix())
+            ioctl_snap_destroy(nested)
+        ioctl_snap_destroy(self.path)
 
     def remove(self) -> None:
         """
         Remove this subvolume and all subvolumes nested inside it
         """
+        if self._try_ioctl("remove subvolume", self._remove_ioctl):
+            return
+
         # Fetch IDs of nested subvolumes
         #
         # Use IDs rather than paths to avoid potential issues with exotic path
@@ -148,7 +489,23 @@ class Subvolume:
         )
 
 
-FIDEDUPERANGE = 0xC0189436
+# struct file_dedupe_range
+_DEDUPE_RANGE = struct.Struct("=QQHHI")
+# struct file_dedupe_range_info
+_DEDUPE_RANGE_INFO = struct.Struct("=qQQiI")
+
+FIDEDUPERANGE = _IOWR(BTRFS_IOCTL_MAGIC, 54, _DEDUPE_RANGE.size)
+
+#: Value of file_dedupe_range_info.status when the data ranges differ
+FILE_DEDUPE_RANGE_DIFFERS = 1
+
+#: Maximum number of destinations for a single FIDEDUPERANGE call: the kernel
+#: refuses arguments bigger than a page
+DEDUPE_MAX_DESTINATIONS = (4096 - _DEDUPE_RANGE.size) // _DEDUPE_RANGE_INFO.size
+
+#: Amount of data deduplicated with each call. btrfs does not deduplicate more
+#: than 16MiB at a time
+DEDUPE_CHUNK_SIZE = 16 * 1024 * 1024
 
 
 def ioctl_fideduperange(src_fd: int, s: bytes) -> tuple[int, int]:
@@ -156,10 +513,143 @@ def ioctl_fideduperange(src_fd: int, s: bytes) -> tuple[int, int]:
     Wrapper for ioctl_fideduperange(2)
     """
     v = fcntl.ioctl(src_fd, FIDEDUPERANGE, s)
-    _, _, _, _, _, _, _, bytes_dup, status, _ = struct.unpack("QQHHIqQQiH", v)
+    _, _, _, _, _, _, _, bytes_dup, status, _ = struct.unpack("QQHHIqQQiI", v)
     return bytes_dup, status
 
 
+def ioctl_fideduperange_multi(
+    src_fd: int, offset: int, length: int, dst_fds: list[int]
+) -> list[tuple[int, int]]:
+    """
+    Wrapper for ioctl_fideduperange(2) deduplicating the same range of the
+    source file with multiple destination files in a single call.
+
+    :returns: a list with ``(bytes_deduped, status)`` for each destination
+    """
+    buf = bytearray(_DEDUPE_RANGE.size + _DEDUPE_RANGE_INFO.size * len(dst_fds))
+    _DEDUPE_RANGE.pack_into(buf, 0, offset, length, len(dst_fds), 0, 0)
+    for idx, dst_fd in enumerate(dst_fds):
+        _DEDUPE_RANGE_INFO.pack_into(
+            buf,
+            _DEDUPE_RANGE.size + idx * _DEDUPE_RANGE_INFO.size,
+            dst_fd,
+            offset,
+            0,
+            0,
+            0,
+        )
+    # A mutable buffer is needed for arguments bigger than 1024 bytes
+    fcntl.ioctl(src_fd, FIDEDUPERANGE, buf, True)
+    res: list[tuple[int, int]] = []
+    for idx in range(len(dst_fds)):
+        _, _, bytes_deduped, status, _ = _DEDUPE_RANGE_INFO.unpack_from(
+            buf, _DEDUPE_RANGE.size + idx * _DEDUPE_RANGE_INFO.size
+        )
+        res.append((bytes_deduped, status))
+    return res
+
+
+# struct fiemap
+_FIEMAP = struct.Struct("=QQIIII")
+# struct fiemap_extent
+_FIEMAP_EXTENT = struct.Struct("=QQQ16xI12x")
+
+FS_IOC_FIEMAP = _IOWR(ord("f"), 11, _FIEMAP.size)
+
+#: Last extent in the file
+FIEMAP_EXTENT_LAST = 0x1
+#: Location of the data is not known yet
+FIEMAP_EXTENT_UNKNOWN = 0x2
+#: Data is stored inline in the metadata, and has no physical location
+FIEMAP_EXTENT_DATA_INLINE = 0x200
+#: Extent is shared with other files
+FIEMAP_EXTENT_SHARED = 0x2000
+
+#: Number of extents requested with each FS_IOC_FIEMAP call
+FIEMAP_BATCH_SIZE = 64
+
+
+class Extent(NamedTuple):
+    """Mapping of a range of a file to its physical location."""
+
+    logical: int
+    physical: int
+    length: int
+    flags: int
+
+
+def get_extents(fd: int) -> list[Extent]:
+    """
+    Return the extent map of an open file, using FS_IOC_FIEMAP.
+
+    Contiguous extents are merged, so that the result does not depend on how
+    the file system splits them.
+    """
+    extents: list[Extent] = []
+    start = 0
+    buf = bytearray(_FIEMAP.size + _FIEMAP_EXTENT.size * FIEMAP_BATCH_SIZE)
+    while True:
+        _FIEMAP.pack_into(buf, 0, start, 2**64 - 1, 0, 0, FIEMAP_BATCH_SIZE, 0)
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, buf, True)
+        mapped = _FIEMAP.unpack_from(buf)[3]
+        if not mapped:
+            break
+        for idx in range(mapped):
+            extent = Extent._make(
+                _FIEMAP_EXTENT.unpack_from(
+                    buf, _FIEMAP.size + idx * _FIEMAP_EXTENT.size
+                )
+            )
+            last = extents[-1] if extents else None
+            if (
+                last is not None
+                and last.logical + last.length == extent.logical
+                and last.physical + last.length == extent.physical
+            ):
+                extents[-1] = last._replace(
+                    length=last.length + extent.length,
+                    flags=last.flags | extent.flags,
+                )
+            else:
+                extents.append(extent)
+        if extent.flags & FIEMAP_EXTENT_LAST:
+            break
+        start = extent.logical + extent.length
+    return extents
+
+
+def extents_shared(src: list[Extent], dst: list[Extent]) -> bool:
+    """
+    Check if two extent maps point to the same physical data.
+    """
+    if not src or len(src) != len(dst):
+        return False
+    for a, b in zip(src, dst):
+        if (a.flags | b.flags) & (
+            FIEMAP_EXTENT_UNKNOWN | FIEMAP_EXTENT_DATA_INLINE
+        ):
+            return False
+        if (a.logical, a.physical, a.length) != (
+            b.logical,
+            b.physical,
+            b.length,
+        ):
+            return False
+    return True
+
+
+class DedupeResult(NamedTuple):
+    """Outcome of a deduplication request."""
+
+    #: Bytes newly deduplicated
+    reclaimed: int = 0
+    #: Bytes that were already shared, and were not looked at
+    shared: int = 0
+    #: Number of destination files that could not be deduplicated because of
+    #: errors
+    failed: int = 0
+
+
 def do_dedupe(src_file: str, dst_file: str, size: int) -> int:
     """
     Tell the kernel to deduplicate the two files if their contents are the
@@ -167,44 +657,94 @@ def do_dedupe(src_file: str, dst_file: str, size: int) -> int:
 
     The files are supposed to have the same size, which is already known and
     passed as the ``size`` argument.
+
+    :returns: the number of bytes that are deduplicated
+    """
+    result = do_dedupe_multi(src_file, [dst_file], size)
+    return result.reclaimed + result.shared
+
+
+def do_dedupe_multi(
+    src_file: str, dst_files: list[str], size: int
+) -> DedupeResult:
+    """
+    Tell the kernel to deduplicate each destination file with the source file,
+    if their contents are the same.
+
+    The files are supposed to have the same size, which is already known and
+    passed as the ``size`` argument.
+
+    Destination files whose extents are already all shared with the source
+    file are skipped, without asking the kernel to compare their contents.
+
+    Errors on a destination file are logged and counted in the result, and do
+    not stop work on the other destination files.
     """
     # The code to interface with BTRFS is taken using dduper as a reference.
     # See https://github.com/Lakshmipathi/dduper/blob/master/dduper
 
     total_bytes_deduped = 0
+    total_bytes_shared = 0
+    failed = 0
 
-    src_fd = os.open(src_file, os.O_RDONLY)
-    try:
-        dst_fd = os.open(dst_file, os.O_WRONLY)
+    with contextlib.ExitStack() as stack:
+        src_fd = os.open(src_file, os.O_RDONLY)
+        stack.callback(os.close, src_fd)
         try:
-            # todo: Clear dict/np/list if there are not used further
-            # todo : handle same content within single file
-
-            chunk_size = 1024 * 1024
-            for offset in range(0, size, chunk_size):
-                src_len = min(chunk_size, size - offset)
-
-                s = struct.pack(
-                    "QQHHIqQQiH",
-                    offset,
-                    src_len,
-                    1,
-                    0,
-                    0,
-                    dst_fd,
-                    offset,
-                    0,
-                    0,
-                    0,
+            src_extents = get_extents(src_fd)
+        except OSError as e:
+            log.debug("%s: cannot read extent map: %s", src_file, e)
+            src_extents = []
+        dst_fds: list[int] = []
+        dst_names: dict[int, str] = {}
+        for dst_file in dst_files:
+            try:
+                dst_fd = os.open(dst_file, os.O_WRONLY)
+            except OSError as e:
+                # Files can change or disappear while we work
+                log.warning("%s: cannot deduplicate: %s", dst_file, e)
+                failed += 1
+                continue
+            stack.callback(os.close, dst_fd)
+            dst_names[dst_fd] = dst_file
+            if src_extents:
+                try:
+                    dst_extents = get_extents(dst_fd)
+                except OSError as e:
+                    log.debug("%s: cannot read extent map: %s", dst_file, e)
+                else:
+                    if extents_shared(src_extents, dst_extents):
+                        total_bytes_shared += size
+                        continue
+            dst_fds.append(dst_fd)
+
+        for offset in range(0, size, DEDUPE_CHUNK_SIZE):
+            if not dst_fds:
+                break
+            src_len = min(DEDUPE_CHUNK_SIZE, size - offset)
+            done: set[int] = set()
+            for start in range(0, len(dst_fds), DEDUPE_MAX_DESTINATIONS):
+                batch = dst_fds[start : start + DEDUPE_MAX_DESTINATIONS]
+                results = ioctl_fideduperange_multi(
+                    src_fd, offset, src_len, batch
                 )
-                bytes_deduped, status = ioctl_fideduperange(src_fd, s)
-                total_bytes_deduped += bytes_deduped
-        finally:
-            os.close(dst_fd)
-    finally:
-        os.close(src_fd)
-
-    return total_bytes_deduped
+                for dst_fd, (bytes_deduped, status) in zip(batch, results):
+                    if status < 0:
+                        log.warning(
+                            "%s: cannot deduplicate: %s",
+                            dst_names[dst_fd],
+                            os.strerror(-status),
+                        )
+                        failed += 1
+                        done.add(dst_fd)
+                    elif status == FILE_DEDUPE_RANGE_DIFFERS:
+                        done.add(dst_fd)
+                    total_bytes_deduped += bytes_deduped
+            # Stop working on files whose contents differ, or that failed
+            if done:
+                dst_fds = [fd for fd in dst_fds if fd not in done]
+
+    return DedupeResult(total_bytes_deduped, total_bytes_shared, failed)
 
 
 def is_btrfs(path: Path) -> bool:
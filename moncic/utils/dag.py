@@ -0,0 +1,130 @@
+"""
+Run interdependent tasks concurrently
+"""
+
+import asyncio
+import enum
+import logging
+from collections.abc import Callable, Coroutine, Iterable
+from typing import Any
+
+log = logging.getLogger("dag")
+
+
+class TaskStatus(enum.Enum):
+    """Outcome of a task in a dependency graph."""
+
+    #: The task completed successfully
+    OK = "ok"
+    #: The task failed
+    FAILED = "failed"
+    #: The task was not run, because a dependency did not succeed
+    SKIPPED = "skipped"
+
+
+class DependencyGraph:
+    """
+    Set of named tasks, each of which can only start after the tasks it
+    depends on have completed successfully.
+    """
+
+    def __init__(self) -> None:
+        #: Dependencies of each task
+        self.deps: dict[str, set[str]] = {}
+
+    def add(self, name: str, deps: Iterable[str] = ()) -> None:
+        """Add a task, with the names of the tasks it depends on."""
+        self.deps.setdefault(name, set()).update(deps)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.deps
+
+    def __len__(self) -> int:
+        return len(self.deps)
+
+    def check(self) -> None:
+        """
+        Check that all dependencies are tasks in the graph, and that there are
+        no dependency loops.
+
+        :raises ValueError: if the graph is not valid
+        """
+        for name, deps in self.deps.items():
+            for dep in deps:
+                if dep not in self.deps:
+                    raise ValueError(f"{name} depends on unknown task {dep}")
+        # Depth-first visit, looking for back edges
+        visiting: set[str] = set()
+        visited: set[str] = set()
+
+        def visit(name: str, path: list[str]) -> None:
+            if name in visited:
+                return
+            if name in visiting:
+                loop = path[path.index(name) :] + [name]
+                raise ValueError("dependency loop: " + " → ".join(loop))
+            visiting.add(name)
+            for dep in sorted(self.deps[name]):
+                visit(dep, path + [name])
+            visiting.discard(name)
+            visited.add(name)
+
+        for name in sorted(self.deps):
+            visit(name, [])
+
+    async def run(
+        self, work: Callable[[str], Coroutine[Any, Any, bool]], jobs: int = 1
+    ) -> dict[str, TaskStatus]:
+        """
+        Run all tasks, at most ``jobs`` at a time.
+
+        A task starts as soon as all its dependencies have completed
+        successfully. Tasks whose dependencies failed are skipped.
+
+        :param work: coroutine function called with the name of a task, and
+          returning True if the task succeeded. Exceptions count as failures
+        :returns: the status of each task
+        """
+        self.check()
+        jobs = max(jobs, 1)
+        status: dict[str, TaskStatus] = {}
+        pending = {name: set(deps) for name, deps in self.deps.items()}
+        running: dict[asyncio.Task[bool], str] = {}
+
+        while pending or running:
+            # Skip tasks whose dependencies did not succeed
+            for name, deps in sorted(pending.items()):
+                if any(
+                    status.get(dep, TaskStatus.OK) != TaskStatus.OK
+                    for dep in deps
+                ):
+                    status[name] = TaskStatus.SKIPPED
+                    del pending[name]
+                    log.warning("%s: skipped, a dependency failed", name)
+
+            # Start tasks whose dependencies are all done
+            ready = sorted(
+                name
+                for name, deps in pending.items()
+                if all(status.get(dep) == TaskStatus.OK for dep in deps)
+            )
+            for name in ready[: max(jobs - len(running), 0)]:
+                del pending[name]
+                running[asyncio.create_task(work(name))] = name
+
+            if not running:
+                continue
+
+            done, _ = await asyncio.wait(
+                running, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                name = running.pop(task)
+                try:
+                    ok = task.result()
+                except Exception:
+                    log.exception("%s: failed", name)
+                    ok = False
+                status[name] = TaskStatus.OK if ok else TaskStatus.FAILED
+
+        return status
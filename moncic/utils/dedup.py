@@ -0,0 +1,565 @@
+"""
+Infrastructure to deduplicate files across OS images
+"""
+
+import concurrent.futures
+import hashlib
+import logging
+import os
+import sqlite3
+import stat
+import threading
+import time
+import types
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+from typing import NamedTuple, Self
+
+from .btrfs import DedupeResult, do_dedupe_multi, get_subvolume_info
+
+log = logging.getLogger(__name__)
+
+
+class DedupGroup(NamedTuple):
+    """Files with the same relative path and size across different images."""
+
+    #: Path of the file relative to the image root
+    relpath: str
+    #: File size
+    size: int
+    #: Names of the images containing the file. The first one is used as the
+    #: reference for deduplication
+    images: list[str]
+    #: Names of the images whose file changed since it was last deduplicated
+    changed: list[str]
+
+
+class ContentGroup(NamedTuple):
+    """Files with the same contents, at any path in any image."""
+
+    #: File size
+    size: int
+    #: Hash of the file contents
+    hash: str
+    #: ``(image, relpath)`` for each file. The first one is used as the
+    #: reference for deduplication
+    files: list[tuple[str, str]]
+    #: ``(image, relpath)`` of files that changed since they were last
+    #: deduplicated
+    changed: list[tuple[str, str]]
+
+
+class DedupIndex:
+    """
+    Persistent index of the contents of the images in an image directory.
+
+    The index remembers, for each file, its size, modification time and inode
+    number, and whether it has already been deduplicated. For each image it
+    remembers the btrfs subvolume UUID and generation: if they did not change
+    since the last run, the image is not scanned again.
+
+    This allows to only look at files that changed since the last
+    deduplication.
+    """
+
+    FILENAME = ".moncic-ci-dedup.sqlite"
+
+    #: Version of the database schema. The index is a cache, and it is
+    #: rebuilt from scratch if the version changes
+    SCHEMA_VERSION = 1
+
+    #: Files smaller than this are not considered for content-based
+    #: deduplication: they are likely to be stored inline in the metadata, and
+    #: they cannot be shared
+    CONTENT_MIN_SIZE = 4096
+
+    #: Amount of data read to compute the prefix hash of a file
+    PREFIX_SIZE = 65536
+
+    #: Amount of data read at a time when hashing files
+    HASH_CHUNK_SIZE = 1024 * 1024
+
+    #: Commit progress to disk after this many changes
+    COMMIT_INTERVAL = 1000
+
+    def __init__(self, imagedir: Path) -> None:
+        self.imagedir = imagedir
+        self.path = imagedir / self.FILENAME
+        self.db: sqlite3.Connection | None = None
+        self.pending_changes = 0
+
+    def __enter__(self) -> Self:
+        self.db = sqlite3.connect(self.path)
+        (version,) = self.db.execute("PRAGMA user_version").fetchone()
+        if version != self.SCHEMA_VERSION:
+            self.db.executescript(
+                """
+                DROP TABLE IF EXISTS images;
+                DROP TABLE IF EXISTS files;
+                """
+            )
+            self.db.execute(f"PRAGMA user_version={self.SCHEMA_VERSION:d}")
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS images (
+                name TEXT PRIMARY KEY,
+                uuid BLOB,
+                generation INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                image TEXT NOT NULL,
+                relpath TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                ino INTEGER NOT NULL,
+                hash TEXT,
+                deduped INTEGER NOT NULL DEFAULT 0,
+                content_deduped INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (image, relpath)
+            );
+            CREATE INDEX IF NOT EXISTS files_by_name_size
+                ON files (relpath, size);
+            CREATE INDEX IF NOT EXISTS files_by_size ON files (size);
+            """
+        )
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_tb: types.TracebackType | None,
+    ) -> None:
+        assert self.db is not None
+        # Also commit on errors: what was recorded so far is still valid, and
+        # it saves work on the next run
+        self.db.commit()
+        self.db.close()
+        self.db = None
+
+    def _changed(self, count: int = 1) -> None:
+        """Account for changes, periodically committing them."""
+        assert self.db is not None
+        self.pending_changes += count
+        if self.pending_changes >= self.COMMIT_INTERVAL:
+            self.db.commit()
+            self.pending_changes = 0
+
+    def _is_up_to_date(self, name: str, path: Path) -> bool:
+        """Check if the image is unchanged since it was last indexed."""
+        assert self.db is not None
+        info = get_subvolume_info(path)
+        if info is None:
+            return False
+        row = self.db.execute(
+            "SELECT uuid, generation FROM images WHERE name=?", (name,)
+        ).fetchone()
+        if row is None:
+            return False
+        return bool(row[0] == info.uuid and row[1] == info.generation)
+
+    def update_image(self, name: str, path: Path) -> bool:
+        """
+        Bring the index up to date with the contents of an image.
+
+        :returns: False if the image was unchanged and has not been scanned
+        """
+        assert self.db is not None
+        if self._is_up_to_date(name, path):
+            log.debug("%s: unchanged since last deduplication", name)
+            return False
+
+        log.debug("%s: scanning for changes", name)
+        known: dict[str, tuple[int, int, int]] = {}
+        for relpath, size, mtime_ns, ino in self.db.execute(
+            "SELECT relpath, size, mtime_ns, ino FROM files WHERE image=?",
+            (name,),
+        ):
+            known[relpath] = (size, mtime_ns, ino)
+
+        for dirpath, dirnames, filenames, dirfd in os.fwalk(path):
+            reldir = os.path.relpath(dirpath, path)
+            for fn in filenames:
+                st = os.lstat(fn, dir_fd=dirfd)
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                relpath = os.path.join(reldir, fn)
+                signature = (st.st_size, st.st_mtime_ns, st.st_ino)
+                if known.pop(relpath, None) == signature:
+                    continue
+                self.db.execute(
+                    "INSERT OR REPLACE INTO files"
+                    " (image, relpath, size, mtime_ns, ino, hash, deduped,"
+                    " content_deduped)"
+                    " VALUES (?, ?, ?, ?, ?, NULL, 0, 0)",
+                    (name, relpath, *signature),
+                )
+                self._changed()
+
+        # Forget files that have disappeared
+        for relpath in known:
+            self.db.execute(
+                "DELETE FROM files WHERE image=? AND relpath=?",
+                (name, relpath),
+            )
+            self._changed()
+        return True
+
+    def update_generation(self, name: str, path: Path) -> None:
+        """
+        Record the current subvolume generation of an image.
+
+        This is done after deduplication, since deduplicating itself changes
+        the generation.
+        """
+        assert self.db is not None
+        info = get_subvolume_info(path)
+        if info is None:
+            return
+        self.db.execute(
+            "INSERT OR REPLACE INTO images (name, uuid, generation)"
+            " VALUES (?, ?, ?)",
+            (name, info.uuid, info.generation),
+        )
+
+    def prune(self, names: set[str]) -> None:
+        """Remove from the index all images not in names."""
+        assert self.db is not None
+        for (name,) in self.db.execute(
+            "SELECT DISTINCT image FROM files UNION SELECT name FROM images"
+        ).fetchall():
+            if name in names:
+                continue
+            log.debug("%s: removing from deduplication index", name)
+            self.db.execute("DELETE FROM files WHERE image=?", (name,))
+            self.db.execute("DELETE FROM images WHERE name=?", (name,))
+            self._changed()
+
+    def pending_groups(self) -> Iterator[DedupGroup]:
+        """
+        Generate groups of files that still need deduplication.
+
+        A group is generated if the same file with the same size appears in
+        more than one image, and at least one of them changed since the last
+        time it was deduplicated.
+        """
+        assert self.db is not None
+        rows = self.db.execute(
+            "SELECT relpath, size FROM files GROUP BY relpath, size"
+            " HAVING count(*) > 1 AND min(deduped) = 0"
+        ).fetchall()
+        for relpath, size in rows:
+            images: list[str] = []
+            changed: list[str] = []
+            for image, deduped in self.db.execute(
+                "SELECT image, deduped FROM files"
+                " WHERE relpath=? AND size=? ORDER BY image",
+                (relpath, size),
+            ):
+                images.append(image)
+                if not deduped:
+                    changed.append(image)
+            yield DedupGroup(relpath, size, images, changed)
+
+    def mark_deduped(self, group: DedupGroup) -> None:
+        """Record that all files in the group have been deduplicated."""
+        assert self.db is not None
+        self.db.execute(
+            "UPDATE files SET deduped=1 WHERE relpath=? AND size=?",
+            (group.relpath, group.size),
+        )
+        self._changed()
+
+    def _hash_file(self, image: str, relpath: str, size: int) -> str:
+        """Compute the hash of the first ``size`` bytes of a file."""
+        digest = hashlib.sha256()
+        with open(self.imagedir / image / relpath, "rb") as fd:
+            while size > 0:
+                if not (data := fd.read(min(size, self.HASH_CHUNK_SIZE))):
+                    break
+                digest.update(data)
+                size -= len(data)
+        return digest.hexdigest()
+
+    def _hash_files(
+        self,
+        pool: concurrent.futures.Executor,
+        files: list[tuple[str, str]],
+        size: int,
+    ) -> dict[tuple[str, str], str | None]:
+        """
+        Hash the first ``size`` bytes of each file, in parallel.
+
+        :returns: a dict mapping ``(image, relpath)`` to the hash, or None if
+          the file could not be read
+        """
+
+        def hash_file(file: tuple[str, str]) -> str | None:
+            try:
+                return self._hash_file(file[0], file[1], size)
+            except OSError as e:
+                log.warning("%s/%s: cannot read: %s", file[0], file[1], e)
+                return None
+
+        return dict(zip(files, pool.map(hash_file, files)))
+
+    def content_groups(self, jobs: int | None = None) -> Iterator[ContentGroup]:
+        """
+        Generate groups of files with the same contents, regardless of their
+        path.
+
+        Files are bucketed by size, then by a hash of their first
+        :attr:`PREFIX_SIZE` bytes, and only then the whole contents are hashed.
+        Full hashes are stored in the index and reused across runs.
+
+        A group is generated if at least one of its files changed since it was
+        last deduplicated by content.
+
+        :param jobs: number of threads used to hash files
+        """
+        assert self.db is not None
+        sizes = [
+            size
+            for (size,) in self.db.execute(
+                "SELECT size FROM files WHERE size >= ? GROUP BY size"
+                " HAVING count(*) > 1 AND min(content_deduped) = 0",
+                (self.CONTENT_MIN_SIZE,),
+            ).fetchall()
+        ]
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=jobs or min(8, os.cpu_count() or 1),
+            thread_name_prefix="dedupe-hash",
+        ) as pool:
+            for size in sizes:
+                yield from self._content_groups_for_size(pool, size)
+
+    def _content_groups_for_size(
+        self, pool: concurrent.futures.Executor, size: int
+    ) -> Iterator[ContentGroup]:
+        """Generate content groups for files of the given size."""
+        assert self.db is not None
+        hashes: dict[tuple[str, str], str | None] = {}
+        changed: set[tuple[str, str]] = set()
+        seen_inodes: set[tuple[str, int]] = set()
+        # Files that do not need to be looked at again until they change
+        done: list[tuple[str, str]] = []
+        for image, relpath, ino, digest, deduped in self.db.execute(
+            "SELECT image, relpath, ino, hash, content_deduped FROM files"
+            " WHERE size=? ORDER BY image, relpath",
+            (size,),
+        ):
+            # Skip hardlinks to files already seen
+            if (image, ino) in seen_inodes:
+                done.append((image, relpath))
+                continue
+            seen_inodes.add((image, ino))
+            hashes[(image, relpath)] = digest
+            if not deduped:
+                changed.add((image, relpath))
+
+        # Bucket files by their prefix hash, and only compute full hashes
+        # when the prefix hashes collide
+        unhashed = [file for file, digest in hashes.items() if digest is None]
+        computed: dict[tuple[str, str], str | None] = {}
+        if size <= self.PREFIX_SIZE:
+            computed = self._hash_files(pool, unhashed, size)
+        elif unhashed:
+            by_prefix: dict[str, list[tuple[str, str]]] = {}
+            for file, prefix in self._hash_files(
+                pool, list(hashes), self.PREFIX_SIZE
+            ).items():
+                if prefix is not None:
+                    by_prefix.setdefault(prefix, []).append(file)
+            candidates: list[tuple[str, str]] = []
+            for files in by_prefix.values():
+                if len(files) > 1:
+                    candidates.extend(f for f in files if hashes[f] is None)
+                elif hashes[files[0]] is None:
+                    done.append(files[0])
+            computed = self._hash_files(pool, candidates, size)
+
+        for file, digest in computed.items():
+            if digest is None:
+                continue
+            hashes[file] = digest
+            self.db.execute(
+                "UPDATE files SET hash=? WHERE image=? AND relpath=?",
+                (digest, *file),
+            )
+        self._changed(len(computed))
+
+        by_hash: dict[str, list[tuple[str, str]]] = {}
+        for file, digest in hashes.items():
+            if digest is not None:
+                by_hash.setdefault(digest, []).append(file)
+
+        for digest, files in by_hash.items():
+            if len(files) < 2:
+                done.append(files[0])
+            elif changed.intersection(files):
+                yield ContentGroup(
+                    size,
+                    digest,
+                    files,
+                    [file for file in files if file in changed],
+                )
+
+        self.db.executemany(
+            "UPDATE files SET content_deduped=1 WHERE image=? AND relpath=?",
+            done,
+        )
+        self._changed(len(done))
+
+    def mark_content_deduped(self, group: ContentGroup) -> None:
+        """Record that all files in the group have been deduplicated."""
+        assert self.db is not None
+        self.db.executemany(
+            "UPDATE files SET content_deduped=1 WHERE image=? AND relpath=?",
+            group.files,
+        )
+        self._changed()
+
+
+class DedupeJob(NamedTuple):
+    """Deduplicate a set of files against a reference one."""
+
+    #: Reference file
+    src: str
+    #: Files to deduplicate against the reference
+    dsts: list[str]
+    #: Size of all the files
+    size: int
+
+
+def format_size(size: float) -> str:
+    """Format a size in bytes in a human-readable way."""
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if size < 1024:
+            break
+        size /= 1024
+    return f"{size:.1f}{unit}"
+
+
+class DedupeProgress:
+    """
+    Keep track of deduplication progress and periodically log it.
+    """
+
+    def __init__(self, total: int, interval: float = 5.0) -> None:
+        #: Total number of bytes that need to be scanned
+        self.total = total
+        #: Seconds between progress reports
+        self.interval = interval
+        #: Number of bytes scanned so far
+        self.scanned = 0
+        #: Number of bytes newly deduplicated so far
+        self.reclaimed = 0
+        #: Number of bytes found already shared so far
+        self.shared = 0
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.lock = threading.Lock()
+
+    def add(self, scanned: int, result: DedupeResult) -> None:
+        """Account for work done."""
+        with self.lock:
+            self.scanned += scanned
+            self.reclaimed += result.reclaimed
+            self.shared += result.shared
+
+    def eta(self) -> float | None:
+        """
+        Estimate the number of seconds until the end of the work.
+
+        :returns: None if no estimate is yet possible
+        """
+        elapsed = time.monotonic() - self.started
+        if not self.scanned or not elapsed:
+            return None
+        return elapsed * (self.total - self.scanned) / self.scanned
+
+    def report(self, force: bool = False) -> None:
+        """Log progress, if enough time has passed since the last report."""
+        now = time.monotonic()
+        if not force and now - self.last_report < self.interval:
+            return
+        self.last_report = now
+        eta = self.eta()
+        log.info(
+            "Deduplication: %s/%s scanned, %s reclaimed, %s already shared,"
+            " ETA %s",
+            format_size(self.scanned),
+            format_size(self.total),
+            format_size(self.reclaimed),
+            format_size(self.shared),
+            "unknown" if eta is None else f"{eta:.0f}s",
+        )
+
+
+class DedupeExecutor[T]:
+    """
+    Run deduplication jobs on a pool of worker threads.
+
+    The deduplication ioctl releases the GIL, so multiple threads can keep the
+    storage busy.
+
+    Jobs are tagged with a caller-defined value of type ``T``, and they are
+    consumed and their results returned in the calling thread, so that they
+    can be used with objects like :class:`DedupIndex` that are not thread
+    safe.
+    """
+
+    def __init__(self, jobs: int | None = None) -> None:
+        #: Number of worker threads
+        self.jobs = jobs or min(8, os.cpu_count() or 1)
+        #: Maximum number of jobs queued to the workers at any time
+        self.max_pending = self.jobs * 4
+
+    def _dedupe(self, job: DedupeJob) -> DedupeResult:
+        """
+        Run a deduplication job.
+
+        Errors are logged, and counted in the ``failed`` field of the result.
+        """
+        try:
+            return do_dedupe_multi(job.src, job.dsts, job.size)
+        except OSError as e:
+            # Files can change or disappear while we work
+            log.warning("%s: cannot deduplicate: %s", job.src, e)
+            return DedupeResult(failed=len(job.dsts))
+
+    def run(
+        self, work: Iterable[tuple[T, DedupeJob]], progress: DedupeProgress
+    ) -> Iterator[tuple[T, DedupeResult]]:
+        """
+        Run deduplication jobs.
+
+        :returns: an iterator of ``(tag, result)`` for each job, in order of
+          completion
+        """
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.jobs, thread_name_prefix="dedupe"
+        ) as pool:
+            pending: dict[
+                concurrent.futures.Future[DedupeResult], tuple[T, DedupeJob]
+            ] = {}
+
+            def collect() -> Iterator[tuple[T, DedupeResult]]:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    tag, job = pending.pop(future)
+                    result = future.result()
+                    progress.add(job.size * len(job.dsts), result)
+                    yield tag, result
+                progress.report()
+
+            for tag, job in work:
+                if len(pending) >= self.max_pending:
+                    yield from collect()
+                pending[pool.submit(self._dedupe, job)] = (tag, job)
+
+            while pending:
+                yield from collect()
+        progress.report(force=True)
@@ -1,4 +1,5 @@
 import contextlib
+import ctypes
 import logging
 import os
 import tempfile
@@ -8,6 +9,10 @@ from typing import Any, IO
 
 log = logging.getLogger(__name__)
 
+# See renameat2(2)
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
 
 @contextlib.contextmanager
 def atomic_writer(
@@ -91,6 +96,26 @@ def cd(path: str) -> Generator[None, None, None]:
         os.chdir(cwd)
 
 
+def exchange_paths(a: Path, b: Path) -> None:
+    """
+    Atomically exchange two paths, which both need to exist on the same
+    filesystem
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    if (
+        libc.renameat2(
+            AT_FDCWD,
+            os.fsencode(a),
+            AT_FDCWD,
+            os.fsencode(b),
+            RENAME_EXCHANGE,
+        )
+        != 0
+    ):
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno), a, None, b)
+
+
 @contextlib.contextmanager
 def dirfd(path: Path) -> Generator[int]:
     """
@@ -0,0 +1,255 @@
+"""
+Client for systemd and systemd-machined on the system D-Bus
+"""
+
+import logging
+import re
+import time
+from typing import Any
+
+try:
+    from jeepney import DBusAddress, MatchRule, Properties, new_method_call
+    from jeepney.bus_messages import message_bus
+    from jeepney.io.blocking import DBusConnection, open_dbus_connection
+    from jeepney.wrappers import unwrap_msg
+
+    HAVE_JEEPNEY = True
+except ModuleNotFoundError:
+    HAVE_JEEPNEY = False
+
+log = logging.getLogger(__name__)
+
+#: D-Bus signature and value of a unit property
+UnitProperty = tuple[str, tuple[str, Any]]
+
+#: Seconds to wait for a transient unit to start
+START_TIMEOUT = 300
+
+re_timespan = re.compile(r"^(\d+)\s*(us|ms|s|min|h)?$")
+
+TIMESPAN_UNITS = {
+    "us": 1,
+    "ms": 1_000,
+    "s": 1_000_000,
+    "min": 60_000_000,
+    "h": 3_600_000_000,
+}
+
+re_size = re.compile(r"^(\d+)\s*([KMGTPE]?)$")
+
+SIZE_UNITS = "KMGTPE"
+
+#: Value used by systemd for unlimited sizes
+UINT64_MAX = 2**64 - 1
+UINT32_MAX = 2**32 - 1
+
+
+def parse_timespan(value: str) -> int:
+    """Parse a simple systemd time span, returning microseconds."""
+    if not (mo := re_timespan.match(value.strip())):
+        raise ValueError(f"unsupported time span {value!r}")
+    return int(mo.group(1)) * TIMESPAN_UNITS[mo.group(2) or "s"]
+
+
+def parse_size(value: str) -> int:
+    """
+    Parse a systemd size in bytes, with an optional base 1024 suffix, or
+    ``infinity``.
+    """
+    value = value.strip()
+    if value == "infinity":
+        return UINT64_MAX
+    if not (mo := re_size.match(value)):
+        raise ValueError(f"unsupported size {value!r}")
+    if not (unit := mo.group(2)):
+        return int(mo.group(1))
+    return int(mo.group(1)) << (10 * (SIZE_UNITS.index(unit) + 1))
+
+
+def parse_percent(value: str) -> float:
+    """Parse a percentage like ``50%``."""
+    value = value.strip()
+    if not value.endswith("%"):
+        raise ValueError(f"{value!r} is not a percentage")
+    return float(value[:-1])
+
+
+def parse_cpu_set(value: str) -> bytes:
+    """
+    Parse a list of CPUs like ``0-3,6``, returning it as the bit mask used by
+    systemd.
+    """
+    cpus: set[int] = set()
+    for item in value.replace(",", " ").split():
+        first, _, last = item.partition("-")
+        cpus.update(range(int(first), int(last or first) + 1))
+    if not cpus:
+        return b""
+    mask = bytearray(max(cpus) // 8 + 1)
+    for cpu in cpus:
+        mask[cpu // 8] |= 1 << (cpu % 8)
+    return bytes(mask)
+
+
+def unit_properties(assignments: list[str]) -> list[UnitProperty]:
+    """
+    Convert ``Name=value`` unit property assignments, as given to
+    ``systemd-run --property``, to typed D-Bus unit properties.
+
+    Only the properties used by Moncic-CI are supported.
+    """
+    res: list[UnitProperty] = []
+    for assignment in assignments:
+        name, value = assignment.split("=", 1)
+        match name:
+            case "KillMode" | "Type" | "Slice" | "CollectMode":
+                res.append((name, ("s", value)))
+            case "CPUWeight" | "IOWeight":
+                res.append((name, ("t", int(value))))
+            case "CPUQuota":
+                # Microseconds of CPU time per second
+                usec = int(parse_percent(value) * 10_000)
+                res.append(("CPUQuotaPerSecUSec", ("t", usec)))
+            case "AllowedCPUs":
+                res.append((name, ("ay", parse_cpu_set(value))))
+            case "MemoryHigh" | "MemoryMax" if value.strip().endswith("%"):
+                scale = int(parse_percent(value) / 100 * UINT32_MAX)
+                res.append((f"{name}Scale", ("u", scale)))
+            case "MemoryHigh" | "MemoryMax":
+                res.append((name, ("t", parse_size(value))))
+            case "Delegate":
+                res.append((name, ("b", value == "yes")))
+            case "TasksMax":
+                res.append((name, ("t", int(value))))
+            case "WatchdogSec":
+                res.append(("WatchdogUSec", ("t", parse_timespan(value))))
+            case "RestartForceExitStatus" | "SuccessExitStatus":
+                statuses = [int(v) for v in value.split()]
+                res.append((name, ("(aiai)", (statuses, []))))
+            case _:
+                raise ValueError(f"unsupported unit property {name!r}")
+    return res
+
+
+class Machined:
+    """
+    Persistent connection to the system D-Bus, used to start transient
+    units and to query registered machines without running ``systemd-run``
+    and ``machinectl``.
+    """
+
+    def __init__(self, conn: "DBusConnection") -> None:
+        self.conn = conn
+        self.systemd = DBusAddress(
+            "/org/freedesktop/systemd1",
+            bus_name="org.freedesktop.systemd1",
+            interface="org.freedesktop.systemd1.Manager",
+        )
+        self.machine1 = DBusAddress(
+            "/org/freedesktop/machine1",
+            bus_name="org.freedesktop.machine1",
+            interface="org.freedesktop.machine1.Manager",
+        )
+        self._call(self.systemd, "Subscribe")
+        self.job_removed = MatchRule(
+            type="signal",
+            sender="org.freedesktop.systemd1",
+            interface="org.freedesktop.systemd1.Manager",
+            member="JobRemoved",
+            path="/org/freedesktop/systemd1",
+        )
+        self._call_msg(message_bus.AddMatch(self.job_removed))
+
+    @classmethod
+    def connect(cls) -> "Machined | None":
+        """
+        Connect to the system D-Bus.
+
+        This needs to be called with root privileges, which the connection
+        keeps after they are dropped.
+
+        :returns: None if the connection is not possible
+        """
+        if not HAVE_JEEPNEY:
+            return None
+        try:
+            conn = open_dbus_connection(bus="SYSTEM")
+        except (OSError, KeyError) as e:
+            log.debug("cannot connect to the system D-Bus: %s", e)
+            return None
+        try:
+            return cls(conn)
+        except Exception as e:
+            log.debug("cannot subscribe to systemd signals: %s", e)
+            conn.close()
+            return None
+
+    def close(self) -> None:
+        """Close the connection."""
+        self.conn.close()
+
+    def _call_msg(self, msg: Any) -> tuple[Any, ...]:
+        """Send a method call and return the body of its reply."""
+        body: tuple[Any, ...] = unwrap_msg(self.conn.send_and_get_reply(msg))
+        return body
+
+    def _call(
+        self,
+        address: "DBusAddress",
+        method: str,
+        signature: str | None = None,
+        body: tuple[Any, ...] = (),
+    ) -> tuple[Any, ...]:
+        """Call a D-Bus method and return the body of its reply."""
+        return self._call_msg(new_method_call(address, method, signature, body))
+
+    def start_transient_unit(
+        self,
+        unit: str,
+        argv: list[str],
+        properties: list[UnitProperty],
+        timeout: float = START_TIMEOUT,
+    ) -> None:
+        """
+        Start a transient service running argv, and wait until its start job
+        has completed.
+
+        :raises RuntimeError: if the unit failed to start
+        :raises TimeoutError: if the start job did not complete in time
+        """
+        properties = properties + [
+            ("Description", ("s", argv[0])),
+            ("ExecStart", ("a(sasb)", [(argv[0], argv, False)])),
+        ]
+        deadline = time.monotonic() + timeout
+        with self.conn.filter(self.job_removed) as signals:
+            (job,) = self._call(
+                self.systemd,
+                "StartTransientUnit",
+                "ssa(sv)a(sa(sv))",
+                (unit, "fail", properties, []),
+            )
+            while True:
+                # Signals about other jobs do not extend the timeout
+                signal = self.conn.recv_until_filtered(
+                    signals, timeout=max(deadline - time.monotonic(), 0)
+                )
+                _, removed_job, _, result = signal.body
+                if removed_job == job:
+                    break
+        if result != "done":
+            raise RuntimeError(f"{unit}: start job finished with {result!r}")
+
+    def machine_properties(self, name: str) -> dict[str, str]:
+        """
+        Return the properties of a registered machine, formatted as strings
+        like in ``machinectl show``.
+        """
+        (path,) = self._call(self.machine1, "GetMachine", "s", (name,))
+        machine = DBusAddress(
+            path,
+            bus_name="org.freedesktop.machine1",
+            interface="org.freedesktop.machine1.Machine",
+        )
+        (properties,) = self._call_msg(Properties(machine).get_all())
+        return {key: str(value) for key, (_, value) in properties.items()}
@@ -0,0 +1,118 @@
+"""
+Track processes that are not children of this one
+"""
+
+import errno
+import os
+import select
+import signal
+import time
+from pathlib import Path
+from types import TracebackType
+from typing import Self
+
+#: Interval between checks when pidfds are not available
+POLL_INTERVAL = 0.01
+
+#: Mount point of the unified cgroup hierarchy
+CGROUP_ROOT = Path("/sys/fs/cgroup")
+
+
+class ProcessHandle:
+    """
+    Handle to a running process, to signal it and wait for it to exit.
+
+    A pidfd is used if the kernel supports it, so that the process cannot be
+    confused with a new one reusing its pid, and waiting does not need
+    polling.
+    """
+
+    def __init__(self, pid: int) -> None:
+        self.pid = pid
+        #: pidfd referring to the process, or None if unsupported
+        self.pidfd: int | None = None
+        #: Set to True when the process is known to have exited
+        self.exited = False
+        try:
+            self.pidfd = os.pidfd_open(pid)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                self.exited = True
+            elif e.errno not in (errno.ENOSYS, errno.EPERM):
+                raise
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Release the pidfd."""
+        if self.pidfd is not None:
+            os.close(self.pidfd)
+            self.pidfd = None
+
+    def send_signal(self, sig: int) -> None:
+        """Send a signal to the process, if it is still running."""
+        if self.exited:
+            return
+        try:
+            if self.pidfd is not None:
+                signal.pidfd_send_signal(self.pidfd, sig)
+            else:
+                os.kill(self.pid, sig)
+        except ProcessLookupError:
+            self.exited = True
+
+    def _is_running(self) -> bool:
+        """Check if the process is running, without pidfd."""
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            return False
+        return True
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """
+        Wait for the process to exit.
+
+        :param timeout: maximum number of seconds to wait, or None to wait
+          forever
+        :returns: True if the process exited, False on timeout
+        """
+        if self.exited:
+            return True
+        if self.pidfd is not None:
+            poll = select.poll()
+            poll.register(self.pidfd, select.POLLIN)
+            self.exited = bool(
+                poll.poll(None if timeout is None else int(timeout * 1000))
+            )
+            return self.exited
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._is_running():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(POLL_INTERVAL)
+        self.exited = True
+        return True
+
+
+def process_cgroup(pid: int) -> Path | None:
+    """
+    Return the path of the unified cgroup hierarchy directory of a process.
+
+    :returns: None if the process is not in a cgroup v2 hierarchy
+    """
+    for line in Path(f"/proc/{pid}/cgroup").read_text().splitlines():
+        hierarchy, controllers, path = line.split(":", 2)
+        if hierarchy == "0" and not controllers:
+            return CGROUP_ROOT / path.lstrip("/")
+    return None
@@ -0,0 +1,69 @@
+"""
+Resource controls for containers, applied as systemd unit properties
+"""
+
+from collections.abc import Mapping
+from typing import Any
+
+from .machined import unit_properties
+
+#: Supported resource control settings, and the systemd unit property each
+#: of them sets
+RESOURCE_CONTROLS = {
+    "cpu_weight": "CPUWeight",
+    "cpu_quota": "CPUQuota",
+    "allowed_cpus": "AllowedCPUs",
+    "memory_high": "MemoryHigh",
+    "memory_max": "MemoryMax",
+    "io_weight": "IOWeight",
+}
+
+#: Resource control settings applied to containers of each priority class.
+#: The systemd default for weights is 100
+PRIORITY_CLASSES: dict[str, dict[str, str]] = {
+    "interactive": {"cpu_weight": "1000", "io_weight": "1000"},
+    "batch": {"cpu_weight": "50", "io_weight": "50"},
+}
+
+
+def load_resources(conf: Mapping[str, Any] | None) -> dict[str, str]:
+    """
+    Validate resource control settings from a configuration file.
+
+    Values are checked with the same parsers used to start containers via
+    D-Bus, so that they are accepted the same way with and without it.
+
+    :returns: the settings, with values converted to strings
+    :raises ValueError: if a setting or its value is not supported
+    """
+    if not conf:
+        return {}
+    res: dict[str, str] = {}
+    for name, value in conf.items():
+        if name not in RESOURCE_CONTROLS:
+            raise ValueError(
+                f"unsupported resource control {name!r}: supported are"
+                f" {', '.join(RESOURCE_CONTROLS)}"
+            )
+        res[name] = str(value)
+        try:
+            unit_properties([f"{RESOURCE_CONTROLS[name]}={res[name]}"])
+        except ValueError as e:
+            raise ValueError(
+                f"invalid value {res[name]!r} for resource control {name!r}"
+            ) from e
+    return res
+
+
+def resource_unit_config(*layers: Mapping[str, str]) -> list[str]:
+    """
+    Convert resource control settings to ``Name=value`` unit properties.
+
+    Settings in later layers override those in earlier ones.
+    """
+    merged: dict[str, str] = {}
+    for layer in layers:
+        merged.update(layer)
+    return [
+        f"{RESOURCE_CONTROLS[name]}={value}" for name, value in merged.items()
+    ]
@@ -8,6 +8,22 @@ from typing import Any
 
 log = logging.getLogger("run")
 
+#: Directory containing the moncic package
+PACKAGE_ROOT = Path(__file__).parent.parent.parent
+
+
+def moncic_env() -> dict[str, str]:
+    """
+    Build the environment for running Python subprocesses which import this
+    moncic package, also when running from a source checkout.
+    """
+    env = dict(os.environ)
+    if pythonpath := env.get("PYTHONPATH"):
+        env["PYTHONPATH"] = f"{PACKAGE_ROOT.as_posix()}:{pythonpath}"
+    else:
+        env["PYTHONPATH"] = PACKAGE_ROOT.as_posix()
+    return env
+
 
 def log_run(cmd: Sequence[str], **kw: Any) -> None:
     """
@@ -35,3 +51,21 @@ def run(
     """
     log_run(cmd, **kw)
     return subprocess.run(cmd, check=check, **kw)
+
+
+def spawn_detached(cmd: list[str], logfile: Path) -> None:
+    """
+    Start a process which keeps running after Moncic-CI exits, appending its
+    output to logfile.
+
+    The process runs with the environment from :func:`moncic_env`.
+    """
+    with logfile.open("ab") as fd:
+        subprocess.Popen(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=fd,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+            env=moncic_env(),
+        )
@@ -187,3 +187,83 @@ class Script:
         print(file=file)
         for lineno, line in enumerate(self.lines, start=1):
             print(f"{lineno:03d} {line}", file=file)
+
+
+class ScriptBatch:
+    """
+    Scripts queued to be run together, in as few invocations as possible.
+
+    Consecutive scripts with the same user, working directory and network
+    settings are merged into a single script, where each one runs as a
+    separate step in a subshell. A failing step is reported with its title.
+    """
+
+    def __init__(self, title: str, *, keep_going: bool = False) -> None:
+        self.title = title
+        #: Run all steps even if some fail, then fail at the end
+        self.keep_going = keep_going
+        self.scripts: list[Script] = []
+
+    def __bool__(self) -> bool:
+        """Check if the batch contains any script."""
+        return bool(self.scripts)
+
+    def add(self, script: Script) -> None:
+        """Queue a script."""
+        if script:
+            self.scripts.append(script)
+
+    def _add_step(self, merged: Script, script: Script) -> None:
+        """Append a script as a step of a merged script."""
+        title = shlex.quote(script.title)
+        merged.add_line(f"# {script.title}")
+        merged.add_line("set +e")
+        merged.add_line("(")
+        merged.indent += 4
+        merged.add_line("set -e")
+        for line in script.lines:
+            merged.add_line(line)
+        merged.indent -= 4
+        merged.add_line(")")
+        merged.add_line("MONCIC_RC=$?")
+        merged.add_line("set -e")
+        with merged.if_("[ $MONCIC_RC -ne 0 ]"):
+            merged.add_line(f"echo 'Failed step:' {title} >&2")
+            if self.keep_going:
+                merged.add_line("MONCIC_FAILED=1")
+            else:
+                merged.add_line("exit $MONCIC_RC")
+
+    def _merge(self, scripts: list[Script]) -> Script:
+        """Merge compatible scripts into one."""
+        if len(scripts) == 1:
+            return scripts[0]
+        first = scripts[0]
+        merged = Script(
+            f"{self.title}: " + ", ".join(s.title for s in scripts),
+            cwd=first.cwd,
+            user=first.user,
+            disable_network=first.disable_network,
+        )
+        merged.add_line("MONCIC_FAILED=")
+        for script in scripts:
+            self._add_step(merged, script)
+        merged.add_line('[ -z "$MONCIC_FAILED" ]')
+        return merged
+
+    def merged(self) -> list[Script]:
+        """Return the scripts to run, merging compatible ones."""
+        res: list[Script] = []
+        group: list[Script] = []
+        for script in self.scripts:
+            if group and (
+                script.cwd != group[0].cwd
+                or script.user != group[0].user
+                or script.disable_network != group[0].disable_network
+            ):
+                res.append(self._merge(group))
+                group = []
+            group.append(script)
+        if group:
+            res.append(self._merge(group))
+        return res
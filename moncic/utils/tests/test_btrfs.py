@@ -0,0 +1,115 @@
+import errno
+import tempfile
+import unittest
+from pathlib import Path
+from typing import override
+from unittest import mock
+
+from moncic.moncic import MoncicConfig
+from moncic.utils.btrfs import Subvolume
+
+
+class RecordingSubvolume(Subvolume):
+    """Subvolume that records commands instead of running them."""
+
+    def __init__(self, path: Path, compression: str | None = None) -> None:
+        super().__init__(MoncicConfig(), path, compression)
+        self.commands: list[list[str]] = []
+
+    @override
+    def local_run(self, cmd: list[str]) -> None:
+        self.commands.append(cmd)
+
+
+class TestSubvolume(unittest.TestCase):
+    @override
+    def setUp(self) -> None:
+        super().setUp()
+        self.workdir = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        # Make ioctls fail as they do outside of btrfs, regardless of the
+        # filesystem of the test directory and of privileges
+        not_btrfs = OSError(errno.ENOTTY, "Inappropriate ioctl for device")
+        self.enterContext(
+            mock.patch("moncic.utils.btrfs.fcntl.ioctl", side_effect=not_btrfs)
+        )
+        self.enterContext(
+            mock.patch("moncic.utils.btrfs.os.setxattr", side_effect=not_btrfs)
+        )
+
+    def test_fallback(self) -> None:
+        # ioctls fail and the command line tool is used
+        path = self.workdir / "test"
+        subvolume = RecordingSubvolume(path, "zstd")
+        with subvolume.create():
+            pass
+        subvolume.snapshot(self.workdir)
+        self.assertEqual(
+            subvolume.commands,
+            [
+                ["btrfs", "-q", "subvolume", "create", path.as_posix()],
+                [
+                    "btrfs",
+                    "-q",
+                    "property",
+                    "set",
+                    path.as_posix(),
+                    "compression",
+                    "zstd",
+                ],
+                [
+                    "btrfs",
+                    "-q",
+                    "subvolume",
+                    "snapshot",
+                    self.workdir.as_posix(),
+                    path.as_posix(),
+                ],
+            ],
+        )
+
+    def test_ioctl(self) -> None:
+        # When ioctls work, the command line tool is not used
+        path = self.workdir / "test"
+        subvolume = RecordingSubvolume(path)
+        with mock.patch("moncic.utils.btrfs.fcntl.ioctl") as ioctl:
+            subvolume.snapshot(self.workdir)
+        ioctl.assert_called_once()
+        self.assertEqual(subvolume.commands, [])
+
+    def test_no_ioctl(self) -> None:
+        path = self.workdir / "test"
+        subvolume = RecordingSubvolume(path)
+        subvolume.use_ioctl = False
+        subvolume.snapshot(self.workdir)
+        self.assertEqual(
+            subvolume.commands,
+            [
+                [
+                    "btrfs",
+                    "-q",
+                    "subvolume",
+                    "snapshot",
+                    self.workdir.as_posix(),
+                    path.as_posix(),
+                ],
+            ],
+        )
+
+    def test_readonly_snapshot(self) -> None:
+        path = self.workdir / "test"
+        subvolume = RecordingSubvolume(path)
+        subvolume.snapshot(self.workdir, readonly=True)
+        self.assertEqual(
+            subvolume.commands,
+            [
+                [
+                    "btrfs",
+                    "-q",
+                    "subvolume",
+                    "snapshot",
+                    "-r",
+                    self.workdir.as_posix(),
+                    path.as_posix(),
+                ],
+            ],
+        )
@@ -0,0 +1,83 @@
+import asyncio
+import unittest
+
+from moncic.utils.dag import DependencyGraph, TaskStatus
+
+
+class TestDependencyGraph(unittest.TestCase):
+    def make_graph(self) -> DependencyGraph:
+        graph = DependencyGraph()
+        graph.add("base")
+        graph.add("child1", ["base"])
+        graph.add("child2", ["base"])
+        graph.add("grandchild", ["child1"])
+        graph.add("other")
+        return graph
+
+    def run_graph(
+        self, graph: DependencyGraph, jobs: int, fail: set[str] = set()
+    ) -> tuple[dict[str, TaskStatus], list[str], int]:
+        started: list[str] = []
+        running = 0
+        max_running = 0
+
+        async def work(name: str) -> bool:
+            nonlocal running, max_running
+            started.append(name)
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            if name == "raise":
+                raise RuntimeError("test")
+            return name not in fail
+
+        status = asyncio.run(graph.run(work, jobs=jobs))
+        return status, started, max_running
+
+    def test_sequential(self) -> None:
+        status, started, max_running = self.run_graph(self.make_graph(), 1)
+        self.assertEqual(max_running, 1)
+        self.assertEqual(set(status.values()), {TaskStatus.OK})
+        self.assertEqual(len(started), 5)
+        self.assertLess(started.index("base"), started.index("child1"))
+        self.assertLess(started.index("child1"), started.index("grandchild"))
+
+    def test_parallel(self) -> None:
+        status, started, max_running = self.run_graph(self.make_graph(), 2)
+        self.assertEqual(max_running, 2)
+        self.assertEqual(set(status.values()), {TaskStatus.OK})
+        self.assertEqual(started[:2], ["base", "other"])
+        self.assertLess(started.index("child1"), started.index("grandchild"))
+
+    def test_failure(self) -> None:
+        graph = self.make_graph()
+        graph.add("raise")
+        graph.add("after_raise", ["raise"])
+        status, started, _ = self.run_graph(graph, 4, fail={"child1"})
+        self.assertEqual(
+            status,
+            {
+                "base": TaskStatus.OK,
+                "child1": TaskStatus.FAILED,
+                "child2": TaskStatus.OK,
+                "grandchild": TaskStatus.SKIPPED,
+                "other": TaskStatus.OK,
+                "raise": TaskStatus.FAILED,
+                "after_raise": TaskStatus.SKIPPED,
+            },
+        )
+        self.assertNotIn("grandchild", started)
+        self.assertNotIn("after_raise", started)
+
+    def test_check(self) -> None:
+        graph = self.make_graph()
+        graph.check()
+        graph.add("base", ["grandchild"])
+        with self.assertRaisesRegex(ValueError, "dependency loop"):
+            graph.check()
+
+        graph = DependencyGraph()
+        graph.add("test", ["missing"])
+        with self.assertRaisesRegex(ValueError, "unknown task missing"):
+            graph.check()
@@ -0,0 +1,229 @@
+import hashlib
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from typing import override
+
+from moncic.utils.btrfs import (
+    DedupeResult,
+    Extent,
+    do_dedupe_multi,
+    extents_shared,
+    get_extents,
+)
+from moncic.utils.dedup import (
+    DedupeExecutor,
+    DedupeJob,
+    DedupeProgress,
+    DedupIndex,
+    format_size,
+)
+
+
+class TestDedupIndex(unittest.TestCase):
+    @override
+    def setUp(self) -> None:
+        super().setUp()
+        self.imagedir = Path(self.enterContext(tempfile.TemporaryDirectory()))
+
+    def make_file(
+        self, image: str, relpath: str, data: bytes, mtime: int = 1
+    ) -> None:
+        path = self.imagedir / image / relpath
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        os.utime(path, (mtime, mtime))
+
+    def update(self, index: DedupIndex) -> None:
+        names = {"img1", "img2", "img3"}
+        for name in names:
+            if (self.imagedir / name).is_dir():
+                index.update_image(name, self.imagedir / name)
+        index.prune(names)
+
+    def test_incremental(self) -> None:
+        self.make_file("img1", "etc/a", b"test")
+        self.make_file("img2", "etc/a", b"test")
+        self.make_file("img2", "etc/b", b"test")
+        self.make_file("img3", "etc/a", b"other size")
+
+        with DedupIndex(self.imagedir) as index:
+            self.update(index)
+            groups = list(index.pending_groups())
+            self.assertEqual(len(groups), 1)
+            group = groups[0]
+            self.assertEqual(group.relpath, "etc/a")
+            self.assertEqual(group.size, 4)
+            self.assertEqual(group.images, ["img1", "img2"])
+            self.assertEqual(group.changed, ["img1", "img2"])
+            index.mark_deduped(group)
+            self.assertEqual(list(index.pending_groups()), [])
+
+        # The index is persistent: nothing to do if nothing changed
+        with DedupIndex(self.imagedir) as index:
+            self.update(index)
+            self.assertEqual(list(index.pending_groups()), [])
+
+        # Changing a file only reports the changed file
+        self.make_file("img2", "etc/a", b"tset", mtime=2)
+        with DedupIndex(self.imagedir) as index:
+            self.update(index)
+            groups = list(index.pending_groups())
+            self.assertEqual(len(groups), 1)
+            self.assertEqual(groups[0].images, ["img1", "img2"])
+            self.assertEqual(groups[0].changed, ["img2"])
+
+    def test_prune(self) -> None:
+        self.make_file("img1", "etc/a", b"test")
+        self.make_file("img2", "etc/a", b"test")
+
+        with DedupIndex(self.imagedir) as index:
+            self.update(index)
+            self.assertEqual(len(list(index.pending_groups())), 1)
+            index.prune({"img1"})
+            self.assertEqual(list(index.pending_groups()), [])
+
+    def test_content(self) -> None:
+        data = b"x" * 5000
+        self.make_file("img1", "usr/lib/a", data)
+        self.make_file("img2", "usr/share/b", data)
+        self.make_file("img2", "usr/share/c", b"y" * 5000)
+        # Same prefix, different contents
+        self.make_file("img3", "srv/d", b"x" * 4999 + b"z")
+        # Too small to be considered
+        self.make_file("img1", "etc/small", b"test")
+        self.make_file("img2", "etc/small2", b"test")
+
+        with DedupIndex(self.imagedir) as index:
+            # Exercise both prefix and full hashing, reading in chunks
+            index.PREFIX_SIZE = 1024
+            index.HASH_CHUNK_SIZE = 1000
+            self.update(index)
+            groups = list(index.content_groups())
+            self.assertEqual(len(groups), 1)
+            group = groups[0]
+            self.assertEqual(group.size, 5000)
+            self.assertEqual(
+                group.files, [("img1", "usr/lib/a"), ("img2", "usr/share/b")]
+            )
+            self.assertEqual(group.changed, group.files)
+            index.mark_content_deduped(group)
+            self.assertEqual(list(index.content_groups()), [])
+
+        # Only changed files are looked at again
+        self.make_file("img3", "srv/d", data, mtime=2)
+        with DedupIndex(self.imagedir) as index:
+            self.update(index)
+            groups = list(index.content_groups())
+            self.assertEqual(len(groups), 1)
+            self.assertEqual(
+                groups[0].files,
+                [
+                    ("img1", "usr/lib/a"),
+                    ("img2", "usr/share/b"),
+                    ("img3", "srv/d"),
+                ],
+            )
+            self.assertEqual(groups[0].changed, [("img3", "srv/d")])
+
+    def test_hash_file(self) -> None:
+        data = bytes(range(256)) * 20
+        self.make_file("img1", "usr/lib/a", data)
+        with DedupIndex(self.imagedir) as index:
+            index.HASH_CHUNK_SIZE = 1000
+            for size in (100, 1000, 2500, len(data), len(data) + 1):
+                with self.subTest(size=size):
+                    self.assertEqual(
+                        index._hash_file("img1", "usr/lib/a", size),
+                        hashlib.sha256(data[:size]).hexdigest(),
+                    )
+
+
+class TestDedupeExecutor(unittest.TestCase):
+    @override
+    def setUp(self) -> None:
+        super().setUp()
+        self.workdir = Path(self.enterContext(tempfile.TemporaryDirectory()))
+
+    def test_format_size(self) -> None:
+        self.assertEqual(format_size(10), "10.0B")
+        self.assertEqual(format_size(1536), "1.5KiB")
+        self.assertEqual(format_size(3 * 1024**3), "3.0GiB")
+
+    def test_progress(self) -> None:
+        progress = DedupeProgress(100)
+        self.assertIsNone(progress.eta())
+        progress.add(50, DedupeResult(reclaimed=10, shared=20))
+        self.assertEqual(progress.scanned, 50)
+        self.assertEqual(progress.reclaimed, 10)
+        self.assertEqual(progress.shared, 20)
+        with self.assertLogs("moncic.utils.dedup", level="INFO") as out:
+            progress.report(force=True)
+        self.assertIn(
+            "50.0B/100.0B scanned, 10.0B reclaimed, 20.0B already shared",
+            out.output[0],
+        )
+
+    def test_run(self) -> None:
+        work: list[tuple[int, DedupeJob]] = []
+        for idx in range(10):
+            src = self.workdir / f"src{idx}"
+            src.write_bytes(b"test")
+            dst = self.workdir / f"dst{idx}"
+            dst.write_bytes(b"test")
+            work.append((idx, DedupeJob(src.as_posix(), [dst.as_posix()], 4)))
+
+        progress = DedupeProgress(40)
+        executor = DedupeExecutor[int](jobs=2)
+        self.assertEqual(executor.max_pending, 8)
+        # The test directory may not support deduplication: failures are
+        # logged and do not stop the work
+        with self.assertLogs("moncic.utils.dedup", level="INFO"):
+            results = list(executor.run(work, progress))
+        self.assertEqual(sorted(tag for tag, saved in results), list(range(10)))
+        self.assertEqual(progress.scanned, 40)
+
+    def test_dedupe_failed(self) -> None:
+        src = self.workdir / "src"
+        dsts = [(self.workdir / f"dst{idx}").as_posix() for idx in range(2)]
+        executor = DedupeExecutor[int](jobs=1)
+        with self.assertLogs("moncic.utils.dedup", level="WARNING"):
+            result = executor._dedupe(DedupeJob(src.as_posix(), dsts, 4))
+        # All destinations are reported as failed
+        self.assertEqual(result, DedupeResult(failed=2))
+
+    def test_dedupe_missing_destination(self) -> None:
+        src = self.workdir / "src"
+        src.write_bytes(b"test")
+        dsts = [(self.workdir / f"dst{idx}").as_posix() for idx in range(2)]
+        # Missing destinations are logged and skipped
+        with self.assertLogs("moncic.utils.btrfs", level="WARNING") as out:
+            result = do_dedupe_multi(src.as_posix(), dsts, 4)
+        self.assertEqual(result, DedupeResult(failed=2))
+        self.assertEqual(len(out.output), 2)
+
+    def test_extents(self) -> None:
+        path = self.workdir / "test"
+        path.write_bytes(os.urandom(100000))
+        fd = os.open(path, os.O_RDONLY)
+        self.addCleanup(os.close, fd)
+        os.fsync(fd)
+        try:
+            extents = get_extents(fd)
+        except OSError as e:
+            raise unittest.SkipTest(f"FIEMAP not supported: {e}")
+        self.assertTrue(extents)
+        self.assertEqual(extents[0].logical, 0)
+        self.assertTrue(extents_shared(extents, extents))
+
+    def test_extents_shared(self) -> None:
+        a = [Extent(0, 4096, 4096, 0), Extent(4096, 16384, 4096, 1)]
+        b = [Extent(0, 4096, 4096, 0x2000), Extent(4096, 16384, 4096, 0x2001)]
+        self.assertTrue(extents_shared(a, b))
+        self.assertFalse(extents_shared([], []))
+        self.assertFalse(extents_shared(a, a[:1]))
+        self.assertFalse(extents_shared(a, [a[0], a[1]._replace(physical=0)]))
+        # Data stored inline cannot be shared
+        inline = [Extent(0, 0, 100, 0x201)]
+        self.assertFalse(extents_shared(inline, inline))
@@ -0,0 +1,29 @@
+import errno
+import tempfile
+import unittest
+from pathlib import Path
+
+from moncic.utils.fs import exchange_paths
+
+
+class TestFs(unittest.TestCase):
+    def test_exchange_paths(self) -> None:
+        with tempfile.TemporaryDirectory() as workdir_str:
+            workdir = Path(workdir_str)
+            a = workdir / "a"
+            a.mkdir()
+            (a / "old").touch()
+            b = workdir / "b"
+            b.mkdir()
+            (b / "new").touch()
+            try:
+                exchange_paths(a, b)
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                raise unittest.SkipTest(f"RENAME_EXCHANGE not supported: {e}")
+            self.assertEqual([p.name for p in a.iterdir()], ["new"])
+            self.assertEqual([p.name for p in b.iterdir()], ["old"])
+
+            with self.assertRaises(FileNotFoundError):
+                exchange_paths(a, workdir / "missing")
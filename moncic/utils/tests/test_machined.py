@@ -0,0 +1,107 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from moncic.nspawn.container import DBUS_UNIT_CONFIG, NSPAWN_UNIT_CONFIG
+from moncic.utils.machined import (
+    HAVE_JEEPNEY,
+    UINT32_MAX,
+    UINT64_MAX,
+    Machined,
+    parse_cpu_set,
+    parse_size,
+    parse_timespan,
+    unit_properties,
+)
+
+
+class TestMachined(unittest.TestCase):
+    def test_parse_timespan(self) -> None:
+        self.assertEqual(parse_timespan("3"), 3_000_000)
+        self.assertEqual(parse_timespan("3min"), 180_000_000)
+        self.assertEqual(parse_timespan("500ms"), 500_000)
+        with self.assertRaises(ValueError):
+            parse_timespan("3 days")
+
+    def test_parse_size(self) -> None:
+        self.assertEqual(parse_size("1024"), 1024)
+        self.assertEqual(parse_size("2K"), 2048)
+        self.assertEqual(parse_size("4G"), 4 * 1024**3)
+        self.assertEqual(parse_size("infinity"), UINT64_MAX)
+        with self.assertRaises(ValueError):
+            parse_size("4GB")
+
+    def test_parse_cpu_set(self) -> None:
+        self.assertEqual(parse_cpu_set(""), b"")
+        self.assertEqual(parse_cpu_set("0"), b"\x01")
+        self.assertEqual(parse_cpu_set("0-3,6"), b"\x4f")
+        self.assertEqual(parse_cpu_set("1 9"), b"\x02\x02")
+
+    def test_resource_properties(self) -> None:
+        props = dict(
+            unit_properties(
+                [
+                    "CPUWeight=50",
+                    "IOWeight=1000",
+                    "CPUQuota=150%",
+                    "AllowedCPUs=0-1",
+                    "MemoryHigh=2G",
+                    "MemoryMax=50%",
+                ]
+            )
+        )
+        self.assertEqual(props["CPUWeight"], ("t", 50))
+        self.assertEqual(props["IOWeight"], ("t", 1000))
+        self.assertEqual(props["CPUQuotaPerSecUSec"], ("t", 1_500_000))
+        self.assertEqual(props["AllowedCPUs"], ("ay", b"\x03"))
+        self.assertEqual(props["MemoryHigh"], ("t", 2 * 1024**3))
+        self.assertEqual(props["MemoryMaxScale"], ("u", UINT32_MAX // 2))
+
+    def test_unit_properties(self) -> None:
+        props = dict(unit_properties(NSPAWN_UNIT_CONFIG + DBUS_UNIT_CONFIG))
+        self.assertEqual(props["KillMode"], ("s", "mixed"))
+        self.assertEqual(props["Type"], ("s", "notify"))
+        self.assertEqual(
+            props["RestartForceExitStatus"], ("(aiai)", ([133], []))
+        )
+        self.assertEqual(props["SuccessExitStatus"], ("(aiai)", ([133], [])))
+        self.assertEqual(props["Slice"], ("s", "machine.slice"))
+        self.assertEqual(props["Delegate"], ("b", True))
+        self.assertEqual(props["TasksMax"], ("t", 16384))
+        self.assertEqual(props["WatchdogUSec"], ("t", 180_000_000))
+        self.assertEqual(props["CollectMode"], ("s", "inactive-or-failed"))
+
+    def test_unsupported(self) -> None:
+        with self.assertRaises(ValueError):
+            unit_properties(["CPUAccounting=yes"])
+        with self.assertRaises(ValueError):
+            unit_properties(["CPUQuota=2"])
+
+    @unittest.skipIf(not HAVE_JEEPNEY, "jeepney not available")
+    def test_start_timeout(self) -> None:
+        clock = [1000.0]
+        timeouts: list[float] = []
+
+        def recv_until_filtered(signals: object, timeout: float) -> object:
+            timeouts.append(timeout)
+            if timeout <= 0:
+                raise TimeoutError()
+            # Signals about other jobs keep arriving
+            clock[0] += 4
+            return SimpleNamespace(body=(1, "/job/other", "other", "done"))
+
+        conn = mock.MagicMock()
+        conn.recv_until_filtered.side_effect = recv_until_filtered
+        machined = Machined(conn)
+        with (
+            mock.patch.object(machined, "_call", return_value=("/job/1",)),
+            mock.patch(
+                "moncic.utils.machined.time.monotonic",
+                side_effect=lambda: clock[0],
+            ),
+        ):
+            with self.assertRaises(TimeoutError):
+                machined.start_transient_unit(
+                    "test.service", ["true"], [], timeout=10
+                )
+        self.assertEqual(timeouts, [10, 6, 2, 0])
@@ -0,0 +1,53 @@
+import os
+import signal
+import subprocess
+import time
+import unittest
+from pathlib import Path
+
+from moncic.utils.process import CGROUP_ROOT, ProcessHandle, process_cgroup
+
+
+class TestProcessHandle(unittest.TestCase):
+    def test_wait(self) -> None:
+        proc = subprocess.Popen(["sleep", "60"])
+        self.addCleanup(proc.wait)
+        with ProcessHandle(proc.pid) as handle:
+            self.assertFalse(handle.wait(0.05))
+            handle.send_signal(signal.SIGTERM)
+            # Reap the child, as a non-child would be reaped by its parent
+            proc.wait()
+            started = time.monotonic()
+            self.assertTrue(handle.wait(5))
+            self.assertLess(time.monotonic() - started, 1)
+            self.assertTrue(handle.exited)
+            # Signalling an exited process is a no-op
+            handle.send_signal(signal.SIGTERM)
+
+    def test_exited(self) -> None:
+        proc = subprocess.Popen(["true"])
+        proc.wait()
+        with ProcessHandle(proc.pid) as handle:
+            self.assertTrue(handle.wait(0))
+            self.assertTrue(handle.exited)
+
+    def test_without_pidfd(self) -> None:
+        proc = subprocess.Popen(["sleep", "60"])
+        self.addCleanup(proc.wait)
+        handle = ProcessHandle(proc.pid)
+        handle.close()
+        self.assertFalse(handle.wait(0.05))
+        handle.send_signal(signal.SIGKILL)
+        proc.wait()
+        self.assertTrue(handle.wait(5))
+
+
+class TestProcessCgroup(unittest.TestCase):
+    def test_process_cgroup(self) -> None:
+        lines = Path("/proc/self/cgroup").read_text().splitlines()
+        unified = [line for line in lines if line.startswith("0::")]
+        cgroup = process_cgroup(os.getpid())
+        if not unified:
+            self.assertIsNone(cgroup)
+            return
+        self.assertEqual(cgroup, CGROUP_ROOT / unified[0][3:].lstrip("/"))
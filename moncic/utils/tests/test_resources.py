@@ -0,0 +1,69 @@
+import unittest
+
+from moncic.utils.resources import (
+    PRIORITY_CLASSES,
+    load_resources,
+    resource_unit_config,
+)
+
+
+class TestResources(unittest.TestCase):
+    def test_load(self) -> None:
+        self.assertEqual(load_resources(None), {})
+        self.assertEqual(
+            load_resources({"cpu_weight": 200, "memory_max": "4G"}),
+            {"cpu_weight": "200", "memory_max": "4G"},
+        )
+        with self.assertRaisesRegex(ValueError, "'cpu_shares'"):
+            load_resources({"cpu_shares": 200})
+
+    def test_load_values(self) -> None:
+        self.assertEqual(
+            load_resources(
+                {
+                    "cpu_quota": "150%",
+                    "allowed_cpus": "0-3,6",
+                    "memory_high": "50%",
+                    "memory_max": "infinity",
+                    "io_weight": 10,
+                }
+            ),
+            {
+                "cpu_quota": "150%",
+                "allowed_cpus": "0-3,6",
+                "memory_high": "50%",
+                "memory_max": "infinity",
+                "io_weight": "10",
+            },
+        )
+
+        # Values not supported when starting containers via D-Bus are
+        # rejected when loading the configuration
+        for name, value in (
+            ("memory_max", "1.5G"),
+            ("memory_max", "4GB"),
+            ("cpu_quota", "infinity"),
+            ("cpu_quota", "2"),
+            ("cpu_weight", "idle"),
+            ("io_weight", "1.5"),
+            ("allowed_cpus", "all"),
+        ):
+            with self.subTest(name=name, value=value):
+                with self.assertRaisesRegex(ValueError, repr(name)):
+                    load_resources({name: value})
+
+    def test_unit_config(self) -> None:
+        self.assertEqual(resource_unit_config(), [])
+        self.assertEqual(
+            resource_unit_config(
+                {"cpu_weight": "200", "memory_max": "4G"},
+                {"allowed_cpus": "0-3"},
+                PRIORITY_CLASSES["batch"],
+            ),
+            [
+                "CPUWeight=50",
+                "MemoryMax=4G",
+                "AllowedCPUs=0-3",
+                "IOWeight=50",
+            ],
+        )
@@ -0,0 +1,63 @@
+import subprocess
+import tempfile
+import unittest
+from pathlib import Path
+
+from moncic.runner import UserConfig
+from moncic.utils.script import Script, ScriptBatch
+
+
+class TestScriptBatch(unittest.TestCase):
+    def run_script(self, script: Script) -> subprocess.CompletedProcess[str]:
+        with tempfile.NamedTemporaryFile("wt") as tf:
+            script.print(file=tf)
+            tf.flush()
+            return subprocess.run(
+                ["/bin/sh", "-ue", tf.name], capture_output=True, text=True
+            )
+
+    def make_script(self, title: str, *lines: str) -> Script:
+        script = Script(title, cwd=Path("/"), user=UserConfig.root())
+        for line in lines:
+            script.run_unquoted(line)
+        return script
+
+    def test_merge(self) -> None:
+        batch = ScriptBatch("Setup")
+        batch.add(self.make_script("first", "echo one"))
+        batch.add(self.make_script("empty"))
+        batch.add(self.make_script("second", "echo two"))
+        other = Script("other", cwd=Path("/tmp"), user=UserConfig.root())
+        other.run(["echo", "three"])
+        batch.add(other)
+
+        merged = batch.merged()
+        self.assertEqual(len(merged), 2)
+        self.assertEqual(merged[0].title, "Setup: first, second")
+        self.assertIs(merged[1], other)
+
+        res = self.run_script(merged[0])
+        self.assertEqual(res.returncode, 0)
+        self.assertEqual(res.stdout, "one\ntwo\n")
+
+    def test_failure(self) -> None:
+        batch = ScriptBatch("Setup")
+        batch.add(self.make_script("first", "false", "echo not reached"))
+        batch.add(self.make_script("second", "echo two"))
+        (merged,) = batch.merged()
+        res = self.run_script(merged)
+        self.assertEqual(res.returncode, 1)
+        self.assertEqual(res.stdout, "")
+        self.assertIn("Failed step: first", res.stderr)
+
+    def test_keep_going(self) -> None:
+        batch = ScriptBatch("Teardown", keep_going=True)
+        batch.add(self.make_script("first", "exit 3"))
+        batch.add(self.make_script("second", "echo two"))
+        batch.add(self.make_script("third", "exit 0", "echo not reached"))
+        (merged,) = batch.merged()
+        res = self.run_script(merged)
+        self.assertNotEqual(res.returncode, 0)
+        self.assertEqual(res.stdout, "two\n")
+        self.assertIn("Failed step: first", res.stderr)
+        self.assertNotIn("third", res.stderr)
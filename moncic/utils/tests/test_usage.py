@@ -0,0 +1,48 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from moncic.utils.usage import (
+    DiskUsage,
+    ImageExtents,
+    combine_extents,
+    extent_usage,
+    scan_extents,
+)
+
+
+class TestUsage(unittest.TestCase):
+    def test_combine(self) -> None:
+        res = combine_extents(
+            {
+                "base": ImageExtents({0: 100, 4096: 200}, 10),
+                "child": ImageExtents({0: 100, 8192: 50}, 0),
+                "other": ImageExtents({16384: 300}, 0),
+            }
+        )
+        self.assertEqual(res["base"], DiskUsage(310, 210))
+        self.assertEqual(res["base"].shared, 100)
+        self.assertEqual(res["child"], DiskUsage(150, 50))
+        self.assertEqual(res["other"], DiskUsage(300, 300))
+        self.assertEqual(res["other"].shared, 0)
+
+    def test_scan(self) -> None:
+        with tempfile.TemporaryDirectory() as workdir:
+            root = Path(workdir)
+            (root / "etc").mkdir()
+            (root / "etc" / "data").write_bytes(b"x" * 65536)
+            os.link(root / "etc" / "data", root / "etc" / "hardlink")
+            os.symlink("data", root / "etc" / "symlink")
+            (root / "empty").write_bytes(b"")
+
+            scan = scan_extents(root)
+            total = sum(scan.extents.values()) + scan.private
+            # The hardlink is only counted once
+            self.assertGreaterEqual(total, 65536)
+            self.assertLess(total, 65536 * 2)
+
+            res = extent_usage({"a": root, "b": root / "etc"}, jobs=2)
+            # Both images reference the same data
+            self.assertEqual(res["a"].referenced, res["b"].referenced)
+            self.assertEqual(res["a"].exclusive, scan.private)
@@ -0,0 +1,194 @@
+"""
+Disk usage accounting of images sharing storage
+"""
+
+import concurrent.futures
+import logging
+import os
+import stat
+from collections import Counter
+from pathlib import Path
+from typing import NamedTuple
+
+from .btrfs import (
+    FIEMAP_EXTENT_DATA_INLINE,
+    FIEMAP_EXTENT_UNKNOWN,
+    get_extents,
+    get_subvolume_info,
+    ioctl_qgroup_info,
+)
+
+log = logging.getLogger(__name__)
+
+#: Inode number of the root directory of btrfs subvolumes
+BTRFS_FIRST_FREE_OBJECTID = 256
+
+
+class DiskUsage(NamedTuple):
+    """Disk usage of an image."""
+
+    #: Bytes of data referenced by the image
+    referenced: int
+    #: Bytes of data referenced only by the image, which would be freed by
+    #: removing it
+    exclusive: int
+
+    @property
+    def shared(self) -> int:
+        """Bytes of data that the image shares with others."""
+        return self.referenced - self.exclusive
+
+
+class ImageExtents(NamedTuple):
+    """Data referenced by the files of an image."""
+
+    #: Length of each physical extent, indexed by physical offset
+    extents: dict[int, int]
+    #: Bytes of data that cannot be shared, like inline extents
+    private: int
+
+
+def scan_extents(path: Path) -> ImageExtents:
+    """
+    Collect the physical extents of all files in a directory tree.
+
+    Files whose extents cannot be read are accounted using their allocated
+    blocks.
+    """
+    extents: dict[int, int] = {}
+    private = 0
+    seen: set[tuple[int, int]] = set()
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            pathname = os.path.join(root, name)
+            try:
+                st = os.lstat(pathname)
+            except OSError:
+                # Files can disappear while we work
+                continue
+            if not stat.S_ISREG(st.st_mode) or not st.st_size:
+                continue
+            if st.st_nlink > 1:
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+            try:
+                fd = os.open(pathname, os.O_RDONLY | os.O_NOFOLLOW)
+            except OSError:
+                continue
+            try:
+                file_extents = get_extents(fd)
+            except OSError:
+                private += st.st_blocks * 512
+                continue
+            finally:
+                os.close(fd)
+            for extent in file_extents:
+                if extent.flags & (
+                    FIEMAP_EXTENT_UNKNOWN | FIEMAP_EXTENT_DATA_INLINE
+                ):
+                    private += extent.length
+                elif extent.length > extents.get(extent.physical, 0):
+                    extents[extent.physical] = extent.length
+    return ImageExtents(extents, private)
+
+
+def combine_extents(scans: dict[str, ImageExtents]) -> dict[str, DiskUsage]:
+    """
+    Compute the disk usage of images from their extents.
+
+    An extent is exclusive to an image if no other image references it.
+    """
+    users: Counter[int] = Counter()
+    for scan in scans.values():
+        users.update(scan.extents.keys())
+    res: dict[str, DiskUsage] = {}
+    for name, scan in scans.items():
+        referenced = scan.private
+        exclusive = scan.private
+        for physical, length in scan.extents.items():
+            referenced += length
+            if users[physical] == 1:
+                exclusive += length
+        res[name] = DiskUsage(referenced, exclusive)
+    return res
+
+
+def extent_usage(
+    paths: dict[str, Path], jobs: int | None = None
+) -> dict[str, DiskUsage]:
+    """
+    Compute the disk usage of images by walking the extents of their files.
+
+    Images are scanned in parallel. Sizes are uncompressed, and only sharing
+    among the given images is taken into account.
+
+    :param paths: paths of the images, indexed by name
+    :param jobs: number of images to scan in parallel
+    """
+    jobs = jobs or min(8, os.cpu_count() or 1)
+    scans: dict[str, ImageExtents] = {}
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=jobs, thread_name_prefix="usage"
+    ) as pool:
+        futures = {
+            pool.submit(scan_extents, path): name
+            for name, path in paths.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            scans[name] = future.result()
+            log.debug("%s: extents scanned", name)
+    return combine_extents(scans)
+
+
+def qgroup_usage(paths: dict[str, Path]) -> dict[str, DiskUsage] | None:
+    """
+    Read the disk usage of btrfs subvolumes from their quota groups.
+
+    This needs root privileges. Exclusive bytes are not shared with any other
+    subvolume in the file system, including snapshots that are not images.
+
+    :param paths: paths of the images, indexed by name
+    :returns: None if the information is not available, for example because
+      quotas are not enabled
+    """
+    subvolids: dict[str, int] = {}
+    for name, path in paths.items():
+        # Only subvolume roots have their own quota group
+        if path.stat().st_ino != BTRFS_FIRST_FREE_OBJECTID:
+            return None
+        if (info := get_subvolume_info(path)) is None:
+            return None
+        subvolids[name] = info.subvolid
+    if not subvolids:
+        return {}
+    fd = os.open(next(iter(paths.values())), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        qgroups = ioctl_qgroup_info(fd)
+    except OSError as e:
+        log.debug("cannot read btrfs quota groups: %s", e)
+        return None
+    finally:
+        os.close(fd)
+    res: dict[str, DiskUsage] = {}
+    for name, subvolid in subvolids.items():
+        if (qgroup := qgroups.get(subvolid)) is None:
+            return None
+        res[name] = DiskUsage(qgroup.referenced, qgroup.exclusive)
+    return res
+
+
+def disk_usage(
+    paths: dict[str, Path], jobs: int | None = None
+) -> dict[str, DiskUsage]:
+    """
+    Compute the disk usage of images, using btrfs quota groups if they are
+    enabled, or walking the extents of their files otherwise.
+
+    :param paths: paths of the images, indexed by name
+    :param jobs: number of images to scan in parallel
+    """
+    if (res := qgroup_usage(paths)) is not None:
+        return res
+    return extent_usage(paths, jobs)